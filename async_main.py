@@ -0,0 +1,465 @@
+"""Serve the ticket system on an asyncio event loop.
+
+    python async_main.py
+    gunicorn async_main:create_app --bind 0.0.0.0:$PORT --worker-class aiohttp.GunicornWebWorker
+
+/webhook, /send_reply/<ticket_id> and /send_file/<ticket_id> are handled on the
+loop: Green API requests and media downloads go through aiohttp, so thousands of
+them can be in flight in one process. Ticket changes, Supabase calls and ffmpeg
+runs go to a thread pool. Every other route is served by the Flask app in main.py
+on a second thread pool, so pages, templates and the JSON API are the same as
+with `gunicorn main:app`.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import asynccontextmanager
+
+import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
+from werkzeug.utils import secure_filename
+
+import main
+from main import logger
+
+# --- Configuration ---
+# ASYNC_THREADS threads run ticket changes and Supabase calls for the handlers on
+# the loop; GUNICORN_THREADS threads serve the Flask routes, one per request or
+# open /events connection, as in threaded mode.
+ASYNC_THREADS = int(os.getenv('ASYNC_THREADS', '32'))
+ASYNC_MAX_PENDING_WEBHOOKS = int(os.getenv('ASYNC_MAX_PENDING_WEBHOOKS', '10000'))  # Beyond this, webhooks get 503
+ASYNC_GREEN_API_CONCURRENCY = int(os.getenv('ASYNC_GREEN_API_CONCURRENCY', '1000'))  # Green API requests in flight
+WSGI_THREADS = int(os.getenv('GUNICORN_THREADS', '32'))
+WSGI_BUFFER_BYTES = 1024 * 1024  # Flask responses up to this size are sent in one piece, larger ones streamed
+WSGI_WRITE_TIMEOUT = 60  # Seconds a streamed chunk may take to reach the client
+MAX_REQUEST_BYTES = 100 * 1024 * 1024  # Green API accepts files of up to 100 MB
+
+green_api_slots = asyncio.Semaphore(max(ASYNC_GREEN_API_CONCURRENCY, 1))
+sender_turns = {}  # Sender -> [asyncio.Lock, webhooks holding or waiting for it]
+webhook_tasks = set()
+download_tasks = set()
+state = {'session': None, 'wsgi_executor': None}
+
+def create_http_session():
+    """The aiohttp session for Green API requests and media downloads."""
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+
+def start_task(coroutine, tasks):
+    """Run a coroutine in the background, keeping a reference to it in `tasks` until it is done."""
+    task = asyncio.get_running_loop().create_task(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+# --- Webhook Handler ---
+# Webhooks are acknowledged once claimed and processed by a task each. A sender's
+# webhooks take turns on one asyncio.Lock, which hands itself over in arrival
+# order, so each chat is still handled strictly in order. WEBHOOK_WORKERS=0
+# processes webhooks within the request, as in threaded mode.
+async def webhook(request):
+    """Validate a Green API webhook, start processing it and acknowledge it."""
+    with main.timed('ticket_system_webhook_stage_seconds', stage='parse'):
+        try:
+            data = await request.json()
+        except (ValueError, web.HTTPException):
+            data = None
+        valid = isinstance(data, dict) and bool(data.get('typeWebhook'))
+    if not valid:
+        return web.json_response({"status": "error", "message": "Invalid webhook payload"}, status=400)
+    logger.debug(f"Received raw data: {data}")
+
+    if data['typeWebhook'] != 'incomingMessageReceived':
+        logger.debug(f"Received non-actionable webhook: {data['typeWebhook']}")
+        return web.json_response({"status": "ok"})
+
+    id_message = data.get('idMessage')
+    with main.timed('ticket_system_webhook_stage_seconds', stage='dedup'):
+        if main.WEBHOOK_DEDUP_DATABASE:
+            claimed = await asyncio.to_thread(main.claim_webhook, id_message)  # May look the ID up in Supabase
+        else:
+            claimed = main.claim_webhook(id_message)
+    if not claimed:
+        logger.info(f"Ignoring redelivered webhook {id_message}.")
+        return web.json_response({"status": "ok", "duplicate": True})
+
+    if main.WEBHOOK_WORKERS <= 0:
+        try:
+            with main.timed('ticket_system_webhook_processing_seconds', type=main.get_webhook_message_type(data)):
+                await process_webhook(data)
+        except Exception as e:
+            main.release_webhook(id_message)
+            logger.error(f"Error processing webhook: {e}", exc_info=True)
+            return web.json_response({"status": "error", "message": str(e)}, status=500)
+        return web.json_response({"status": "ok"})
+
+    if len(webhook_tasks) >= ASYNC_MAX_PENDING_WEBHOOKS:
+        # Green API redelivers on failure, so shed load instead of piling up tasks
+        main.release_webhook(id_message)
+        with main.webhook_stats_lock:
+            main.webhook_queue_stats['rejected'] += 1
+        logger.warning("Too many webhooks pending, rejecting webhook.")
+        return web.json_response({"status": "error", "message": "Queue full"}, status=503)
+    with main.webhook_stats_lock:
+        main.webhook_queue_stats['enqueued'] += 1
+        main.webhook_queue_stats['pending'] += 1
+    start_task(run_webhook(data, main.get_webhook_sender(data) or '', time.monotonic()), webhook_tasks)
+    return web.json_response({"status": "ok"})
+
+@asynccontextmanager
+async def sender_turn(sender):
+    """Wait for the sender's earlier webhooks to be processed."""
+    turn = sender_turns.get(sender)
+    if turn is None:
+        turn = sender_turns[sender] = [asyncio.Lock(), 0]
+    turn[1] += 1
+    try:
+        async with turn[0]:
+            yield
+    finally:
+        turn[1] -= 1
+        if not turn[1]:
+            del sender_turns[sender]
+
+async def run_webhook(data, sender, enqueued_at):
+    async with sender_turn(sender):
+        main.count_webhook_started(time.monotonic() - enqueued_at, pending=True)
+        message_type = main.get_webhook_message_type(data)
+        outcome = 'failed'
+        try:
+            with main.timed('ticket_system_webhook_processing_seconds', type=message_type):
+                await process_webhook(data)
+            outcome = 'processed'
+        except Exception as e:
+            logger.error(f"Error processing webhook: {e}", exc_info=True)
+        finally:
+            main.count_webhook_finished(outcome)
+
+async def process_webhook(data):
+    """Apply an incoming message webhook to the tickets, like main.process_webhook."""
+    parsed = main.parse_webhook(data)
+    if parsed is None:
+        return
+    action, sender, sender_name, message = parsed
+    if action == 'close':
+        ticket_id, reply_text = await asyncio.to_thread(main.close_sender_ticket, sender)
+        with main.timed('ticket_system_webhook_stage_seconds', stage='reply'):
+            await send_whatsapp_message(sender, reply_text, ticket_id=ticket_id, author="System")
+        if ticket_id is not None:
+            with main.timed('ticket_system_webhook_stage_seconds', stage='persist'):
+                await asyncio.to_thread(main.save_ticket_to_db, main.tickets[ticket_id])
+        return
+
+    if message.get('file_url'):
+        start_task(download_media(message['file_url']), download_tasks)  # Download before the URL expires
+    ticket_id, created = await asyncio.to_thread(main.record_incoming_message, sender, sender_name, message)
+    if created:
+        with main.timed('ticket_system_webhook_stage_seconds', stage='reply'):
+            await send_whatsapp_message(sender, main.ticket_created_reply(ticket_id), ticket_id=ticket_id, author="System")
+    with main.timed('ticket_system_webhook_stage_seconds', stage='persist'):
+        await asyncio.to_thread(main.save_ticket_to_db, main.tickets[ticket_id])
+
+# --- Green API Client ---
+# Requests share the keep-alive connections of one aiohttp session. Up to
+# ASYNC_GREEN_API_CONCURRENCY are in flight; they keep to GREEN_API_RATE_LIMIT and
+# are retried like in threaded mode, and counted in the same Green API stats.
+# There is no send queue, so agent replies are not sent ahead of automatic messages.
+async def green_api_post(host, method, read_timeout=main.GREEN_API_READ_TIMEOUT, payload=None, fields=None, file=None):
+    """POST JSON `payload`, or form `fields` with a (file name, bytes) `file`, to a Green API method.
+
+    Returns the status and body of the response. Raises if the request fails after all retries.
+    """
+    url = main.green_api_url(host, method)
+    timeout = aiohttp.ClientTimeout(sock_connect=main.GREEN_API_CONNECT_TIMEOUT, sock_read=read_timeout)
+    enqueued_at = time.monotonic()
+    async with green_api_slots:
+        main.record_green_api_queue_wait(method, time.monotonic() - enqueued_at)
+        attempt = 0
+        while True:
+            delay = main.reserve_rate_limit_slot()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            started_at = time.monotonic()
+            retry_after = None
+            try:
+                async with state['session'].post(url, json=payload, data=build_form(fields, file), timeout=timeout) as response:
+                    body = await response.text()
+            except aiohttp.ClientConnectionError as e:
+                main.record_green_api_call(method, time.monotonic() - started_at, failed=True)
+                if attempt >= main.GREEN_API_MAX_RETRIES or isinstance(e, aiohttp.SocketTimeoutError):
+                    raise  # Like requests, read timeouts are not retried: the message may have been sent
+            else:
+                main.record_green_api_call(method, time.monotonic() - started_at, failed=response.status != 200)
+                if response.status not in main.GREEN_API_RETRY_STATUSES or attempt >= main.GREEN_API_MAX_RETRIES:
+                    return response.status, body
+                if response.headers.get('Retry-After', '').isdigit():
+                    retry_after = int(response.headers['Retry-After'])
+
+            attempt += 1
+            await asyncio.sleep(main.green_api_retry_delay(method, attempt, retry_after))
+
+def build_form(fields, file):
+    """Multipart form of an upload; built again for each attempt, as aiohttp consumes it."""
+    if fields is None:
+        return None
+    form = aiohttp.FormData()
+    for name, value in fields.items():
+        form.add_field(name, value)
+    if file is not None:
+        form.add_field('file', file[1], filename=file[0], content_type='application/octet-stream')
+    return form
+
+async def send_whatsapp_message(chat_id, text, ticket_id=None, author="Agent"):
+    """Send a WhatsApp message and log it to the ticket history, like main.send_whatsapp_message."""
+    try:
+        logger.info(f"Attempting to send message to {chat_id}: {text}")
+        status, body = await green_api_post('api', 'sendMessage', payload={"chatId": chat_id, "message": text})
+        if status == 200:
+            await asyncio.to_thread(main.record_sent_message, chat_id, text, ticket_id, author)
+        else:
+            logger.error(f"Failed to send message to {chat_id}. Status: {status}, Response: {body}")
+    except Exception as e:
+        logger.error(f"Error sending message to {chat_id}: {e}")
+
+async def send_whatsapp_file(chat_id, file_path, file_data, file_name, caption="", ticket_id=None, author="Agent"):
+    """Send a file via SendFileByUpload, like main.send_whatsapp_file. `file_path` holds `file_data`."""
+    try:
+        fields = {'chatId': chat_id, 'fileName': file_name}
+        if caption:
+            fields['caption'] = caption
+        logger.info(f"Attempting to send file to {chat_id}: {file_name}")
+        status, body = await green_api_post('media', 'sendFileByUpload', read_timeout=main.GREEN_API_UPLOAD_TIMEOUT,
+                                            fields=fields, file=(file_name, file_data))
+        if status == 200:
+            return await asyncio.to_thread(main.record_sent_file, chat_id, json.loads(body), file_path, file_name,
+                                           caption, ticket_id, author)
+        logger.error(f"Failed to send file to {chat_id}. Status: {status}, Response: {body}")
+        return None
+    except Exception as e:
+        logger.error(f"Error sending file to {chat_id}: {e}")
+        return None
+
+# --- Media Downloads ---
+async def download_media(file_url):
+    """Download an inbound media file into the cache, unless it already is being downloaded."""
+    url_key = main.media_url_key(file_url)
+    if main.claim_media_download(url_key) is not None:
+        return
+    try:
+        if await asyncio.to_thread(main.get_cached_media_path, file_url) is not None:
+            return
+        started_at = time.monotonic()
+        fd, temp_path = await asyncio.to_thread(main.new_media_temp_file)
+        timeout = aiohttp.ClientTimeout(sock_connect=main.MEDIA_DOWNLOAD_TIMEOUT[0], sock_read=main.MEDIA_DOWNLOAD_TIMEOUT[1])
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                async with state['session'].get(file_url, timeout=timeout) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(main.MEDIA_CHUNK_SIZE):
+                        digest.update(chunk)
+                        temp_file.write(chunk)  # Into the page cache; cheaper than a hop to a thread
+                        size += len(chunk)
+            await asyncio.to_thread(main.commit_media, file_url, temp_path, digest.hexdigest(), size)
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            logger.error(f"Failed to download media {file_url}: {e}")
+            main.record_media_download(time.monotonic() - started_at)
+            return
+        main.record_media_download(time.monotonic() - started_at, size)
+    finally:
+        main.release_media_download(url_key)
+
+# --- Agent Routes ---
+async def send_reply(request):
+    """Send a reply to a ticket via web interface."""
+    ticket_id = request.match_info['ticket_id']
+    problem = main.reply_ticket_problem(ticket_id)
+    if problem:
+        return web.json_response({'success': False, 'message': problem})
+
+    data = await request.json()
+    message = data.get('message', '').strip()
+
+    if not message:
+        return web.json_response({'success': False, 'message': 'Message cannot be empty'})
+
+    try:
+        chat_id = main.tickets[ticket_id]['sender_id']
+        await send_whatsapp_message(chat_id, message, ticket_id=ticket_id, author="Agent")
+        return web.json_response({'success': True, 'message': 'Reply sent successfully'})
+    except Exception as e:
+        logger.error(f"Error sending reply via web interface: {e}")
+        return web.json_response({'success': False, 'message': str(e)})
+
+async def send_file(request):
+    """Handle file uploads and send via WhatsApp."""
+    ticket_id = request.match_info['ticket_id']
+    try:
+        form = await request.post()
+        file = form.get('file')
+        if not isinstance(file, web.FileField):
+            return web.json_response({'success': False, 'message': 'No file uploaded'})
+
+        caption = form.get('caption', '')
+
+        if file.filename == '':
+            return web.json_response({'success': False, 'message': 'No file selected'})
+
+        problem = main.reply_ticket_problem(ticket_id)
+        if problem:
+            return web.json_response({'success': False, 'message': problem})
+
+        chat_id = main.tickets[ticket_id]['sender_id']
+
+        filename = secure_filename(file.filename)
+
+        file_data = await asyncio.to_thread(file.file.read)
+        if file.content_type and file.content_type.startswith('audio/'):
+            # Convert audio to MP3 for better WhatsApp compatibility
+            # On a thread, so ffmpeg runs share main.py's TRANSCODE_WORKERS slots with the Flask routes
+            filename, file_data = main.converted_upload(filename, file_data, await asyncio.to_thread(main.transcode_audio, file_data, 'mp3'))
+
+        # Save the file to upload under a unique temporary name; the ticket history caches it from there
+        temp_file_path = await asyncio.to_thread(write_temp_file, os.path.splitext(filename)[1], file_data)
+        try:
+            result = await send_whatsapp_file(chat_id, temp_file_path, file_data, filename, caption, ticket_id)
+        finally:
+            await asyncio.to_thread(os.remove, temp_file_path)
+
+        if result:
+            return web.json_response({'success': True, 'message': 'File sent successfully'})
+        else:
+            return web.json_response({'success': False, 'message': 'Failed to send file'})
+
+    except Exception as e:
+        logger.error(f"Error in send_file route: {e}")
+        return web.json_response({'success': False, 'message': f'Server error: {str(e)}'})
+
+def write_temp_file(suffix, data):
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, 'wb') as temp_file:
+        temp_file.write(data)
+    return path
+
+# --- Flask Routes ---
+# Any other request is passed to main.app as a WSGI call on a thread of its own.
+# The thread also iterates the response and hands each chunk to the loop, so
+# streamed responses such as /events work as under gunicorn's threaded workers.
+async def wsgi_handler(request):
+    body = await request.read()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(state['wsgi_executor'], run_wsgi, request, wsgi_environ(request, body), loop)
+
+def wsgi_environ(request, body):
+    url = request.url
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': request.rel_url.raw_query_string,
+        'SERVER_NAME': url.host or '',
+        'SERVER_PORT': str(url.port or (443 if request.scheme == 'https' else 80)),
+        'SERVER_PROTOCOL': f"HTTP/{request.version.major}.{request.version.minor}",
+        'REMOTE_ADDR': request.remote or '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    if 'Content-Type' in request.headers:
+        environ['CONTENT_TYPE'] = request.headers['Content-Type']
+    for name in request.headers.keys():
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH') and key not in environ:
+            environ[key] = ','.join(request.headers.getall(name))
+    return environ
+
+def run_wsgi(request, environ, loop):
+    """Call the Flask app in this thread and return its response, streaming it if it is large or open-ended."""
+    started = {}
+    def start_response(status, headers, exc_info=None):
+        started['status'], started['headers'] = status, headers
+
+    result = main.app(environ, start_response)
+    try:
+        status, reason = started['status'].split(' ', 1)
+        headers = CIMultiDict(started['headers'])
+        content_length = headers.get('Content-Length')
+        if content_length is not None and int(content_length) <= WSGI_BUFFER_BYTES:
+            return web.Response(status=int(status), reason=reason, headers=headers, body=b''.join(result))
+
+        response = web.StreamResponse(status=int(status), reason=reason, headers=headers)
+        def on_loop(coroutine):
+            future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+            try:
+                return future.result(WSGI_WRITE_TIMEOUT)
+            except FutureTimeoutError:
+                future.cancel()
+                raise
+        on_loop(response.prepare(request))
+        for chunk in result:
+            if chunk:
+                on_loop(response.write(chunk))
+        return response
+    except ConnectionResetError:
+        return response  # The client went away, e.g. closed a tab following /events
+    except FutureTimeoutError:
+        # The client stopped reading; drop the connection instead of leaving the response half sent
+        logger.warning(f"Closing {request.path}: the client did not read the response for {WSGI_WRITE_TIMEOUT}s.")
+        loop.call_soon_threadsafe(close_transport, request)
+        return response
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+def close_transport(request):
+    if request.transport is not None:
+        request.transport.close()
+
+# --- App ---
+async def start_async_serving(application):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max(ASYNC_THREADS, 1), thread_name_prefix='async-worker'))
+    state['wsgi_executor'] = ThreadPoolExecutor(max(WSGI_THREADS, 1), thread_name_prefix='wsgi')
+    state['session'] = create_http_session()
+    logger.info(f"Serving on an event loop with {ASYNC_THREADS} worker threads and {WSGI_THREADS} Flask threads.")
+
+async def drain_webhook_tasks(application):
+    """Give pending webhooks and downloads a chance to finish before the server stops."""
+    tasks = webhook_tasks | download_tasks
+    if tasks:
+        _, unfinished = await asyncio.wait(tasks, timeout=main.WEBHOOK_DRAIN_TIMEOUT)
+        if unfinished:
+            logger.warning(f"Exiting with {len(unfinished)} webhooks and media downloads unfinished.")
+
+async def stop_async_serving(application):
+    await state['session'].close()
+    state['wsgi_executor'].shutdown(wait=False, cancel_futures=True)
+
+async def create_app():
+    """The aiohttp application; gunicorn's aiohttp.GunicornWebWorker calls this in each worker."""
+    application = web.Application(client_max_size=MAX_REQUEST_BYTES)
+    application.router.add_post('/webhook', webhook)
+    application.router.add_post('/send_reply/{ticket_id}', send_reply)
+    application.router.add_post('/send_file/{ticket_id}', send_file)
+    application.router.add_route('*', '/{path:.*}', wsgi_handler)
+    application.on_startup.append(start_async_serving)
+    application.on_shutdown.append(drain_webhook_tasks)
+    application.on_cleanup.append(stop_async_serving)
+    return application
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), access_log=None)
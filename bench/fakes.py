@@ -0,0 +1,418 @@
+"""Local stand-ins for Supabase and Green API used by the benchmark.
+
+Both keep call counts and sleep a configurable latency per call, outside of any
+lock, so concurrent calls overlap as they would against the real services.
+"""
+import asyncio
+import io
+import itertools
+import json
+import threading
+import time
+import types
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import requests
+
+# --- Supabase ---
+# An in-memory database behind the subset of the supabase-py query builder main.py
+# uses. It enforces what supabase_schema.sql declares that the app relies on: one
+# open ticket per sender, unique message idMessage and message_key values, and tickets touched
+# when messages are added. `ticket_summaries` is computed like the view.
+
+class UniqueViolation(Exception):
+    def __init__(self, constraint):
+        super().__init__(json.dumps({'code': '23505', 'message': f'duplicate key value violates unique constraint "{constraint}"'}))
+
+class FakeResult:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+def column_value(row, column):
+    if '->>' in column:
+        column, key = column.split('->>', 1)
+        value = (row.get(column) or {}).get(key)
+        return None if value is None else str(value)
+    return row.get(column)
+
+class FakeDatabase:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tickets = {}
+        self.messages = {}  # id -> row, in insertion order
+        self.messages_by_ticket = {}  # ticket_id -> rows
+        self.message_ids_by_key = {'id_message': {}, 'message_key': {}}  # Unique column -> value -> id
+        self.voice_transcriptions = {}  # message_id -> row
+        self.message_ids = itertools.count(1)
+        self.ticket_numbers = itertools.count(1)
+        self.calls = Counter()  # 'table.operation' -> calls
+
+    def table_rows(self, table, filters):
+        if table == 'tickets':
+            return list(self.tickets.values())
+        if table == 'messages':
+            for column, operator, value in filters:
+                if column == 'ticket_id' and operator == 'eq':
+                    return list(self.messages_by_ticket.get(value, []))
+            return list(self.messages.values())
+        if table == 'voice_transcriptions':
+            return list(self.voice_transcriptions.values())
+        if table == 'ticket_summaries':
+            return [self.summarize_ticket(ticket_row) for ticket_row in self.tickets.values()]
+        raise Exception(f'relation "{table}" does not exist')
+
+    def summarize_ticket(self, ticket_row):
+        messages = self.messages_by_ticket.get(ticket_row['id'], [])
+        last = max(messages, key=lambda row: (row.get('timestamp') or '', row['id'])) if messages else {}
+        return dict(ticket_row,
+                    message_count=len(messages),
+                    has_voice=any(row.get('message_type') == 'audio' for row in messages),
+                    has_media=any(row.get('message_type') in ('image', 'video', 'document') for row in messages),
+                    last_message_author=last.get('author'),
+                    last_message_type=last.get('message_type'),
+                    last_message_text=last.get('text'),
+                    last_message_at=last.get('timestamp'))
+
+    def write_ticket(self, row, insert_only):
+        row = dict(row)
+        existing = self.tickets.get(row['id'])
+        if existing is not None and insert_only:
+            raise UniqueViolation('tickets_pkey')
+        merged = dict(existing or {'created_at': now_iso(), 'status': 'open'}, **row)
+        if merged.get('status') == 'open':
+            for other in self.tickets.values():
+                if other['id'] != merged['id'] and other['sender_id'] == merged['sender_id'] and other['status'] == 'open':
+                    raise UniqueViolation('idx_tickets_one_open_per_sender')
+        merged['updated_at'] = now_iso()
+        self.tickets[merged['id']] = merged
+        return dict(merged)
+
+    def write_message(self, row, on_conflict, ignore_duplicates):
+        row = dict(row)
+        existing = None
+        if on_conflict in self.message_ids_by_key and row.get(on_conflict) is not None:
+            existing_id = self.message_ids_by_key[on_conflict].get(row[on_conflict])
+            existing = self.messages.get(existing_id)
+        elif on_conflict == 'id' and row.get('id') is not None:
+            existing = self.messages.get(row['id'])
+        if existing is not None:
+            if ignore_duplicates:
+                return None
+            existing.update(row)
+            return dict(existing)
+        for column, message_ids in self.message_ids_by_key.items():
+            if row.get(column) is not None and row[column] in message_ids:
+                raise UniqueViolation(f'idx_messages_{column}')
+        row.setdefault('id', next(self.message_ids))
+        self.messages[row['id']] = row
+        self.messages_by_ticket.setdefault(row['ticket_id'], []).append(row)
+        for column, message_ids in self.message_ids_by_key.items():
+            if row.get(column) is not None:
+                message_ids[row[column]] = row['id']
+        if row['ticket_id'] in self.tickets:
+            self.tickets[row['ticket_id']]['updated_at'] = now_iso()  # Like the trigger
+        return dict(row)
+
+    def execute(self, query):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[f"{query.table}.{query.operation}"] += 1
+            if query.operation == 'select':
+                return self.select(query)
+            if query.operation in ('insert', 'upsert'):
+                return self.write(query)
+            if query.operation == 'update':
+                rows = self.filtered_rows(query)
+                for row in rows:
+                    row.update(query.payload)
+                return FakeResult([dict(row) for row in rows])
+            if query.operation == 'delete':
+                rows = self.filtered_rows(query)
+                self.delete(query.table, rows)
+                return FakeResult([dict(row) for row in rows])
+        raise Exception(f"Unsupported operation {query.operation}")
+
+    def filtered_rows(self, query):
+        rows = self.table_rows(query.table, query.filters)
+        for column, operator, value in query.filters:
+            rows = [row for row in rows if matches(column_value(row, column), operator, value)]
+        return rows
+
+    def select(self, query):
+        rows = self.filtered_rows(query)
+        total = len(rows)
+        for column, descending in reversed(query.ordering):
+            rows.sort(key=lambda row: sort_key(column_value(row, column)), reverse=descending)
+        rows = rows[query.offset:]
+        if query.row_limit is not None:
+            rows = rows[:query.row_limit]
+        if query.columns.strip() != '*':
+            columns = [column.strip() for column in query.columns.split(',')]
+            rows = [{column: row.get(column) for column in columns} for row in rows]
+        else:
+            rows = [dict(row) for row in rows]
+        return FakeResult(rows, count=total if query.count else None)
+
+    def write(self, query):
+        rows = query.payload if isinstance(query.payload, list) else [query.payload]
+        written = []
+        for row in rows:
+            if query.table == 'tickets':
+                written.append(self.write_ticket(row, insert_only=query.operation == 'insert'))
+            elif query.table == 'messages':
+                on_conflict = query.options.get('on_conflict', 'id') if query.operation == 'upsert' else None
+                result = self.write_message(row, on_conflict, query.options.get('ignore_duplicates', False))
+                if result is not None:
+                    written.append(result)
+            elif query.table == 'voice_transcriptions':
+                stored = self.voice_transcriptions.setdefault(row['message_id'], {})
+                stored.update(row)
+                written.append(dict(stored))
+            else:
+                raise Exception(f'relation "{query.table}" does not exist')
+        return FakeResult(written)
+
+    def delete(self, table, rows):
+        for row in rows:
+            if table == 'tickets':
+                self.tickets.pop(row['id'], None)
+            elif table == 'messages':
+                self.messages.pop(row['id'], None)
+                self.messages_by_ticket.get(row['ticket_id'], []).remove(row)
+
+    def rpc(self, function):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[f"rpc.{function}"] += 1
+            if function == 'next_ticket_number':
+                return FakeResult(next(self.ticket_numbers))
+        raise Exception(f"function {function} does not exist")
+
+def sort_key(value):
+    return (value is None, '' if value is None else value)  # NULLs last, like Postgres
+
+def matches(value, operator, expected):
+    if operator == 'eq':
+        return value == expected
+    if operator == 'neq':
+        return value != expected
+    if operator == 'in':
+        return value in expected
+    if value is None:
+        return False
+    if operator == 'gt':
+        return value > expected
+    if operator == 'gte':
+        return value >= expected
+    if operator == 'lt':
+        return value < expected
+    if operator == 'lte':
+        return value <= expected
+    raise Exception(f"Unsupported filter {operator}")
+
+class FakeQuery:
+    def __init__(self, database, table):
+        self.database = database
+        self.table = table
+        self.operation = None
+        self.columns = '*'
+        self.count = None
+        self.payload = None
+        self.options = {}
+        self.filters = []
+        self.ordering = []
+        self.offset = 0
+        self.row_limit = None
+
+    def select(self, columns='*', count=None):
+        self.operation, self.columns, self.count = 'select', columns, count
+        return self
+
+    def insert(self, payload, **options):
+        self.operation, self.payload, self.options = 'insert', payload, options
+        return self
+
+    def upsert(self, payload, **options):
+        self.operation, self.payload, self.options = 'upsert', payload, options
+        return self
+
+    def update(self, payload):
+        self.operation, self.payload = 'update', payload
+        return self
+
+    def delete(self):
+        self.operation = 'delete'
+        return self
+
+    def filter(self, column, operator, value):
+        self.filters.append((column, operator, value))
+        return self
+
+    def eq(self, column, value):
+        return self.filter(column, 'eq', value)
+
+    def neq(self, column, value):
+        return self.filter(column, 'neq', value)
+
+    def gt(self, column, value):
+        return self.filter(column, 'gt', value)
+
+    def gte(self, column, value):
+        return self.filter(column, 'gte', value)
+
+    def lt(self, column, value):
+        return self.filter(column, 'lt', value)
+
+    def lte(self, column, value):
+        return self.filter(column, 'lte', value)
+
+    def in_(self, column, values):
+        return self.filter(column, 'in', list(values))
+
+    def order(self, column, desc=False):
+        self.ordering.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def range(self, start, end):
+        self.offset, self.row_limit = start, end - start + 1
+        return self
+
+    def execute(self):
+        return self.database.execute(self)
+
+class FakeRpc:
+    def __init__(self, database, function):
+        self.database = database
+        self.function = function
+
+    def execute(self):
+        return self.database.rpc(self.function)
+
+class FakeClient:
+    def __init__(self, database):
+        self.database = database
+
+    def table(self, table):
+        return FakeQuery(self.database, table)
+
+    def rpc(self, function, params=None):
+        return FakeRpc(self.database, function)
+
+def make_supabase_module(database):
+    """A module to install as `supabase` before main.py is imported."""
+    module = types.ModuleType('supabase')
+    module.Client = FakeClient
+    module.create_client = lambda url, key: FakeClient(database)
+    return module
+
+# --- Green API ---
+# A requests transport adapter answering sendMessage, sendFileByUpload and other
+# Green API methods, and serving media download URLs, without any network I/O.
+# It is mounted on main.py's Green API and media sessions; in async mode it
+# answers through a FakeGreenApiSession in place of async_main.py's aiohttp session.
+MEDIA_HOST = 'media.bench.local'
+
+class FakeGreenApi(requests.adapters.BaseAdapter):
+    def __init__(self, latency=0.0, media_bytes=64 * 1024):
+        super().__init__()
+        self.latency = latency
+        self.media_content = b'\0' * media_bytes
+        self.message_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.calls = Counter()  # Green API method, or 'download' -> calls
+
+    def respond(self, url):
+        """Count a call and return the status, content and content type to answer it with."""
+        url = urlparse(url)
+        if url.hostname == MEDIA_HOST:
+            method, status, content, content_type = 'download', 200, self.media_content, 'application/octet-stream'
+        else:
+            # /waInstance<id>/<method>/<token>
+            parts = url.path.strip('/').split('/')
+            method = parts[1] if len(parts) >= 3 else 'unknown'
+            body = {'idMessage': f"BENCH{next(self.message_ids):08d}"}
+            if method == 'sendFileByUpload':
+                body['urlFile'] = f"https://{MEDIA_HOST}/uploads/{body['idMessage']}"
+            status, content, content_type = 200, json.dumps(body).encode('utf-8'), 'application/json'
+        with self.lock:
+            self.calls[method] += 1
+        return status, content, content_type
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        status, content, content_type = self.respond(request.url)
+        if self.latency:
+            time.sleep(self.latency)
+        response = requests.Response()
+        response.status_code = status
+        response.headers['Content-Type'] = content_type
+        response.headers['Content-Length'] = str(len(content))
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        response.reason = 'OK'
+        return response
+
+    def close(self):
+        pass
+
+    def install(self, *sessions):
+        for session in sessions:
+            session.mount('https://', self)
+            session.mount('http://', self)
+
+class FakeGreenApiSession:
+    """An aiohttp.ClientSession answering like a FakeGreenApi, for async_main.py.
+
+    Calls are counted by the FakeGreenApi; latency is slept on the event loop.
+    """
+
+    def __init__(self, green_api):
+        self.green_api = green_api
+
+    def post(self, url, **kwargs):
+        return FakeAsyncResponse(self.green_api, url)
+
+    def get(self, url, **kwargs):
+        return FakeAsyncResponse(self.green_api, url)
+
+    async def close(self):
+        pass
+
+class FakeAsyncResponse:
+    def __init__(self, green_api, url):
+        self.green_api = green_api
+        self.url = url
+        self.content = self  # For response.content.iter_chunked()
+
+    async def __aenter__(self):
+        self.status, self.body, content_type = self.green_api.respond(self.url)
+        self.headers = {'Content-Type': content_type, 'Content-Length': str(len(self.body))}
+        if self.green_api.latency:
+            await asyncio.sleep(self.green_api.latency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def text(self):
+        return self.body.decode('utf-8')
+
+    def raise_for_status(self):
+        pass
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self.body), size):
+            yield self.body[start:start + size]
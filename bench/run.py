@@ -0,0 +1,418 @@
+"""Benchmark the ticket system against local Supabase and Green API stand-ins.
+
+    python bench/run.py                   # Run all scenarios and compare with bench/baseline.json
+    python bench/run.py --save-baseline   # Record the results as the new baseline
+    python bench/run.py --scenario webhooks --requests 5000 --db-latency-ms 20
+    python bench/run.py --mode async --threads 200 --output async.json
+
+The app runs in this process, in a temporary working directory, with the
+`supabase` client and Green API replaced by the stand-ins in fakes.py. App
+settings are read from the environment as usual (e.g. WEBHOOK_WORKERS=0).
+In sync mode clients call the Flask app directly from `--threads` threads; in
+async mode (async_main.py) `--threads` client coroutines send real HTTP requests
+over loopback, so async numbers include the HTTP round trip.
+Exits with status 1 when a scenario regressed against the baseline.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fakes
+import workload
+
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+SCENARIOS = ('webhooks', 'dashboard', 'ticket', 'mixed')
+MODES = ('sync', 'async')
+IDLE_TIMEOUT = 300  # Seconds to wait for queued work after a scenario
+
+# Metrics compared with the baseline, and whether higher values are better
+COMPARED_METRICS = {
+    'throughput': True,
+    'processed_per_second': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'db_calls_per_request': False,
+    'http_calls_per_request': False,
+}
+# Tail latencies are shown next to the baseline but never count as regressions: with
+# clients and app sharing one interpreter they depend on how the threads happen to
+# line up for the GIL, and differ by an order of magnitude between identical runs
+INFORMATIONAL_METRICS = ('p95_ms', 'p99_ms')
+# Threads waiting for the GIL lose whole switch intervals; smaller latency changes are noise
+MIN_LATENCY_CHANGE_MS = sys.getswitchinterval() * 1000
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the ticket system with local service stand-ins.')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='Scenario to run; repeat for several (default: all)')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per scenario')
+    parser.add_argument('--mode', choices=MODES, default='sync',
+                        help='Serve with the Flask app (sync) or the asyncio server in async_main.py (async)')
+    parser.add_argument('--threads', type=int, default=4, help='Concurrent clients')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='Runs of the scenarios, each in a new process; the best of them is reported')
+    parser.add_argument('--db-latency-ms', type=float, default=5.0, help='Latency of each Supabase call')
+    parser.add_argument('--api-latency-ms', type=float, default=20.0, help='Latency of each Green API call and media download')
+    parser.add_argument('--new-senders', type=float, default=0.2, help='Share of webhooks from senders not seen before')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline results to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative change of a metric beyond which it counts as a regression')
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    parser.add_argument('--round-output', help=argparse.SUPPRESS)  # Run one round and write its results here
+    return parser.parse_args()
+
+def start_app(args):
+    """Import main.py, and async_main.py in async mode, wired to the stand-ins. Returns (main, database, green_api)."""
+    os.chdir(tempfile.mkdtemp(prefix='ticket-bench-'))  # app.log, journal, caches
+    os.environ.setdefault('GREEN_API_RATE_LIMIT', '0')  # Measure the app, not the rate limit
+    database = fakes.FakeDatabase(latency=args.db_latency_ms / 1000)
+    green_api = fakes.FakeGreenApi(latency=args.api_latency_ms / 1000)
+    sys.modules['supabase'] = fakes.make_supabase_module(database)
+    import main
+    green_api.install(main.green_api_session, main.media_session)
+    if args.mode == 'async':
+        import async_main
+        async_main.create_http_session = lambda: fakes.FakeGreenApiSession(green_api)
+    # Keep logging to app.log, but not to the terminal
+    for handler in list(main.logger.handlers):
+        if not isinstance(handler, main.logging.FileHandler):
+            main.logger.removeHandler(handler)
+    return main, database, green_api
+
+def wait_until_idle(main):
+    """Wait for queued webhooks, sends and downloads, then write everything buffered."""
+    deadline = time.monotonic() + IDLE_TIMEOUT
+    queues = lambda: list(main.webhook_queues) + [main.green_api_queue, main.media_download_queue]
+    async_main = sys.modules.get('async_main')
+    async_tasks = lambda: async_main is not None and (async_main.webhook_tasks or async_main.download_tasks)
+    while any(work_queue.unfinished_tasks for work_queue in queues()) or async_tasks():
+        if time.monotonic() > deadline:
+            raise RuntimeError('Queued work did not finish in time')
+        time.sleep(0.005)
+    main.flush_pending_writes()
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)]
+
+class Scenario:
+    """Runs a list of requests against the app from concurrent clients."""
+
+    def __init__(self, main, threads):
+        self.main = main
+        self.threads = threads
+        self.local = threading.local()
+
+    def perform(self, request_spec):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.main.app.test_client()
+        method, path, body = request_spec
+        started = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        return time.perf_counter() - started, response.status_code
+
+    def run(self, request_specs):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            outcomes = list(executor.map(self.perform, request_specs))
+        sent = time.perf_counter() - started
+        wait_until_idle(self.main)
+        return outcomes, sent, time.perf_counter() - started
+
+class AsyncServer:
+    """async_main.py's app on an event loop thread of its own, serving HTTP on a loopback port."""
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='bench-event-loop', daemon=True).start()
+        self.call(self.start())
+
+    async def start(self):
+        import aiohttp
+        import async_main
+        from aiohttp.test_utils import TestServer
+        self.server = TestServer(await async_main.create_app())
+        await self.server.start_server()
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.threads))
+
+    def call(self, coroutine):
+        """Run a coroutine on the server's loop and return its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        self.call(self.session.close())
+        self.call(self.server.close())
+
+class AsyncScenario:
+    """Runs a list of requests against the async server from concurrent client coroutines."""
+
+    def __init__(self, main, server):
+        self.main = main
+        self.server = server
+
+    async def perform(self, request_spec):
+        method, path, body = request_spec
+        started = time.perf_counter()
+        async with self.server.session.request(method, self.server.server.make_url(path), json=body) as response:
+            await response.read()
+        return time.perf_counter() - started, response.status
+
+    async def perform_all(self, request_specs):
+        outcomes = [None] * len(request_specs)
+        pending = enumerate(request_specs)
+        async def client():
+            for index, request_spec in pending:
+                outcomes[index] = await self.perform(request_spec)
+        await asyncio.gather(*(client() for _ in range(self.server.threads)))
+        return outcomes
+
+    def run(self, request_specs):
+        started = time.perf_counter()
+        outcomes = self.server.call(self.perform_all(request_specs))
+        sent = time.perf_counter() - started
+        wait_until_idle(self.main)
+        return outcomes, sent, time.perf_counter() - started
+
+def webhook_requests(generator, count):
+    return [('POST', '/webhook', webhook) for webhook in generator.webhooks(count)]
+
+def dashboard_requests(main, generator, count):
+    pages = max(len(main.tickets) // main.DASHBOARD_PER_PAGE, 1)
+    requests_ = []
+    for _ in range(count):
+        status = generator.random.choice(('', '', 'open', 'closed'))
+        page = min(int(generator.random.expovariate(0.5)) + 1, pages)  # Mostly the first pages
+        requests_.append(('GET', f"/dashboard?filter={status}&page={page}" if status else f"/dashboard?page={page}", None))
+    return requests_
+
+def ticket_requests(main, generator, count):
+    ticket_ids = sorted(main.tickets) or ['T1']
+    return [('GET', f"/ticket/{generator.random.choice(ticket_ids)}", None) for _ in range(count)]
+
+def build_requests(name, main, generator, count):
+    if name == 'webhooks':
+        return webhook_requests(generator, count)
+    if name == 'dashboard':
+        return dashboard_requests(main, generator, count)
+    if name == 'ticket':
+        return ticket_requests(main, generator, count)
+    # mixed: agents browsing while messages arrive
+    webhooks = webhook_requests(generator, count * 7 // 10)
+    pages = dashboard_requests(main, generator, count * 2 // 10)
+    details = ticket_requests(main, generator, count - len(webhooks) - len(pages))
+    mixed = webhooks + pages + details
+    generator.random.shuffle(mixed)
+    return mixed
+
+def measure(name, main, database, green_api, generator, args, server=None):
+    request_specs = build_requests(name, main, generator, args.requests)
+    db_calls, http_calls = Counter(database.calls), Counter(green_api.calls)
+    scenario = AsyncScenario(main, server) if server is not None else Scenario(main, args.threads)
+    outcomes, sent_seconds, total_seconds = scenario.run(request_specs)
+    db_calls, http_calls = database.calls - db_calls, green_api.calls - http_calls
+    latencies = sorted(latency * 1000 for latency, _ in outcomes)
+    statuses = Counter(status for _, status in outcomes)
+    count = len(outcomes)
+    return {
+        'requests': count,
+        'errors': sum(n for status, n in statuses.items() if status >= 400),
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+        'seconds': round(total_seconds, 3),
+        'throughput': round(count / sent_seconds, 1),
+        # Including the queued work the requests caused
+        'processed_per_second': round(count / total_seconds, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+        'db_calls': sum(db_calls.values()),
+        'db_calls_per_request': round(sum(db_calls.values()) / count, 3),
+        'db_calls_by_kind': dict(sorted(db_calls.items())),
+        'http_calls': sum(http_calls.values()),
+        'http_calls_per_request': round(sum(http_calls.values()) / count, 3),
+        'http_calls_by_kind': dict(sorted(http_calls.items())),
+    }
+
+def run_round(args, scenarios):
+    """Run the scenarios once in this process. Returns the report."""
+    app_module, database, green_api = start_app(args)
+    server = AsyncServer(args.threads) if args.mode == 'async' else None
+    generator = workload.WebhookWorkload(seed=args.seed, new_senders=args.new_senders)
+    results = {}
+    for name in scenarios:
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = measure(name, app_module, database, green_api, generator, args, server)
+    if server is not None:
+        server.close()
+    return {'config': describe_config(app_module, args, scenarios), 'scenarios': results}
+
+def run_round_process(args, scenarios):
+    """Run the scenarios once in a new process, so rounds do not share thread timing or state."""
+    fd, output = tempfile.mkstemp(prefix='ticket-bench-', suffix='.json')
+    os.close(fd)
+    command = [sys.executable, os.path.abspath(__file__), '--round-output', output, '--mode', args.mode, '--requests', str(args.requests),
+               '--threads', str(args.threads), '--db-latency-ms', str(args.db_latency_ms),
+               '--api-latency-ms', str(args.api_latency_ms), '--new-senders', str(args.new_senders),
+               '--seed', str(args.seed)]
+    for name in scenarios:
+        command += ['--scenario', name]
+    try:
+        subprocess.run(command, check=True)
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.remove(output)
+
+def combine_rounds(rounds):
+    """Best of the rounds of a scenario, like timeit: noise only ever makes a round slower.
+
+    Throughput is the highest and latencies the lowest of the rounds; other
+    metrics are medians and counts by kind are totals.
+    """
+    combined = {}
+    for key, value in rounds[0].items():
+        values = [result[key] for result in rounds]
+        if key in ('throughput', 'processed_per_second'):
+            combined[key] = max(values)
+        elif key.endswith('_ms'):
+            combined[key] = min(values)
+        elif isinstance(value, (int, float)):
+            combined[key] = statistics.median(values)
+    for key in ('statuses', 'db_calls_by_kind', 'http_calls_by_kind'):
+        totals = Counter()
+        for result in rounds:
+            totals.update(result[key])
+        combined[key] = dict(sorted(totals.items()))
+    combined['rounds'] = len(rounds)
+    return combined
+
+def describe_config(main, args, scenarios):
+    if args.mode == 'async':
+        green_api_concurrency = sys.modules['async_main'].ASYNC_GREEN_API_CONCURRENCY
+    else:
+        green_api_concurrency = main.GREEN_API_CONCURRENCY
+    return {
+        'scenarios': list(scenarios),
+        'mode': args.mode,
+        'requests': args.requests,
+        'threads': args.threads,
+        'rounds': args.rounds,
+        'db_latency_ms': args.db_latency_ms,
+        'api_latency_ms': args.api_latency_ms,
+        'new_senders': args.new_senders,
+        'seed': args.seed,
+        'webhook_workers': main.WEBHOOK_WORKERS,
+        'write_behind': main.WRITE_BEHIND_ENABLED,
+        'lazy_messages': main.LAZY_MESSAGES,
+        'green_api_concurrency': green_api_concurrency,
+        'python': platform.python_version(),
+        'machine': f"{platform.system()} {platform.machine()} ({os.cpu_count()} CPUs)",
+    }
+
+def print_results(results):
+    print(f"{'scenario':<10} {'requests':>8} {'errors':>6} {'req/s':>9} {'done/s':>9} {'p50 ms':>9} "
+          f"{'p95 ms':>9} {'p99 ms':>9} {'db/req':>7} {'http/req':>8}")
+    for name, result in results.items():
+        print(f"{name:<10} {result['requests']:>8} {result['errors']:>6} {result['throughput']:>9.1f} "
+              f"{result['processed_per_second']:>9.1f} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+              f"{result['p99_ms']:>9.2f} {result['db_calls_per_request']:>7.2f} {result['http_calls_per_request']:>8.2f}")
+    for name, result in results.items():
+        print(f"\n{name}: database calls over {result['rounds']} rounds {result['db_calls_by_kind']}")
+        print(f"{name}: Green API calls over {result['rounds']} rounds {result['http_calls_by_kind']}")
+
+def compare_with_baseline(results, config, baseline, tolerance):
+    """Print how the results differ from the baseline. Returns the regressions found.
+
+    Nothing counts as a regression when the benchmark settings differ from the baseline's.
+    """
+    baseline = dict(baseline, config=dict({'mode': 'sync'}, **baseline['config']))  # Recorded before --mode existed
+    differing = {key: (baseline['config'].get(key), value) for key, value in config.items()
+                 if key not in ('scenarios', 'python', 'machine') and baseline['config'].get(key) != value}
+    if differing:
+        print(f"\nNote: settings differ from the baseline, numbers are not comparable: {differing}")
+    if baseline['config'].get('machine') != config['machine']:
+        print(f"\nNote: baseline was recorded on {baseline['config'].get('machine')}")
+
+    regressions = []
+    print(f"\n{'scenario':<10} {'metric':<24} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, result in results.items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = base.get(metric), result[metric]
+            if old is None:
+                continue
+            change = (new - old) / old if old else (0.0 if new == old else math.inf)
+            worse = -change if higher_is_better else change
+            flag = ''
+            if metric.endswith('_ms') and abs(new - old) < MIN_LATENCY_CHANGE_MS:
+                worse = 0.0
+            if worse > tolerance and not differing and metric not in INFORMATIONAL_METRICS:
+                flag = '  REGRESSION'
+                regressions.append(f"{name} {metric}")
+            print(f"{name:<10} {metric:<24} {old:>10} {new:>10} {change:>+8.1%}{flag}")
+    return regressions
+
+def main():
+    args = parse_args()
+    scenarios = args.scenario or SCENARIOS
+    if args.round_output:
+        report = run_round(args, scenarios)
+        with open(args.round_output, 'w') as f:
+            json.dump(report, f)
+        shutil.rmtree(os.getcwd(), ignore_errors=True)  # The round's working directory
+        sys.stdout.flush()
+        os._exit(0)  # Skip the app's exit hooks; everything is already written
+
+    rounds = []
+    for round_number in range(max(args.rounds, 1)):
+        print(f"Round {round_number + 1} of {max(args.rounds, 1)}", file=sys.stderr)
+        rounds.append(run_round_process(args, scenarios))
+    results = {name: combine_rounds([report['scenarios'][name] for report in rounds]) for name in scenarios}
+    config = dict(rounds[0]['config'], rounds=len(rounds))
+
+    print()
+    print_results(results)
+    report = {'config': config, 'scenarios': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"\nBaseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, config, json.load(f), args.tolerance)
+        print(f"\n{len(regressions)} regressions" + (f": {', '.join(regressions)}" if regressions else ''))
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
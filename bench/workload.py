@@ -0,0 +1,77 @@
+"""Synthetic Green API webhooks for the benchmark."""
+import random
+import time
+
+from fakes import MEDIA_HOST
+
+# Share of each kind of incoming message; 'close' is a customer sending !close
+DEFAULT_MIX = {'text': 70, 'audio': 10, 'image': 10, 'document': 5, 'close': 5}
+
+MEDIA_TYPES = {
+    'audio': ('audioMessage', 'voice.ogg', 'audio/ogg'),
+    'image': ('imageMessage', 'photo.jpg', 'image/jpeg'),
+    'document': ('documentMessage', 'invoice.pdf', 'application/pdf'),
+}
+
+WORDS = ('hello', 'order', 'invoice', 'delivery', 'refund', 'payment', 'account', 'please', 'help',
+         'thanks', 'when', 'status', 'tracking', 'number', 'broken', 'missing', 'address', 'today')
+
+class WebhookWorkload:
+    """Generates incomingMessageReceived webhooks from new and returning senders.
+
+    A share `new_senders` of the messages comes from senders not seen before; the
+    others come from earlier senders, the more recent ones more often. The same
+    seed gives the same sequence of webhooks.
+    """
+
+    def __init__(self, seed=1, mix=None, new_senders=0.2, instance_id='1101000001'):
+        self.random = random.Random(seed)
+        self.mix = dict(mix or DEFAULT_MIX)
+        self.new_senders = new_senders
+        self.instance_id = instance_id
+        self.senders = []
+        self.sequence = 0
+
+    def pick_sender(self):
+        if not self.senders or self.random.random() < self.new_senders:
+            self.senders.append(f"7900{len(self.senders):07d}@c.us")
+            return self.senders[-1]
+        # Recent senders are more likely to write again
+        position = int(len(self.senders) * (1 - self.random.random() ** 2))
+        return self.senders[min(position, len(self.senders) - 1)]
+
+    def next_webhook(self):
+        self.sequence += 1
+        sender = self.pick_sender()
+        kind = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        if kind in ('text', 'close'):
+            text = '!close' if kind == 'close' else ' '.join(self.random.choices(WORDS, k=self.random.randint(3, 20)))
+            message_data = {'typeMessage': 'textMessage', 'textMessageData': {'textMessage': text}}
+        else:
+            type_message, file_name, mime_type = MEDIA_TYPES[kind]
+            message_data = {
+                'typeMessage': type_message,
+                'fileMessageData': {
+                    'downloadUrl': f"https://{MEDIA_HOST}/{self.instance_id}/{self.sequence:08d}/{file_name}",
+                    'caption': '' if kind == 'audio' else self.random.choice(WORDS),
+                    'fileName': file_name,
+                    'jpegThumbnail': '',
+                    'mimeType': mime_type,
+                    'fileSize': self.random.randint(10_000, 2_000_000),
+                }
+            }
+            if kind == 'audio':
+                message_data['fileMessageData']['seconds'] = self.random.randint(2, 120)
+        message_data['chatId'] = sender
+        name = f"Customer {sender[4:11]}"
+        return {
+            'typeWebhook': 'incomingMessageReceived',
+            'instanceData': {'idInstance': int(self.instance_id), 'wid': '79000000000@c.us', 'typeInstance': 'whatsapp'},
+            'timestamp': int(time.time()),
+            'idMessage': f"BENCHIN{self.sequence:010d}",
+            'senderData': {'chatId': sender, 'sender': sender, 'chatName': name, 'senderName': name},
+            'messageData': message_data
+        }
+
+    def webhooks(self, count):
+        return [self.next_webhook() for _ in range(count)]
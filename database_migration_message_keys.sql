@@ -0,0 +1,9 @@
+-- Idempotent message writes (required by the write-behind buffer)
+-- Run this SQL in your Supabase SQL Editor
+
+-- Key generated by the app for each message; a message written twice (a retried
+-- flush, or a journal replay after a crash) is stored once
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS message_key TEXT;
+
+-- Messages stored before this migration are NULL, which never conflicts
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_message_key ON messages(message_key);
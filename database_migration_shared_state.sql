@@ -0,0 +1,41 @@
+-- Shared state support for running several app workers (SHARED_STATE=true)
+-- Run this SQL in your Supabase SQL Editor (after database_migration_ticket_summaries.sql)
+
+-- Ticket numbers come from a sequence so workers never hand out the same ID
+CREATE SEQUENCE IF NOT EXISTS ticket_number_seq;
+
+SELECT setval(
+    'ticket_number_seq',
+    GREATEST((SELECT COALESCE(MAX(SUBSTRING(id FROM 2)::BIGINT), 0) FROM tickets WHERE id ~ '^T[0-9]+$'), 1),
+    EXISTS (SELECT 1 FROM tickets WHERE id ~ '^T[0-9]+$')
+);
+
+CREATE OR REPLACE FUNCTION next_ticket_number()
+RETURNS BIGINT AS $$
+    SELECT nextval('ticket_number_seq');
+$$ LANGUAGE sql;
+
+-- A sender can have at most one open ticket
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tickets_one_open_per_sender ON tickets(sender_id) WHERE status = 'open';
+
+-- New messages bump their ticket's updated_at so other workers notice them
+CREATE OR REPLACE FUNCTION touch_tickets_on_messages()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE tickets SET updated_at = NOW()
+    WHERE id IN (SELECT DISTINCT ticket_id FROM new_messages);
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+DROP TRIGGER IF EXISTS touch_tickets_on_messages ON messages;
+CREATE TRIGGER touch_tickets_on_messages
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_messages
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION touch_tickets_on_messages();
+
+CREATE INDEX IF NOT EXISTS idx_tickets_updated_at ON tickets(updated_at);
+
+-- Verify
+SELECT next_ticket_number();
@@ -0,0 +1,28 @@
+-- Add ticket_summaries view used when LAZY_MESSAGES is enabled
+-- Run this SQL in your Supabase SQL Editor
+
+-- One row per ticket with its message count, last message and media flags,
+-- so the dashboard can be served without loading every message
+CREATE OR REPLACE VIEW ticket_summaries AS
+SELECT 
+    t.*,
+    COUNT(m.id) AS message_count,
+    COALESCE(BOOL_OR(m.message_type = 'audio'), FALSE) AS has_voice,
+    COALESCE(BOOL_OR(m.message_type IN ('image', 'video', 'document')), FALSE) AS has_media,
+    lm.author AS last_message_author,
+    lm.message_type AS last_message_type,
+    lm.text AS last_message_text,
+    lm.timestamp AS last_message_at
+FROM tickets t
+LEFT JOIN messages m ON m.ticket_id = t.id
+LEFT JOIN LATERAL (
+    SELECT author, message_type, text, timestamp
+    FROM messages
+    WHERE ticket_id = t.id
+    ORDER BY timestamp DESC, id DESC
+    LIMIT 1
+) lm ON TRUE
+GROUP BY t.id, lm.author, lm.message_type, lm.text, lm.timestamp;
+
+-- Verify the view
+SELECT id, message_count, last_message_at FROM ticket_summaries LIMIT 5;
@@ -0,0 +1,7 @@
+-- Voice transcription pipeline support (TRANSCRIPTION_ENGINE)
+-- Run this SQL in your Supabase SQL Editor
+
+-- The transcription poller looks up voice messages still waiting for a transcription
+CREATE INDEX IF NOT EXISTS idx_messages_pending_transcription
+    ON messages(id)
+    WHERE message_type = 'audio' AND metadata->>'transcription_status' = 'pending';
@@ -0,0 +1,8 @@
+-- Webhook deduplication support (WEBHOOK_DEDUP_DATABASE=true)
+-- Run this SQL in your Supabase SQL Editor
+
+-- Green API ID of incoming messages; a redelivered webhook cannot store its message twice
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS id_message TEXT;
+
+-- Messages without an ID (agent and system messages) are NULL, which never conflicts
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_id_message ON messages(id_message);
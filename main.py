@@ -1,15 +1,39 @@
 import os
+import io
 import json
 import logging
 import threading
 import time
-from datetime import datetime
-from flask import Flask, request, jsonify, render_template, redirect, url_for
+import queue
+import zlib
+import hashlib
+import hmac
+import mimetypes
+import gzip
+import gc
+import pickle
+import atexit
+import sys
+import re
+import math
+import heapq
+import uuid
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+from itertools import count
+from datetime import datetime, timedelta
+from flask import Flask, request, jsonify, render_template, redirect, url_for, Response, stream_with_context
+from flask import send_file as send_file_response  # main.send_file is the upload route
+from markupsafe import Markup
 from werkzeug.utils import secure_filename
 import requests
 from supabase import create_client, Client
 import subprocess
 import tempfile
+import sqlite3
 
 # --- Logging Configuration ---
 # Create a custom logger independent of Flask's logger
@@ -36,6 +60,326 @@ if not logger.handlers:
 # Silence Werkzeug's default logger to prevent duplicate request logs
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
+# --- Metrics ---
+# Latency histograms of the webhook stages and of every Supabase query, Green API
+# request, media download and ffmpeg run, served with a few gauges at /metrics in
+# the Prometheus text format. Each thread observes into its own shard, so recording
+# takes no lock; a scrape adds the shards up. Shards of exited threads are folded
+# into one at scrape time.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # Seconds
+
+# Metric name -> (type, help), in exposition order
+METRIC_HELP = {
+    'ticket_system_webhook_stage_seconds': ('histogram', 'Time spent in each stage of handling an incoming webhook.'),
+    'ticket_system_webhook_processing_seconds': ('histogram', 'Time to process a queued webhook, by message type.'),
+    'ticket_system_supabase_request_seconds': ('histogram', 'Supabase query latency, by table and operation.'),
+    'ticket_system_supabase_errors_total': ('counter', 'Supabase queries that raised, by table and operation.'),
+    'ticket_system_green_api_request_seconds': ('histogram', 'Green API request latency, by method.'),
+    'ticket_system_green_api_errors_total': ('counter', 'Green API requests that failed, by method.'),
+    'ticket_system_media_download_seconds': ('histogram', 'Time to download a media file into the cache.'),
+    'ticket_system_transcode_seconds': ('histogram', 'ffmpeg run time, by output profile.'),
+    'ticket_system_tickets': ('gauge', 'Tickets in memory, by status.'),
+    'ticket_system_resident_messages': ('gauge', 'Messages held in memory.'),
+    'ticket_system_message_cache_bytes': ('gauge', 'Estimated size of the cached message lists.'),
+    'ticket_system_queue_depth': ('gauge', 'Items waiting in the background queues.'),
+}
+
+metrics_local = threading.local()
+metric_shards = []  # (thread, shard) of each thread that recorded a metric
+retired_metric_shard = {}  # Totals of threads that have exited
+metrics_lock = threading.Lock()
+
+def get_metric_shard():
+    """This thread's {(name, labels): values} dict, registered on first use."""
+    shard = getattr(metrics_local, 'shard', None)
+    if shard is None:
+        shard = metrics_local.shard = {}
+        with metrics_lock:
+            metric_shards.append((threading.current_thread(), shard))
+    return shard
+
+def observe(name, seconds, **labels):
+    """Record a duration in a histogram."""
+    if not METRICS_ENABLED:
+        return
+    shard = get_metric_shard()
+    key = (name, tuple(sorted(labels.items())))
+    values = shard.get(key)
+    if values is None:
+        # A count per bucket, one for +Inf, then the sum
+        values = shard[key] = [0] * (len(METRICS_BUCKETS) + 1) + [0.0]
+    values[bisect_left(METRICS_BUCKETS, seconds)] += 1
+    values[-1] += seconds
+
+def increment(name, amount=1, **labels):
+    """Add to a counter."""
+    if not METRICS_ENABLED:
+        return
+    shard = get_metric_shard()
+    key = (name, tuple(sorted(labels.items())))
+    values = shard.get(key)
+    if values is None:
+        values = shard[key] = [0]
+    values[0] += amount
+
+@contextmanager
+def timed(name, **labels):
+    """Observe the duration of a block, also when it raises."""
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started_at, **labels)
+
+def add_metric_values(totals, shard):
+    for key, values in shard.copy().items():  # The owning thread may add keys meanwhile
+        total = totals.get(key)
+        if total is None:
+            totals[key] = list(values)
+        else:
+            for index, value in enumerate(values):
+                total[index] += value
+
+def collect_metrics():
+    """Sum of all shards, {(name, labels): values}."""
+    totals = {}
+    with metrics_lock:
+        live_shards = []
+        for thread, shard in metric_shards:
+            if thread.is_alive():
+                live_shards.append((thread, shard))
+            else:
+                add_metric_values(retired_metric_shard, shard)
+        metric_shards[:] = live_shards
+        add_metric_values(totals, retired_metric_shard)
+        for _, shard in live_shards:
+            add_metric_values(totals, shard)
+    return totals
+
+def format_metric_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+def render_metrics(gauges):
+    """The recorded metrics plus `gauges` ({name: [(labels, value)]}) in the Prometheus text format."""
+    samples = {}
+    for (name, labels), values in collect_metrics().items():
+        samples.setdefault(name, []).append((labels, values))
+    for name, gauge_samples in gauges.items():
+        samples[name] = [(tuple(sorted(labels.items())), [value]) for labels, value in gauge_samples]
+
+    lines = []
+    for name, (metric_type, help_text) in METRIC_HELP.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, values in sorted(samples.get(name, [])):
+            if metric_type != 'histogram':
+                lines.append(f"{name}{format_metric_labels(labels)} {values[0]}")
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(METRICS_BUCKETS + ('+Inf',), values):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_metric_labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{format_metric_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+class InstrumentedSupabase:
+    """Wraps the Supabase client to time the execute() of every query by table and operation."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def table(self, table_name):
+        return InstrumentedQuery(self.client.table(table_name), table_name)
+
+    def rpc(self, function, *args, **kwargs):
+        return InstrumentedQuery(self.client.rpc(function, *args, **kwargs), function, 'rpc')
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class InstrumentedQuery:
+    """A query builder that remembers its table and operation across chained calls."""
+    OPERATIONS = ('select', 'insert', 'upsert', 'update', 'delete')
+
+    def __init__(self, query, table, operation='select'):
+        self.query = query
+        self.table = table
+        self.operation = operation
+
+    def __getattr__(self, name):
+        attribute = getattr(self.query, name)
+        if not callable(attribute):
+            return attribute
+        operation = name if name in self.OPERATIONS else self.operation
+        def call(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            return InstrumentedQuery(result, self.table, operation) if hasattr(result, 'execute') else result
+        return call
+
+    def execute(self):
+        started_at = time.monotonic()
+        try:
+            return self.query.execute()
+        except Exception:
+            increment('ticket_system_supabase_errors_total', table=self.table, operation=self.operation)
+            raise
+        finally:
+            elapsed = time.monotonic() - started_at
+            observe('ticket_system_supabase_request_seconds', elapsed, table=self.table, operation=self.operation)
+            add_trace_call(f"supabase {self.table}.{self.operation}", elapsed)
+
+# --- Profiling ---
+# GET /debug/profile samples the stacks of all threads for a few seconds and returns
+# them collapsed, one 'thread;frame;...;frame count' line per distinct stack, ready
+# for flamegraph.pl or speedscope. Requests (and webhooks processed by the workers)
+# are traced: the Supabase, Green API, media and ffmpeg calls they make are timed,
+# and once one runs past SLOW_REQUEST_THRESHOLD a watchdog samples its stack. Those
+# that end up slow are kept in a ring buffer shown at GET /debug/slow.
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))  # Seconds between samples
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '60'))
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SLOW_REQUEST_THRESHOLD', '1'))  # Seconds; 0 disables tracing
+SLOW_REQUEST_BUFFER = int(os.getenv('SLOW_REQUEST_BUFFER', '100'))  # Slow requests kept
+SLOW_REQUEST_SAMPLE_INTERVAL = float(os.getenv('SLOW_REQUEST_SAMPLE_INTERVAL', '0.05'))  # Seconds between samples
+SLOW_REQUEST_MAX_STACKS = 20  # Most frequent stacks kept per slow request
+SLOW_REQUEST_EXCLUDED_ENDPOINTS = ('events', 'poll_events', 'debug_profile')  # Slow by design
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN', '')  # /debug/* is disabled unless set
+APP_FILE = os.path.abspath(__file__)
+
+profile_lock = threading.Lock()  # One profile at a time
+trace_local = threading.local()
+active_traces = {}  # Thread ident -> trace of the request it is serving; changed without a lock
+slow_requests = deque(maxlen=max(SLOW_REQUEST_BUFFER, 1))
+slow_request_lock = threading.Lock()  # Guards the stacks of traces, slow_requests and slow_request_stats
+slow_request_stats = {'slow': 0, 'samples': 0}
+slow_request_watchdog = None
+
+def frame_stack(frame):
+    """The 'function (file:line)' entries of a frame's stack, outermost first."""
+    entries = []
+    while frame is not None:
+        code = frame.f_code
+        entries.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    entries.reverse()
+    return entries
+
+def in_app_code(frame):
+    while frame is not None:
+        if frame.f_code.co_filename == APP_FILE:
+            return True
+        frame = frame.f_back
+    return False
+
+def sample_stacks(seconds, interval, include_idle=False):
+    """Collapsed stacks of the other threads -> samples. Without `include_idle`, threads
+    not running app code (e.g. server threads waiting for a connection) are left out."""
+    own_ident = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        # Numbered threads of one pool share a root frame
+        thread_names = {thread.ident: re.sub(r'\d+', 'N', thread.name) for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != own_ident and (include_idle or in_app_code(frame)):
+                stacks[';'.join([thread_names.get(ident, 'unknown')] + frame_stack(frame))] += 1
+        time.sleep(interval)
+    return stacks
+
+def start_trace(route):
+    """Start tracing the request or job this thread is about to run."""
+    if SLOW_REQUEST_THRESHOLD <= 0:
+        return
+    trace = {'route': route, 'status': None, 'started_at': time.monotonic(), 'calls': {}, 'stacks': None}
+    trace_local.trace = trace
+    active_traces[threading.get_ident()] = trace
+    if slow_request_watchdog is None:
+        start_slow_request_watchdog()
+
+def add_trace_call(kind, seconds):
+    """Count a call made by the traced request of this thread, if any."""
+    trace = getattr(trace_local, 'trace', None)
+    if trace is not None:
+        call = trace['calls'].get(kind)
+        if call is None:
+            call = trace['calls'][kind] = [0, 0.0]
+        call[0] += 1
+        call[1] += seconds
+
+def finish_trace():
+    """Stop tracing this thread's request and keep it if it was slow."""
+    trace = getattr(trace_local, 'trace', None)
+    if trace is None:
+        return
+    trace_local.trace = None
+    active_traces.pop(threading.get_ident(), None)
+    duration = time.monotonic() - trace['started_at']
+    if duration < SLOW_REQUEST_THRESHOLD:
+        return
+    with slow_request_lock:
+        slow_request_stats['slow'] += 1
+        slow_requests.append({
+            'route': trace['route'],
+            'status': trace['status'],
+            'started': (datetime.now() - timedelta(seconds=duration)).isoformat(),
+            'duration_ms': round(duration * 1000, 1),
+            'calls': {kind: {'calls': calls, 'ms': round(seconds * 1000, 1)}
+                      for kind, (calls, seconds) in sorted(trace['calls'].items(), key=lambda item: -item[1][1])},
+            'stacks': [f"{stack} {samples}" for stack, samples in (trace['stacks'] or Counter()).most_common(SLOW_REQUEST_MAX_STACKS)]
+        })
+    logger.warning(f"Slow request {trace['route']} took {duration:.2f}s")
+
+@contextmanager
+def traced(route):
+    start_trace(route)
+    try:
+        yield
+    finally:
+        finish_trace()
+
+def start_slow_request_watchdog():
+    """Start the thread sampling slow requests (once per process)."""
+    global slow_request_watchdog
+    if slow_request_watchdog is not None:
+        return
+    with slow_request_lock:
+        if slow_request_watchdog is None:
+            slow_request_watchdog = threading.Thread(target=slow_request_watchdog_loop, name="slow-request-watchdog")
+            slow_request_watchdog.daemon = True
+            slow_request_watchdog.start()
+
+def slow_request_watchdog_loop():
+    """Sample the stacks of traced requests while they run past the threshold."""
+    while True:
+        time.sleep(SLOW_REQUEST_SAMPLE_INTERVAL)
+        now = time.monotonic()
+        slow = [(ident, trace) for ident, trace in list(active_traces.items()) if now - trace['started_at'] >= SLOW_REQUEST_THRESHOLD]
+        if not slow:
+            continue
+        frames = sys._current_frames()
+        with slow_request_lock:
+            for ident, trace in slow:
+                frame = frames.get(ident)
+                if frame is not None and active_traces.get(ident) is trace:  # Not finished before the sample
+                    if trace['stacks'] is None:
+                        trace['stacks'] = Counter()
+                    trace['stacks'][';'.join(frame_stack(frame))] += 1
+                    slow_request_stats['samples'] += 1
+        del frames  # Do not keep the sampled frames alive until the next sample
+
+def get_slow_request_stats():
+    with slow_request_lock:
+        stats = dict(slow_request_stats)
+        stats['buffered'] = len(slow_requests)
+    stats['in_flight'] = len(active_traces)
+    stats['threshold_seconds'] = SLOW_REQUEST_THRESHOLD
+    stats['profiling'] = profile_lock.locked()
+    return stats
+
 # --- App Initialization ---
 app = Flask(__name__)
 
@@ -49,209 +393,3292 @@ SUPABASE_KEY = os.getenv('SUPABASE_ANON_KEY', 'eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXV
 
 # Initialize Supabase client
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# File path for ticket persistence (keeping as backup)
-TICKETS_FILE = 'tickets_data.json'
+if METRICS_ENABLED or SLOW_REQUEST_THRESHOLD > 0:
+    supabase = InstrumentedSupabase(supabase)
 
 # In-memory storage for tickets (now synced with database)
 tickets = {}
 open_tickets_by_sender = {}
 next_ticket_id = 1
+ticket_id_lock = threading.Lock()  # Webhook workers create tickets concurrently
+
+# Each ticket has a 'version' taken from this counter, renewed whenever the ticket
+# changes. Versions are never reused, not even across reloads of the tickets, so
+# they double as the change sequence of the JSON API.
+ticket_versions = count(1)
+ticket_changes = OrderedDict()  # Ticket ID -> version, in version order
+ticket_changes_lock = threading.Lock()
+
+# Last state handed off to Supabase, per ticket:
+# {'record': <ticket row as last upserted>, 'message_count': <messages already inserted>}.
+# Messages are append-only, so everything past 'message_count' is new since the last save.
+persisted_ticket_state = {}
+persist_lock = threading.Lock()
+
+# --- Write-Behind Buffer ---
+# Saves are buffered and written by a background flusher as bulk upserts/inserts
+# covering all tickets, once WRITE_BEHIND_BATCH_ROWS rows are pending or
+# WRITE_BEHIND_MAX_DELAY seconds have passed. Buffered rows are also appended to
+# the journal (see below) so they survive a restart. The in-memory tickets are
+# updated before a save, so reads always see buffered writes.
+# A flush moves the buffered rows to an in-flight batch, writes them without
+# holding flush_lock, and then drops them from the batch (or, if they could not
+# be written, puts them back in the buffer). Readers holding flush_lock therefore
+# find every row in the buffer, in flight or in the database; rows in flight may
+# be in the database already, so readers skip those by message_key.
+# Rows are written chunk by chunk and a failed flush retries only the chunks not
+# yet written. Message rows carry a client-generated message_key and are upserted
+# on it, so a chunk written twice (a retry, or a journal replay after a crash
+# mid-flush) is stored once. A chunk that still fails after
+# WRITE_BEHIND_MAX_ATTEMPTS flushes is written row by row, and the rows the
+# database rejects are moved to the dead letters instead of blocking the buffer.
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'true').lower() == 'true'
+WRITE_BEHIND_BATCH_ROWS = int(os.getenv('WRITE_BEHIND_BATCH_ROWS', '200'))
+WRITE_BEHIND_MAX_DELAY = float(os.getenv('WRITE_BEHIND_MAX_DELAY', '0.25'))  # Seconds
+WRITE_BEHIND_RETRY_DELAY = float(os.getenv('WRITE_BEHIND_RETRY_DELAY', '5'))  # Seconds after a failed flush
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv('WRITE_BEHIND_MAX_ATTEMPTS', '5'))  # Failed flushes before a chunk is written row by row
+WRITE_BEHIND_DEAD_LETTER_NAME = 'dead_letter.jsonl'  # In JOURNAL_DIR
+PENDING_WRITES_FILE = os.getenv('PENDING_WRITES_FILE', 'pending_writes.jsonl')  # Spool of older versions, replayed once
+
+pending_ticket_rows = {}  # Ticket ID -> latest ticket row, coalesced
+pending_message_rows = []
+in_flight_ticket_rows = {}  # Ticket ID -> ticket row being written by a flush
+in_flight_message_rows = []
+pending_writes_condition = threading.Condition()  # Guards the buffer and the in-flight batch
+flush_lock = threading.RLock()  # Held to move rows into and out of the in-flight batch
+flush_writer_lock = threading.RLock()  # Held by a flush throughout, so one runs at a time; taken before flush_lock
+write_behind_thread = None
+write_behind_thread_lock = threading.Lock()
+write_behind_stats = {
+    'flushes': 0,
+    'failed_flushes': 0,
+    'consecutive_failures': 0,
+    'tickets_written': 0,
+    'messages_written': 0,
+    'dead_letter_rows': 0,
+    'last_flush_seconds': 0.0
+}
+# Rows the database kept rejecting, as {'table', 'row', 'error', 'at'}; also
+# appended to WRITE_BEHIND_DEAD_LETTER_NAME so they can be fixed and replayed by hand
+dead_letter_rows = []
+
+# --- Journal ---
+# Every save is appended to a local write-ahead journal before it reaches
+# Supabase: one compact JSON line with the ticket and message rows, and a
+# {'flushed': <seq>} marker once all records up to <seq> are in the database.
+# Saves wait until their record is fsynced; saves arriving during an fsync share
+# the next one. The journal is split into segments in JOURNAL_DIR, and a
+# background compaction folds segments the database already has into a gzipped
+# snapshot. As that rewrites the whole snapshot, it runs every
+# JOURNAL_COMPACT_INTERVAL seconds only once the segments have grown to
+# JOURNAL_COMPACT_MIN_RATIO times the snapshot's size. At startup the records after
+# the last marker are replayed into the database; if Supabase is unreachable
+# the tickets are rebuilt from the snapshot plus the journal tail.
+JOURNAL_DIR = os.getenv('JOURNAL_DIR', 'journal')
+JOURNAL_SEGMENT_BYTES = int(os.getenv('JOURNAL_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+JOURNAL_COMPACT_INTERVAL = float(os.getenv('JOURNAL_COMPACT_INTERVAL', '300'))  # Seconds; 0 disables compaction
+JOURNAL_COMPACT_MIN_RATIO = float(os.getenv('JOURNAL_COMPACT_MIN_RATIO', '1'))  # Segment bytes per snapshot byte before compacting
+JOURNAL_SNAPSHOT_NAME = 'snapshot.jsonl.gz'
+
+journal_state = {
+    'seq': 0,  # Last record appended
+    'synced_seq': 0,  # Last record on disk
+    'flushed_seq': 0,  # Every record up to here is in the database
+    'snapshot_seq': 0,  # Every record up to here is folded into the snapshot
+    'segment_start': 1,  # First record of the open segment
+    'segment_bytes': 0,
+    'syncing': False
+}
+journal_file = None  # Open segment; appends hold pending_writes_condition
+journal_file_lock = threading.Lock()  # Keeps rotation from closing the segment under an fsync; after pending_writes_condition
+journal_sync_condition = threading.Condition()
+journal_compact_lock = threading.Lock()
+journal_compact_event = threading.Event()
+journal_stats = {
+    'appends': 0,
+    'syncs': 0,
+    'compactions': 0,
+    'last_compaction_seconds': 0.0,
+    'replayed_records': 0
+}
+
+# --- Webhook Deduplication ---
+# Green API redelivers a webhook when it does not get a timely answer. The
+# idMessage of every incoming message is checked before the webhook is queued,
+# so a redelivery is acknowledged without downloading, replying or writing
+# anything. Recent IDs are kept in an LRU of WEBHOOK_DEDUP_SIZE entries. With
+# WEBHOOK_DEDUP_DATABASE the ID is stored on the message row under a unique index
+# (database_migration_webhook_dedup.sql), so a redelivery that gets past the LRU
+# (to another worker) is not stored twice, and the LRU is filled from the most
+# recently stored IDs at startup, so a redelivery after a restart is caught too.
+# With it, an optional Bloom filter (WEBHOOK_DEDUP_BLOOM_BITS) remembers many more
+# IDs in little memory; an ID missing from the LRU that it claims to know is
+# confirmed against the database, as it can be wrong. Other IDs are never looked
+# up, so webhooks do not wait on the database.
+WEBHOOK_DEDUP_SIZE = int(os.getenv('WEBHOOK_DEDUP_SIZE', '10000'))  # 0 disables deduplication
+WEBHOOK_DEDUP_BLOOM_BITS = int(os.getenv('WEBHOOK_DEDUP_BLOOM_BITS', '0'))  # Per generation; 0 = no Bloom filter
+WEBHOOK_DEDUP_BLOOM_HASHES = 7
+WEBHOOK_DEDUP_DATABASE = os.getenv('WEBHOOK_DEDUP_DATABASE', 'false').lower() == 'true'
+
+webhook_dedup_ids = OrderedDict()  # idMessage -> None, least recently seen first
+# Two generations, newest first: when the newer one holds its capacity
+# (about one ID per 10 bits for a ~1% false positive rate) the older one is dropped
+webhook_dedup_bloom = [bytearray((WEBHOOK_DEDUP_BLOOM_BITS + 7) // 8) for _ in range(2)] if WEBHOOK_DEDUP_BLOOM_BITS else []
+webhook_dedup_lock = threading.Lock()
+webhook_dedup_stats = {
+    'checked': 0,
+    'duplicates': 0,  # Found in the LRU
+    'bloom_lookups': 0,  # Bloom filter hits, checked against the database with WEBHOOK_DEDUP_DATABASE
+    'database_duplicates': 0,  # Confirmed by the database
+    'skipped_on_insert': 0,  # Rejected by the unique index when written
+    'bloom_ids': 0  # In the newer Bloom generation
+}
+
+def bloom_positions(id_message):
+    """Bit positions of an ID in the Bloom filter (double hashing over one digest)."""
+    digest = hashlib.blake2b(id_message.encode('utf-8'), digest_size=16).digest()
+    first = int.from_bytes(digest[:8], 'little')
+    step = int.from_bytes(digest[8:], 'little') | 1
+    return [(first + i * step) % WEBHOOK_DEDUP_BLOOM_BITS for i in range(WEBHOOK_DEDUP_BLOOM_HASHES)]
+
+def is_message_stored(id_message):
+    """Whether the database has a message with this idMessage; False if unsure."""
+    try:
+        result = supabase.table('messages').select('id').eq('id_message', id_message).limit(1).execute()
+        return bool(result.data)
+    except Exception as e:
+        logger.error(f"Failed to look up message {id_message}: {e}")
+        return False
+
+def remember_webhook_id(id_message, positions):
+    """Add an ID to the LRU and the Bloom filter. Requires webhook_dedup_lock."""
+    webhook_dedup_ids[id_message] = None
+    if len(webhook_dedup_ids) > WEBHOOK_DEDUP_SIZE:
+        webhook_dedup_ids.popitem(last=False)
+    if webhook_dedup_bloom:
+        if webhook_dedup_stats['bloom_ids'] >= WEBHOOK_DEDUP_BLOOM_BITS // 10:
+            webhook_dedup_bloom.insert(0, bytearray(len(webhook_dedup_bloom.pop())))
+            webhook_dedup_stats['bloom_ids'] = 0
+        bits = webhook_dedup_bloom[0]
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+        webhook_dedup_stats['bloom_ids'] += 1
+
+def claim_webhook(id_message):
+    """Record the idMessage of a webhook. Returns False if it was seen before."""
+    if not id_message or WEBHOOK_DEDUP_SIZE <= 0:
+        return True
+    positions = bloom_positions(id_message) if webhook_dedup_bloom else []
+    with webhook_dedup_lock:
+        webhook_dedup_stats['checked'] += 1
+        if id_message in webhook_dedup_ids:
+            webhook_dedup_ids.move_to_end(id_message)
+            webhook_dedup_stats['duplicates'] += 1
+            return False
+        maybe_seen = WEBHOOK_DEDUP_DATABASE and any(all(bits[position >> 3] & (1 << (position & 7)) for position in positions)
+                                                    for bits in webhook_dedup_bloom)
+        if not maybe_seen:
+            remember_webhook_id(id_message, positions)
+            return True
+        webhook_dedup_stats['bloom_lookups'] += 1
+    
+    stored = is_message_stored(id_message)
+    with webhook_dedup_lock:
+        if stored or id_message in webhook_dedup_ids:
+            webhook_dedup_stats['database_duplicates' if stored else 'duplicates'] += 1
+            return False
+        remember_webhook_id(id_message, positions)
+    return True
+
+def seed_webhook_dedup():
+    """Fill the LRU with the most recently stored idMessages, so redeliveries after a restart are caught."""
+    if not WEBHOOK_DEDUP_DATABASE or WEBHOOK_DEDUP_SIZE <= 0:
+        return
+    try:
+        result = supabase.table('messages').select('id_message').gt('id_message', '').order('id', desc=True).limit(WEBHOOK_DEDUP_SIZE).execute()
+    except Exception as e:
+        logger.error(f"Failed to load stored message IDs for deduplication: {e}")
+        return
+    with webhook_dedup_lock:
+        for row in reversed(result.data):  # Oldest first, so the newest are evicted last
+            if row['id_message'] not in webhook_dedup_ids:
+                remember_webhook_id(row['id_message'], bloom_positions(row['id_message']) if webhook_dedup_bloom else [])
+    logger.info(f"Loaded {len(result.data)} stored message IDs for webhook deduplication.")
+
+def release_webhook(id_message):
+    """Forget a claimed idMessage whose webhook was not processed, so a redelivery is."""
+    if id_message:
+        with webhook_dedup_lock:
+            webhook_dedup_ids.pop(id_message, None)
+
+def count_stored_duplicates(count):
+    with webhook_dedup_lock:
+        webhook_dedup_stats['skipped_on_insert'] += count
+    logger.info(f"Skipped {count} messages already stored under the same idMessage.")
+
+def get_webhook_dedup_stats():
+    with webhook_dedup_lock:
+        stats = dict(webhook_dedup_stats)
+        stats['size'] = len(webhook_dedup_ids)
+    stats['max_size'] = WEBHOOK_DEDUP_SIZE
+    stats['bloom_bits'] = WEBHOOK_DEDUP_BLOOM_BITS
+    stats['database'] = WEBHOOK_DEDUP_DATABASE
+    return stats
+
+# --- Message Records ---
+# Messages are held in memory as Message objects: slotted records with interned
+# authors and message types, instead of one dict per message. They read like the
+# dicts they replace (message['text'], message.get('file_url'), dict(message)),
+# listing only the fields that are set. The raw webhook payload of an incoming
+# media message ('original_message_data' in the metadata column) is kept only until
+# the message is handed to the database; load_original_message_data() reads it back
+# from there when needed.
+class MediaInfo:
+    __slots__ = ('file_url', 'file_name', 'file_size', 'duration', 'mime_type', 'metadata', 'raw_payload')
+    
+    def __init__(self, file_url=None, file_name=None, file_size=None, duration=None, mime_type=None,
+                 metadata=None, raw_payload=None):
+        self.file_url = file_url
+        self.file_name = file_name
+        self.file_size = file_size
+        self.duration = duration
+        self.mime_type = sys.intern(mime_type) if isinstance(mime_type, str) else mime_type
+        self.metadata = metadata
+        self.raw_payload = raw_payload
+
+class Message(Mapping):
+    """A message of a ticket; media fields live in a MediaInfo only media messages have.
+
+    id_message is the Green API ID of an incoming message, kept (like the raw
+    payload) only until the message is handed to the database.
+    """
+    __slots__ = ('author', 'message_type', 'text', 'timestamp', 'media', 'id_message')
+    FIELDS = ('author', 'message_type', 'text', 'file_url', 'file_name', 'file_size',
+              'duration', 'mime_type', 'metadata', 'timestamp')
+    MEDIA_FIELDS = MediaInfo.__slots__
+    
+    def __init__(self, author, timestamp, message_type='text', text=None, id_message=None, **media):
+        self.author = sys.intern(author) if isinstance(author, str) else author
+        self.message_type = sys.intern(message_type or 'text')
+        self.text = text
+        self.timestamp = timestamp
+        self.id_message = id_message
+        self.media = MediaInfo(**media) if any(value is not None for value in media.values()) else None
+    
+    def __getitem__(self, key):
+        if key in Message.MEDIA_FIELDS and key != 'raw_payload':
+            return getattr(self.media, key) if self.media is not None else None
+        if key not in Message.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __iter__(self):
+        return (field for field in Message.FIELDS if self[field] is not None)
+    
+    def __len__(self):
+        return sum(1 for _ in self)
+    
+    def __contains__(self, key):
+        return key in Message.FIELDS and self[key] is not None
+    
+    def get(self, key, default=None):
+        return self[key] if key in self else default  # Unset fields are missing, as in a dict
+    
+    def __repr__(self):
+        return f"Message({dict(self)!r})"
+    
+    @property
+    def raw_payload(self):
+        return self.media.raw_payload if self.media is not None else None
+    
+    @raw_payload.setter
+    def raw_payload(self, payload):
+        if self.media is not None:
+            self.media.raw_payload = payload
+        elif payload is not None:
+            self.media = MediaInfo(raw_payload=payload)
+    
+    def replace(self, **changes):
+        """A copy of the message with some fields changed."""
+        values = {field: self[field] for field in Message.FIELDS}
+        values['raw_payload'] = self.raw_payload
+        values['id_message'] = self.id_message
+        values.update(changes)
+        return Message(**values)
+
+def compact_message(message):
+    """The Message for a message dict built by a webhook handler."""
+    if isinstance(message, Message):
+        return message
+    metadata = message.get('metadata')
+    raw_payload = None
+    if metadata and 'original_message_data' in metadata:
+        metadata = dict(metadata)
+        raw_payload = metadata.pop('original_message_data')
+    values = {field: message.get(field) for field in Message.FIELDS}
+    values.update(metadata=metadata or None, raw_payload=raw_payload, id_message=message.get('id_message'))
+    return Message(**values)
+
+def load_original_message_data(ticket_id, start, messages):
+    """Raw webhook payloads of a ticket's messages, the first of which is at position start."""
+    payloads = [message.raw_payload for message in messages]
+    if any(payload is None and message.get('file_url') for payload, message in zip(payloads, messages)):
+        result = supabase.table('messages').select('metadata').eq('ticket_id', ticket_id) \
+            .order('timestamp').range(start, start + len(messages) - 1).execute()
+        for index, message_row in enumerate(result.data[:len(payloads)]):
+            if payloads[index] is None:
+                payloads[index] = (message_row.get('metadata') or {}).get('original_message_data')
+    return payloads
 
 # --- Database Functions ---
+def build_ticket_record(ticket_data):
+    """Build the `tickets` table row for a ticket."""
+    return {
+        'id': ticket_data['id'],
+        'sender_id': ticket_data['sender_id'],
+        'sender_name': ticket_data['sender_name'],
+        'status': ticket_data['status'],
+        'created_at': ticket_data['created_at'],
+        'admin_notes': ticket_data.get('admin_notes', '')
+    }
+
+def build_message_record(ticket_id, message):
+    """Build the `messages` table row for a message."""
+    metadata = message.get('metadata')
+    if message.raw_payload is not None:
+        metadata = dict(metadata or {}, original_message_data=message.raw_payload)
+    record = {
+        'ticket_id': ticket_id,
+        'author': message['author'],
+        'message_type': message.get('message_type', 'text'),
+        'text': message.get('text'),
+        'file_url': message.get('file_url'),
+        'file_name': message.get('file_name'),
+        'file_size': message.get('file_size'),
+        'duration': message.get('duration'),
+        'mime_type': message.get('mime_type'),
+        'metadata': metadata,
+        'timestamp': message['timestamp'],
+        'message_key': uuid.uuid4().hex
+    }
+    if WEBHOOK_DEDUP_DATABASE:
+        record['id_message'] = message.id_message
+        if message.id_message:
+            # A redelivered webhook gets the same key, so it is skipped like a retried row
+            record['message_key'] = message.id_message
+    return record
+
+def ticket_from_record(ticket_row):
+    """Build an in-memory ticket (without messages) from a `tickets` row."""
+    ticket_data = {
+        'id': ticket_row['id'],
+        'sender_id': ticket_row['sender_id'],
+        'sender_name': ticket_row['sender_name'],
+        'status': ticket_row['status'],
+        'created_at': ticket_row['created_at'],
+        'admin_notes': ticket_row.get('admin_notes', ''),
+        'messages': [],
+        'message_count': 0,
+        'last_message': None,
+        'has_voice': False,
+        'has_media': False
+    }
+    bump_ticket_version(ticket_data)
+    return ticket_data
+
+def message_from_record(message_row):
+    """Build an in-memory message from a `messages` row."""
+    if not message_row.get('file_url'):
+        return Message(message_row['author'], message_row['timestamp'],
+                       message_type=message_row.get('message_type', 'text'), text=message_row.get('text'))
+    
+    # The raw webhook payload stays in the database
+    metadata = message_row.get('metadata')
+    if metadata and 'original_message_data' in metadata:
+        metadata = {key: value for key, value in metadata.items() if key != 'original_message_data'} or None
+    return Message(
+        message_row['author'],
+        message_row['timestamp'],
+        message_type=message_row.get('message_type', 'text'),
+        text=message_row.get('text'),
+        file_url=message_row['file_url'],
+        file_name=message_row.get('file_name'),
+        file_size=message_row.get('file_size'),
+        duration=message_row.get('duration'),
+        mime_type=message_row.get('mime_type'),
+        metadata=metadata
+    )
+
+def mark_ticket_persisted(ticket_data, record=None, message_count=None):
+    """Record what of a ticket is already stored in the database."""
+    persisted_ticket_state[ticket_data['id']] = {
+        'record': build_ticket_record(ticket_data) if record is None else record,
+        'message_count': len(ticket_data['messages']) if message_count is None else message_count
+    }
+
+def get_persisted_state(ticket_data):
+    """Return the persisted state for a ticket, reconciling with the database if unknown.
+
+    Tickets created in this process are registered as new, and tickets loaded from
+    the database or the journal are registered as fully persisted. Anything else
+    costs one count query, relying on messages being inserted in order. The query
+    runs without persist_lock, so callers must not hold it.
+    """
+    ticket_id = ticket_data['id']
+    with persist_lock:
+        state = persisted_ticket_state.get(ticket_id)
+    if state is not None:
+        return state
+    result = supabase.table('messages').select('id', count='exact').eq('ticket_id', ticket_id).execute()
+    stored_count = result.count if result.count is not None else len(result.data)
+    with persist_lock:
+        state = persisted_ticket_state.get(ticket_id)
+        if state is None:  # Unless another save reconciled it meanwhile
+            state = {'record': None, 'message_count': min(stored_count, len(ticket_data.get('messages', [])))}
+            persisted_ticket_state[ticket_id] = state
+    return state
+
+def write_ticket_rows(rows):
+    supabase.table('tickets').upsert(rows).execute()
+
+def write_message_rows(rows):
+    """Write message rows, skipping those already stored under the same message_key."""
+    result = supabase.table('messages').upsert(rows, on_conflict='message_key', ignore_duplicates=True).execute()
+    if WEBHOOK_DEDUP_DATABASE and len(result.data) < len(rows):
+        count_stored_duplicates(len(rows) - len(result.data))
+
+def is_rejected_write(error):
+    """Whether the database answered with an error for the rows, rather than being unreachable."""
+    return bool(getattr(error, 'code', None)) or is_unique_violation(error)
+
+def write_rows_to_db(ticket_rows, message_rows, written, isolate_failures=False):
+    """Write ticket and message rows to Supabase in bulk, tickets first.
+
+    written counts the 'tickets' and 'messages' rows done so far and is advanced
+    as each chunk commits, so after an error only the rows past it are left.
+    With isolate_failures a chunk the database rejects is written row by row,
+    and the rows it still rejects are dead-lettered.
+    """
+    for table, rows, write_chunk in (('tickets', ticket_rows, write_ticket_rows), ('messages', message_rows, write_message_rows)):
+        while written[table] < len(rows):
+            chunk = rows[written[table]:written[table] + WRITE_BEHIND_BATCH_ROWS]
+            try:
+                write_chunk(chunk)
+            except Exception as e:
+                if not isolate_failures or not is_rejected_write(e):
+                    raise
+                for row in chunk:
+                    try:
+                        write_chunk([row])
+                    except Exception as row_error:
+                        if not is_rejected_write(row_error):
+                            raise
+                        dead_letter_row(table, row, row_error)
+                    written[table] += 1
+                continue
+            written[table] += len(chunk)
+
+def dead_letter_row(table, row, error):
+    """Set aside a row the database rejects, so the rows behind it can be written."""
+    record = {'table': table, 'row': row, 'error': str(error), 'at': datetime.now().isoformat()}
+    logger.error(f"Moving a {table} row the database keeps rejecting to the dead letters: {error}")
+    with pending_writes_condition:
+        dead_letter_rows.append(record)
+        write_behind_stats['dead_letter_rows'] += 1
+    try:
+        with open(journal_path(WRITE_BEHIND_DEAD_LETTER_NAME), 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception as e:
+        logger.error(f"Failed to write dead letter: {e}")
+
 def save_ticket_to_db(ticket_data):
-    """Save or update a ticket in Supabase database."""
-    try:
-        # Insert or update ticket
-        ticket_record = {
-            'id': ticket_data['id'],
-            'sender_id': ticket_data['sender_id'],
-            'sender_name': ticket_data['sender_name'],
-            'status': ticket_data['status'],
-            'created_at': ticket_data['created_at'],
-            'admin_notes': ticket_data.get('admin_notes', '')
+    """Save the unsaved changes of a ticket to Supabase.
+
+    Only the delta since the last save is sent: the ticket row when its fields
+    changed, and the messages appended since then. The delta is journaled and
+    buffered; with write-behind disabled the buffer is flushed right away.
+    """
+    try:
+        journal_seq = None
+        state = get_persisted_state(ticket_data)
+        with persist_lock:
+            state = persisted_ticket_state.setdefault(ticket_data['id'], state)  # Reinstalled if a reload cleared it
+            ticket_record = build_ticket_record(ticket_data)
+            if ticket_record == state['record']:
+                ticket_record = None
+            # Tickets whose messages are not resident (see LAZY_MESSAGES) have no unsaved messages
+            messages = ticket_data.get('messages', [])
+            message_count = len(messages) if 'messages' in ticket_data else state['message_count']
+            unsaved_messages = messages[state['message_count']:message_count]
+            message_records = [build_message_record(ticket_data['id'], message) for message in unsaved_messages]
+            if not ticket_record and not message_records:
+                return True
+            
+            ticket_rows = [ticket_record] if ticket_record else []
+            journal_seq = buffer_pending_writes(ticket_rows, message_records)
+            
+            if ticket_record:
+                state['record'] = ticket_record
+            state['message_count'] = message_count
+            for message in unsaved_messages:
+                message.raw_payload = None  # Now kept by the buffered row
+                message.id_message = None
+        
+        if journal_seq is not None:
+            wait_for_journal(journal_seq)
+        if not WRITE_BEHIND_ENABLED and not flush_pending_writes():
+            return False  # Journaled; the flusher retries
+        logger.info(f"Ticket {ticket_data['id']} saved to database successfully ({len(message_records)} new messages).")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to save ticket {ticket_data['id']} to database: {e}")
+        return False
+
+def get_pending_row_count():
+    return len(pending_ticket_rows) + len(pending_message_rows)
+
+def get_unflushed_row_count():
+    """Rows buffered or in flight. Caller holds pending_writes_condition."""
+    return get_pending_row_count() + len(in_flight_ticket_rows) + len(in_flight_message_rows)
+
+def get_buffered_message_rows(ticket_id):
+    """A ticket's message rows in flight, then those buffered. Caller holds pending_writes_condition."""
+    return [row for rows in (in_flight_message_rows, pending_message_rows) for row in rows if row['ticket_id'] == ticket_id]
+
+def buffer_pending_writes(ticket_rows, message_rows):
+    """Journal rows and add them to the write-behind buffer. Returns the journal record's seq."""
+    start_write_behind_flusher()
+    with pending_writes_condition:
+        journal_seq = append_journal_record({'tickets': ticket_rows, 'messages': message_rows})
+        was_empty = get_pending_row_count() == 0
+        add_pending_rows(ticket_rows, message_rows)
+        if was_empty or get_pending_row_count() >= WRITE_BEHIND_BATCH_ROWS:
+            pending_writes_condition.notify_all()
+    return journal_seq
+
+def add_pending_rows(ticket_rows, message_rows):
+    """Add rows to the buffer, coalescing ticket rows. Caller holds the condition."""
+    for row in ticket_rows:
+        pending_ticket_rows.pop(row['id'], None)
+        pending_ticket_rows[row['id']] = row
+    pending_message_rows.extend(message_rows)
+
+def flush_pending_writes():
+    """Write all buffered rows to Supabase. Returns False if rows are left pending.
+
+    flush_lock is only held to move the rows in flight and to merge the outcome
+    back, not while they are written.
+    """
+    with flush_writer_lock:
+        with flush_lock, pending_writes_condition:
+            ticket_rows = list(pending_ticket_rows.values())
+            message_rows = list(pending_message_rows)
+            pending_ticket_rows.clear()
+            pending_message_rows.clear()
+            in_flight_ticket_rows.update((row['id'], row) for row in ticket_rows)
+            in_flight_message_rows.extend(message_rows)
+            flushed_seq = journal_state['seq']  # Every journaled row is in this batch
+        if not ticket_rows and not message_rows:
+            return True
+        
+        started = time.monotonic()
+        written = {'tickets': 0, 'messages': 0}
+        isolate_failures = write_behind_stats['consecutive_failures'] >= WRITE_BEHIND_MAX_ATTEMPTS
+        try:
+            write_rows_to_db(ticket_rows, message_rows, written, isolate_failures)
+        except Exception as e:
+            ticket_rows = ticket_rows[written['tickets']:]
+            message_rows = message_rows[written['messages']:]
+            logger.error(f"Failed to flush {len(ticket_rows)} tickets and {len(message_rows)} messages to database: {e}")
+            with flush_lock, pending_writes_condition:
+                in_flight_ticket_rows.clear()
+                del in_flight_message_rows[:]
+                # Put the unwritten rows back in front of anything buffered meanwhile, keeping newer ticket rows
+                newer_ticket_rows = dict(pending_ticket_rows)
+                pending_ticket_rows.clear()
+                for row in ticket_rows:
+                    if row['id'] not in newer_ticket_rows:
+                        pending_ticket_rows[row['id']] = row
+                pending_ticket_rows.update(newer_ticket_rows)
+                pending_message_rows[:0] = message_rows
+                write_behind_stats['failed_flushes'] += 1
+                write_behind_stats['consecutive_failures'] += 1
+                write_behind_stats['tickets_written'] += written['tickets']
+                write_behind_stats['messages_written'] += written['messages']
+            return False
+        
+        with flush_lock, pending_writes_condition:
+            in_flight_ticket_rows.clear()
+            del in_flight_message_rows[:]
+            marker_seq = append_journal_record({'flushed': flushed_seq})
+            journal_state['flushed_seq'] = max(journal_state['flushed_seq'], flushed_seq)
+            write_behind_stats['flushes'] += 1
+            write_behind_stats['consecutive_failures'] = 0
+            write_behind_stats['tickets_written'] += len(ticket_rows)
+            write_behind_stats['messages_written'] += len(message_rows)
+            write_behind_stats['last_flush_seconds'] = time.monotonic() - started
+        if marker_seq is not None:
+            wait_for_journal(marker_seq)  # Not replaying these rows after a restart
+        logger.debug(f"Flushed {len(ticket_rows)} tickets and {len(message_rows)} messages to database.")
+        return True
+
+def write_behind_loop():
+    """Flush the buffer whenever it fills up or its oldest row reaches the maximum delay."""
+    while True:
+        with pending_writes_condition:
+            while get_pending_row_count() == 0:
+                pending_writes_condition.wait()
+            deadline = time.monotonic() + WRITE_BEHIND_MAX_DELAY
+            while get_pending_row_count() < WRITE_BEHIND_BATCH_ROWS:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                pending_writes_condition.wait(remaining)
+        if not flush_pending_writes():
+            time.sleep(WRITE_BEHIND_RETRY_DELAY)
+
+def start_write_behind_flusher():
+    """Start the background flusher thread (once per process)."""
+    global write_behind_thread
+    with write_behind_thread_lock:
+        if write_behind_thread is None:
+            write_behind_thread = threading.Thread(target=write_behind_loop, name="write-behind-flusher")
+            write_behind_thread.daemon = True
+            write_behind_thread.start()
+
+def apply_pending_writes():
+    """Overlay buffered rows onto freshly loaded tickets, so reads include writes not yet in the database.
+
+    Caller holds flush_writer_lock, or loaded the tickets from somewhere else than the database.
+    """
+    with pending_writes_condition:
+        ticket_rows = list(in_flight_ticket_rows.values()) + list(pending_ticket_rows.values())
+        message_rows = in_flight_message_rows + pending_message_rows
+    for ticket_row in ticket_rows:
+        ticket_data = tickets.get(ticket_row['id'])
+        if ticket_data is None:
+            ticket_data = tickets[ticket_row['id']] = ticket_from_record(ticket_row)
+            mark_ticket_persisted(ticket_data)
+        else:
+            ticket_data.update({key: value for key, value in ticket_row.items() if key != 'id'})
+        persisted_ticket_state[ticket_row['id']]['record'] = ticket_row
+    for message_row in message_rows:
+        ticket_data = tickets.get(message_row['ticket_id'])
+        if ticket_data is None:
+            continue
+        message_data = message_from_record(message_row)
+        if 'messages' in ticket_data:
+            ticket_data['messages'].append(message_data)
+        update_ticket_header(ticket_data, message_data)
+        persisted_ticket_state[ticket_data['id']]['message_count'] += 1
+
+def get_write_behind_stats():
+    with pending_writes_condition:
+        stats = dict(write_behind_stats)
+        stats['pending_tickets'] = len(pending_ticket_rows)
+        stats['pending_messages'] = len(pending_message_rows)
+        stats['in_flight_rows'] = len(in_flight_ticket_rows) + len(in_flight_message_rows)
+    stats['enabled'] = WRITE_BEHIND_ENABLED
+    return stats
+
+atexit.register(flush_pending_writes)
+
+def journal_path(name):
+    return os.path.join(JOURNAL_DIR, name)
+
+def list_journal_segments():
+    """Return (start seq, path) of the journal segments, oldest first."""
+    segments = []
+    for name in os.listdir(JOURNAL_DIR):
+        if name.endswith('.jsonl') and name[:-6].isdigit():
+            segments.append((int(name[:-6]), journal_path(name)))
+    return sorted(segments)
+
+def fsync_directory(path):
+    """Make renames and new files in a directory durable."""
+    directory_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+def append_journal_record(record):
+    """Append a record to the open segment and return its seq. Caller holds pending_writes_condition.
+
+    The record is handed to the OS but not yet fsynced; see wait_for_journal.
+    Returns None if the journal could not be opened at startup.
+    """
+    if journal_file is None:
+        return None
+    journal_seq = journal_state['seq'] + 1
+    line = json.dumps(dict(record, seq=journal_seq), separators=(',', ':')) + '\n'
+    journal_file.write(line)
+    journal_file.flush()
+    journal_state['seq'] = journal_seq
+    journal_state['segment_bytes'] += len(line)
+    journal_stats['appends'] += 1
+    if journal_state['segment_bytes'] >= JOURNAL_SEGMENT_BYTES:
+        rotate_journal_segment()
+        journal_compact_event.set()
+    return journal_seq
+
+def rotate_journal_segment():
+    """Close the open segment and start a new one. Caller holds pending_writes_condition."""
+    global journal_file
+    with journal_file_lock:
+        if journal_file is not None:
+            os.fsync(journal_file.fileno())
+            journal_file.close()
+        journal_state['segment_start'] = journal_state['seq'] + 1
+        journal_state['segment_bytes'] = 0
+        journal_file = open(journal_path(f"{journal_state['segment_start']:012d}.jsonl"), 'a')
+        if journal_file.tell():
+            journal_file.write('\n')  # Reopened after a crash; end a torn record
+    fsync_directory(JOURNAL_DIR)
+    with journal_sync_condition:
+        journal_state['synced_seq'] = max(journal_state['synced_seq'], journal_state['seq'])
+        journal_sync_condition.notify_all()
+
+def wait_for_journal(journal_seq):
+    """Wait until a journal record is on disk. Returns False if the fsync failed.
+
+    The first waiter fsyncs everything appended so far; waiters arriving meanwhile
+    are covered by that fsync or share the next one.
+    """
+    with journal_sync_condition:
+        while journal_state['synced_seq'] < journal_seq:
+            if not journal_state['syncing']:
+                journal_state['syncing'] = True
+                break
+            journal_sync_condition.wait()
+        else:
+            return True
+    synced_seq = journal_state['seq']  # Appends set the seq after writing the line
+    try:
+        with journal_file_lock:
+            os.fsync(journal_file.fileno())
+        return True
+    except Exception as e:
+        synced_seq = None
+        logger.error(f"Failed to sync journal: {e}")
+        return False
+    finally:
+        with journal_sync_condition:
+            journal_state['syncing'] = False
+            if synced_seq is not None:
+                journal_state['synced_seq'] = max(journal_state['synced_seq'], synced_seq)
+                journal_stats['syncs'] += 1
+            journal_sync_condition.notify_all()
+
+def read_journal_segment(path):
+    """Yield the records of a segment, skipping lines torn by a crash."""
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.error(f"Ignoring torn journal record in {path}.")
+
+def read_snapshot_seq():
+    """Return the seq the snapshot covers (0 without a snapshot)."""
+    if not os.path.exists(journal_path(JOURNAL_SNAPSHOT_NAME)):
+        return 0
+    with gzip.open(journal_path(JOURNAL_SNAPSHOT_NAME), 'rb') as f:
+        return json.loads(f.readline())['seq']
+
+def recover_journal():
+    """Open the journal and buffer the rows a previous process did not get into the database."""
+    try:
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        snapshot_seq = read_snapshot_seq()
+        last_seq = flushed_seq = snapshot_seq
+        unflushed = deque()
+        for segment_start, path in list_journal_segments():
+            for record in read_journal_segment(path):
+                last_seq = max(last_seq, record['seq'])
+                if 'flushed' in record:
+                    flushed_seq = max(flushed_seq, record['flushed'])
+                    while unflushed and unflushed[0]['seq'] <= flushed_seq:
+                        unflushed.popleft()
+                elif record['seq'] > flushed_seq:
+                    unflushed.append(record)
+        
+        with pending_writes_condition:
+            journal_state.update(seq=last_seq, synced_seq=last_seq, flushed_seq=flushed_seq, snapshot_seq=snapshot_seq)
+            for record in unflushed:
+                for row in record['messages']:
+                    row.setdefault('message_key', uuid.uuid4().hex)  # Journaled by older versions
+                add_pending_rows(record['tickets'], record['messages'])
+            journal_stats['replayed_records'] = len(unflushed)
+            rotate_journal_segment()
+        if unflushed:
+            start_write_behind_flusher()
+            logger.info(f"Restored {get_pending_row_count()} pending database writes from the journal.")
+        import_pending_writes_file()
+    except Exception as e:
+        logger.error(f"Failed to recover journal: {e}")
+
+def import_pending_writes_file():
+    """Move rows spooled to PENDING_WRITES_FILE by older versions into the journal."""
+    if not os.path.exists(PENDING_WRITES_FILE):
+        return
+    with open(PENDING_WRITES_FILE, 'r') as f:
+        batches = [json.loads(line) for line in f if line.strip()]
+    for batch in batches:
+        for row in batch['messages']:
+            row.setdefault('message_key', uuid.uuid4().hex)
+        wait_for_journal(buffer_pending_writes(batch['tickets'], batch['messages']))
+    os.remove(PENDING_WRITES_FILE)
+    logger.info(f"Moved {len(batches)} pending write batches from {PENDING_WRITES_FILE} into the journal.")
+
+def compact_journal():
+    """Fold the journal segments the database already has into the snapshot.
+
+    The snapshot is gzipped JSON lines: a {'seq': n} header, then {'message': row}
+    lines in insertion order and the latest {'ticket': row} per ticket. Message
+    lines of the previous snapshot are copied without being parsed. Skipped while
+    the segments are small next to the snapshot, so the cost of rewriting it stays
+    in proportion to the changes it folds in.
+    """
+    with journal_compact_lock:
+        snapshot_path = journal_path(JOURNAL_SNAPSHOT_NAME)
+        snapshot_bytes = os.path.getsize(snapshot_path) if os.path.exists(snapshot_path) else 0
+        segment_bytes = sum(os.path.getsize(path) for segment_start, path in list_journal_segments())
+        if segment_bytes < snapshot_bytes * JOURNAL_COMPACT_MIN_RATIO:
+            return
+        with flush_lock, pending_writes_condition:
+            flushed_seq = journal_state['flushed_seq']
+            if get_unflushed_row_count() == 0:
+                flushed_seq = journal_state['seq']  # Nothing buffered or in flight
+            if journal_state['segment_bytes'] and journal_state['segment_start'] <= flushed_seq:
+                rotate_journal_segment()
+            open_segment_start = journal_state['segment_start']
+        closed_segments = [segment for segment in list_journal_segments() if segment[0] < open_segment_start]
+        segments = []  # (path, last seq) of the oldest closed segments the database has
+        for index, (segment_start, path) in enumerate(closed_segments):
+            # A segment ends where the next one starts
+            segment_end = closed_segments[index + 1][0] - 1 if index + 1 < len(closed_segments) else open_segment_start - 1
+            if segment_end > flushed_seq:
+                break
+            segments.append((path, segment_end))
+        if not segments:
+            return
+        
+        started = time.monotonic()
+        snapshot_seq = max(journal_state['snapshot_seq'], segments[-1][1])
+        ticket_rows = {}
+        with open(f"{snapshot_path}.tmp", 'wb') as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode='wb', compresslevel=6) as out:
+                out.write(json.dumps({'seq': snapshot_seq}).encode() + b'\n')
+                if os.path.exists(snapshot_path):
+                    with gzip.open(snapshot_path, 'rb') as previous:
+                        previous.readline()
+                        for line in previous:
+                            if line.startswith(b'{"message"'):
+                                out.write(line)
+                            else:
+                                ticket_row = json.loads(line)['ticket']
+                                ticket_rows[ticket_row['id']] = ticket_row
+                for path, segment_end in segments:
+                    for record in read_journal_segment(path):
+                        if 'flushed' in record or record['seq'] <= journal_state['snapshot_seq']:
+                            continue
+                        for ticket_row in record['tickets']:
+                            ticket_rows[ticket_row['id']] = ticket_row
+                        for message_row in record['messages']:
+                            out.write(json.dumps({'message': message_row}, separators=(',', ':')).encode() + b'\n')
+                for ticket_row in ticket_rows.values():
+                    out.write(json.dumps({'ticket': ticket_row}, separators=(',', ':')).encode() + b'\n')
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        os.replace(f"{snapshot_path}.tmp", snapshot_path)
+        fsync_directory(JOURNAL_DIR)
+        journal_state['snapshot_seq'] = snapshot_seq
+        for path, segment_end in segments:
+            os.remove(path)
+        
+        journal_stats['compactions'] += 1
+        journal_stats['last_compaction_seconds'] = time.monotonic() - started
+        logger.info(f"Compacted {len(segments)} journal segments into the snapshot (up to record {snapshot_seq}).")
+
+def journal_compact_loop():
+    while True:
+        journal_compact_event.wait(JOURNAL_COMPACT_INTERVAL)
+        journal_compact_event.clear()
+        try:
+            compact_journal()
+        except Exception as e:
+            logger.error(f"Failed to compact journal: {e}")
+
+def start_journal_compactor():
+    if JOURNAL_COMPACT_INTERVAL <= 0 or journal_file is None:
+        return
+    compact_thread = threading.Thread(target=journal_compact_loop, name="journal-compactor")
+    compact_thread.daemon = True
+    compact_thread.start()
+
+def iter_journal_rows():
+    """Yield ('ticket' | 'message', row) for everything in the snapshot and the segments after it."""
+    snapshot_seq = 0
+    snapshot_path = journal_path(JOURNAL_SNAPSHOT_NAME)
+    if os.path.exists(snapshot_path):
+        with gzip.open(snapshot_path, 'rb') as f:
+            snapshot_seq = json.loads(f.readline())['seq']
+            for line in f:
+                record = json.loads(line)
+                if 'message' in record:
+                    yield 'message', record['message']
+                else:
+                    yield 'ticket', record['ticket']
+    for segment_start, path in list_journal_segments():
+        for record in read_journal_segment(path):
+            if 'flushed' in record or record['seq'] <= snapshot_seq:
+                continue
+            for ticket_row in record['tickets']:
+                yield 'ticket', ticket_row
+            for message_row in record['messages']:
+                yield 'message', message_row
+
+def get_journal_stats():
+    stats = dict(journal_stats)
+    stats.update((key, value) for key, value in journal_state.items() if key != 'syncing')
+    try:
+        segments = list_journal_segments()
+        stats['segments'] = len(segments)
+        stats['segment_bytes_total'] = sum(os.path.getsize(path) for segment_start, path in segments)
+        snapshot_path = journal_path(JOURNAL_SNAPSHOT_NAME)
+        stats['snapshot_bytes'] = os.path.getsize(snapshot_path) if os.path.exists(snapshot_path) else 0
+    except OSError:
+        pass
+    stats['records_per_sync'] = round(stats['appends'] / stats['syncs'], 2) if stats['syncs'] else None
+    stats['dir'] = JOURNAL_DIR
+    return stats
+
+def index_loaded_tickets():
+    """Rebuild everything derived from a freshly loaded `tickets`. Caller holds flush_lock."""
+    global open_tickets_by_sender, next_ticket_id
+    open_tickets_by_sender = {ticket_data['sender_id']: ticket_id for ticket_id, ticket_data in tickets.items()
+                              if ticket_data['status'] == 'open'}
+    rebuild_ticket_index()
+    rebuild_search_index()
+    reset_archive_tracking()
+    publish_event('tickets-reloaded')
+    ticket_numbers = [int(ticket_id[1:]) for ticket_id in tickets if ticket_id.startswith('T')]
+    with ticket_id_lock:
+        # Never hand out an ID again that a ticket being created right now got
+        next_ticket_id = max(next_ticket_id, max(ticket_numbers, default=0) + 1)
+
+def load_tickets_from_db():
+    """Load all tickets and messages from Supabase database."""
+    global tickets, open_tickets_by_sender, next_ticket_id
+    try:
+        with flush_writer_lock, flush_lock:
+            # Write buffered changes first so the reload includes them, and keep the
+            # flusher from moving rows into the database while we read it
+            flush_pending_writes()
+        
+            if LAZY_MESSAGES:
+                # Load ticket headers only; messages are loaded on first access
+                summaries_result = supabase.table('ticket_summaries').select('*').execute()
+            
+                tickets = {}
+                open_tickets_by_sender = {}
+                clear_message_cache()
+                persisted_ticket_state.clear()
+                archived_headers = get_archived_headers()
+                for summary_row in summaries_result.data:
+                    ticket_data = ticket_header_from_summary(summary_row)
+                    archived_header = archived_headers.get(ticket_data['id'])
+                    if archived_header and archived_header['message_count'] == ticket_data['message_count']:
+                        ticket_data['archived'] = True  # Rehydrate from the archive rather than the database
+                    tickets[ticket_data['id']] = ticket_data
+                    mark_ticket_persisted(ticket_data, message_count=ticket_data['message_count'])
+            else:
+                # Load tickets
+                tickets_result = supabase.table('tickets').select('*').execute()
+                
+                # Load messages, except those of closed tickets in the archive
+                ticket_statuses = {ticket_row['id']: ticket_row['status'] for ticket_row in tickets_result.data}
+                archived_headers = {ticket_id: header for ticket_id, header in get_archived_headers().items()
+                                    if ticket_statuses.get(ticket_id) == 'closed'}
+                if archived_headers:
+                    hot_ticket_ids = [ticket_id for ticket_id in ticket_statuses if ticket_id not in archived_headers]
+                    message_rows = []
+                    for start in range(0, len(hot_ticket_ids), ARCHIVE_LOAD_CHUNK):
+                        message_rows.extend(supabase.table('messages').select('*') \
+                            .in_('ticket_id', hot_ticket_ids[start:start + ARCHIVE_LOAD_CHUNK]) \
+                            .order('timestamp').execute().data)
+                else:
+                    message_rows = supabase.table('messages').select('*').order('timestamp').execute().data
+            
+                # Reset in-memory storage
+                tickets = {}
+                open_tickets_by_sender = {}
+            
+                # Process tickets
+                for ticket_row in tickets_result.data:
+                    tickets[ticket_row['id']] = ticket_from_record(ticket_row)
+            
+                # Process messages
+                for message_row in message_rows:
+                    ticket_id = message_row['ticket_id']
+                    if ticket_id in tickets:
+                        tickets[ticket_id]['messages'].append(message_from_record(message_row))
+            
+                # Everything just loaded is already stored in the database
+                persisted_ticket_state.clear()
+                for ticket_data in tickets.values():
+                    archived_header = archived_headers.get(ticket_data['id'])
+                    if archived_header:
+                        del ticket_data['messages']
+                        ticket_data.update(archived_header, archived=True)
+                        mark_ticket_persisted(ticket_data, message_count=ticket_data['message_count'])
+                    else:
+                        ticket_data.update(summarize_messages(ticket_data['messages']))
+                        mark_ticket_persisted(ticket_data)
+        
+            # Include writes that could not be flushed yet
+            apply_pending_writes()
+            index_loaded_tickets()
+            
+            # Changes made by other workers after this point are picked up by the shared state sync
+            loaded_rows = summaries_result.data if LAZY_MESSAGES else tickets_result.data
+            shared_state['watermark'] = max((row.get('updated_at') or '' for row in loaded_rows), default='') or None
+            
+            logger.info(f"Loaded {len(tickets)} tickets from database.")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to load tickets from database: {e}")
+        # Fall back to the local journal if the database is unreachable
+        return load_tickets_from_journal()
+
+def load_tickets_from_journal():
+    """Fallback: rebuild tickets from the journal snapshot and the segments after it.
+
+    Only covers what this process (or its slot) journaled; everything in it is
+    either in the database or pending, so tickets count as persisted.
+    """
+    global tickets
+    try:
+        with flush_lock:
+            loaded_tickets = {}
+            message_rows = []
+            for kind, row in iter_journal_rows():
+                if kind == 'ticket':
+                    ticket_data = loaded_tickets.get(row['id'])
+                    if ticket_data is None:
+                        loaded_tickets[row['id']] = ticket_from_record(row)
+                    else:
+                        ticket_data.update({key: value for key, value in row.items() if key != 'id'})
+                else:
+                    message_rows.append(row)
+            for message_row in message_rows:
+                ticket_data = loaded_tickets.get(message_row['ticket_id'])
+                if ticket_data is not None:
+                    ticket_data['messages'].append(message_from_record(message_row))
+            
+            tickets = loaded_tickets
+            clear_message_cache()
+            persisted_ticket_state.clear()
+            for ticket_data in tickets.values():
+                ticket_data.update(summarize_messages(ticket_data['messages']))
+                mark_ticket_persisted(ticket_data)
+            index_loaded_tickets()
+        logger.info(f"Loaded {len(tickets)} tickets from the journal (fallback).")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to load tickets from the journal: {e}")
+        return False
+
+# --- Lazy Message Loading ---
+# With LAZY_MESSAGES enabled only ticket headers are loaded at startup (from the
+# ticket_summaries view). A ticket's messages are loaded on first access and kept
+# in an LRU cache bounded by MESSAGE_CACHE_MAX_TICKETS and MESSAGE_CACHE_MAX_BYTES.
+# Evicted tickets drop their 'messages' list but keep a header with the message
+# count, last message and media flags for the dashboard. Pages showing a window
+# of a ticket that is not resident load just that window (see snapshot_ticket_window).
+LAZY_MESSAGES = os.getenv('LAZY_MESSAGES', 'false').lower() == 'true'
+MESSAGE_CACHE_MAX_TICKETS = int(os.getenv('MESSAGE_CACHE_MAX_TICKETS', '500'))
+MESSAGE_CACHE_MAX_BYTES = int(os.getenv('MESSAGE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+message_cache = OrderedDict()  # Ticket ID -> estimated size in bytes, least recently used first
+message_cache_lock = threading.RLock()
+message_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0, 'window_loads': 0}
+
+def estimate_message_size(message):
+    """Rough memory footprint of a message, in bytes; interned authors and types are not counted."""
+    return sys.getsizeof(message) + sum(sys.getsizeof(value) for key, value in message.items()
+                                        if key not in ('author', 'message_type', 'mime_type'))
+
+def ticket_header_from_summary(summary_row):
+    """Build a ticket without resident messages from a `ticket_summaries` row."""
+    ticket_data = ticket_from_record(summary_row)
+    del ticket_data['messages']
+    last_message = None
+    if summary_row.get('last_message_at'):
+        last_message = {
+            'author': summary_row.get('last_message_author'),
+            'message_type': summary_row.get('last_message_type') or 'text',
+            'text': summary_row.get('last_message_text'),
+            'timestamp': summary_row['last_message_at']
         }
+    ticket_data.update({
+        'message_count': summary_row.get('message_count') or 0,
+        'last_message': last_message,
+        'has_voice': bool(summary_row.get('has_voice')),
+        'has_media': bool(summary_row.get('has_media'))
+    })
+    return ticket_data
+
+def load_ticket_messages_from_db(ticket_id):
+    """Load one ticket's messages, including buffered ones not yet written."""
+    with flush_lock:
+        result = supabase.table('messages').select('*').eq('ticket_id', ticket_id).order('timestamp').order('id').execute()
+        with pending_writes_condition:
+            buffered_rows = get_buffered_message_rows(ticket_id)
+    messages = [message_from_record(message_row) for message_row in result.data]
+    # Rows in flight may have been written before the query
+    stored_keys = {message_row.get('message_key') for message_row in result.data} if buffered_rows else ()
+    messages.extend(message_from_record(message_row) for message_row in buffered_rows
+                    if message_row['message_key'] not in stored_keys)
+    return messages
+
+def load_message_window_from_db(ticket_id, start, end):
+    """Load the messages at positions start to end of a ticket, in the order load_ticket_messages_from_db gives them."""
+    if end <= start:
+        return []
+    with flush_lock:
+        with pending_writes_condition:
+            in_flight = any(row['ticket_id'] == ticket_id for row in in_flight_message_rows)
+            pending_rows = [row for row in pending_message_rows if row['ticket_id'] == ticket_id]
+        if in_flight:
+            # Which of its rows in flight are already counted cannot be told from a window
+            return load_ticket_messages_from_db(ticket_id)[start:end]
+        result = (supabase.table('messages').select('*', count='exact').eq('ticket_id', ticket_id)
+                  .order('timestamp').order('id').range(start, end - 1).execute())
+    stored_count = result.count if result.count is not None else start + len(result.data)
+    messages = [message_from_record(message_row) for message_row in result.data]
+    # Buffered messages follow the stored ones
+    if end > stored_count:
+        messages.extend(message_from_record(message_row)
+                        for message_row in pending_rows[max(start - stored_count, 0):end - stored_count])
+    return messages
+
+def get_ticket_messages(ticket_id):
+    """Return a ticket's message list, loading it into the cache if it is not resident."""
+    ticket_data = tickets[ticket_id]
+    if not LAZY_MESSAGES:
+        messages = ticket_data.get('messages')  # Read once; archiving may drop it at any time
+        if messages is not None:
+            return messages
+    
+    with message_cache_lock:
+        messages = ticket_data.get('messages')
+        if messages is not None:
+            message_cache_stats['hits'] += 1
+            if ticket_id in message_cache:
+                message_cache.move_to_end(ticket_id)
+            return messages
+        message_cache_stats['misses'] += 1
+    
+    loaded_messages = load_archived_messages(ticket_data) if ticket_data.get('archived') else None
+    if loaded_messages is None:
+        loaded_messages = load_ticket_messages_from_db(ticket_id)
+    with message_cache_lock:
+        if 'messages' not in ticket_data:
+            ticket_data['messages'] = loaded_messages
+            ticket_data.pop('archived', None)
+            ticket_data.update(summarize_messages(loaded_messages))
+            with persist_lock:
+                if ticket_id in persisted_ticket_state:
+                    persisted_ticket_state[ticket_id]['message_count'] = len(loaded_messages)
+            cache_ticket_messages(ticket_id)
+        return ticket_data['messages']
+
+def append_message(ticket_id, message):
+    """Append a message to a ticket's history."""
+    message = compact_message(message)
+    with ticket_lock(ticket_id):
+        while True:
+            get_ticket_messages(ticket_id)  # Load outside the cache lock if not resident
+            with message_cache_lock:
+                messages = tickets[ticket_id].get('messages')
+                if messages is None:
+                    continue  # Evicted again before we got the lock
+                messages.append(message)
+                update_ticket_header(tickets[ticket_id], message)
+                index_messages_for_search(ticket_id, len(messages) - 1, [message])
+                publish_event('message-appended', ticket_id, position=len(messages) - 1)
+                if ticket_id in message_cache:
+                    size = estimate_message_size(message)
+                    message_cache[ticket_id] += size
+                    message_cache_stats['bytes'] += size
+                    evict_ticket_messages()
+                return
+
+def cache_ticket_messages(ticket_id):
+    """Register a ticket's resident messages with the LRU cache."""
+    if not LAZY_MESSAGES:
+        return
+    with message_cache_lock:
+        size = sum(estimate_message_size(message) for message in tickets[ticket_id]['messages'])
+        message_cache_stats['bytes'] += size - message_cache.pop(ticket_id, 0)
+        message_cache[ticket_id] = size
+        evict_ticket_messages(keep=ticket_id)
+
+def evict_ticket_messages(keep=None):
+    """Drop least recently used message lists until the cache is within budget.
+
+    Tickets with messages not yet handed to the database stay resident.
+    """
+    with message_cache_lock:
+        for ticket_id in list(message_cache):
+            if len(message_cache) <= MESSAGE_CACHE_MAX_TICKETS and message_cache_stats['bytes'] <= MESSAGE_CACHE_MAX_BYTES:
+                break
+            ticket_data = tickets.get(ticket_id)
+            state = persisted_ticket_state.get(ticket_id)
+            if ticket_id == keep or ticket_data is None or state is None or state['message_count'] < len(ticket_data['messages']):
+                continue
+            del ticket_data['messages']  # The ticket header stays up to date without them
+            message_cache_stats['bytes'] -= message_cache.pop(ticket_id)
+            message_cache_stats['evictions'] += 1
+
+def clear_message_cache():
+    with message_cache_lock:
+        message_cache.clear()
+        message_cache_stats['bytes'] = 0
+
+def get_message_cache_stats():
+    with message_cache_lock:
+        stats = dict(message_cache_stats)
+        stats['resident_tickets'] = len(message_cache)
+    stats['enabled'] = LAZY_MESSAGES
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+# --- Ticket Archive ---
+# Closed tickets idle for ARCHIVE_AFTER_DAYS are moved to a local SQLite file: their
+# messages are stored zlib-compressed and dropped from memory, leaving the ticket
+# header (flagged 'archived') for listing and stats. Messages are rehydrated from the
+# archive on first access (get_ticket_messages), e.g. when the ticket is opened or
+# receives a message again. An archived copy is only used while its message count
+# matches the ticket header; otherwise the messages are loaded from the database.
+# With LAZY_MESSAGES only tickets whose messages are resident are archived.
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', '7'))  # 0 disables archiving
+ARCHIVE_FILE = os.getenv('ARCHIVE_FILE', 'ticket_archive.sqlite3')
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '300'))  # Seconds between archive runs
+ARCHIVE_LOAD_CHUNK = 200  # Ticket IDs per messages query when loading only unarchived tickets
+
+archive_db = None
+archive_lock = threading.Lock()
+archive_candidates = set()  # Closed tickets whose messages are resident
+archived_ticket_ids = set()  # Tickets whose messages are only in the archive
+archive_rehydrated_at = {}  # Ticket ID -> monotonic time of its last rehydration
+archive_stats = {'runs': 0, 'archived': 0, 'rehydrated': 0, 'stale': 0, 'rehydrate_seconds': 0.0, 'max_rehydrate_seconds': 0.0}
+
+def open_archive():
+    """Open (creating if needed) the archive database."""
+    global archive_db
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return
+    try:
+        archive_db = sqlite3.connect(ARCHIVE_FILE, timeout=30, check_same_thread=False)
+        archive_db.execute('PRAGMA journal_mode=WAL')
+        archive_db.execute('PRAGMA synchronous=NORMAL')
+        archive_db.execute("""CREATE TABLE IF NOT EXISTS archived_tickets (
+            id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL,
+            header TEXT NOT NULL,
+            messages BLOB NOT NULL,
+            archived_at TEXT NOT NULL
+        )""")
+        archive_db.commit()
+    except Exception as e:
+        logger.error(f"Failed to open ticket archive {ARCHIVE_FILE}; archiving is disabled: {e}")
+        archive_db = None
+
+def get_archived_headers():
+    """Ticket ID -> header fields of every archived ticket."""
+    if archive_db is None:
+        return {}
+    with archive_lock:
+        rows = archive_db.execute('SELECT id, message_count, header FROM archived_tickets').fetchall()
+    return {ticket_id: dict(json.loads(header), message_count=message_count) for ticket_id, message_count, header in rows}
+
+def archive_ticket(ticket_data, messages):
+    """Write a ticket's messages to the archive unless an identical copy is there."""
+    header = {
+        'last_message': dict(messages[-1]) if messages else None,
+        'has_voice': ticket_data['has_voice'],
+        'has_media': ticket_data['has_media']
+    }
+    with archive_lock:
+        row = archive_db.execute('SELECT message_count FROM archived_tickets WHERE id = ?', (ticket_data['id'],)).fetchone()
+    if row is not None and row[0] == len(messages):
+        return  # Archived before and rehydrated since
+    blob = zlib.compress(json.dumps([dict(message) for message in messages], separators=(',', ':')).encode('utf-8'))
+    with archive_lock:
+        archive_db.execute('INSERT OR REPLACE INTO archived_tickets VALUES (?, ?, ?, ?, ?)',
+                           (ticket_data['id'], len(messages), json.dumps(header), blob, datetime.now().isoformat()))
+        archive_db.commit()
+
+def read_archived_messages(ticket_data):
+    """A ticket's messages from the archive; None if they are not there or out of date."""
+    if archive_db is None:
+        return None
+    with archive_lock:
+        row = archive_db.execute('SELECT message_count, messages FROM archived_tickets WHERE id = ?',
+                                 (ticket_data['id'],)).fetchone()
+    if row is None or row[0] != ticket_data['message_count']:
+        return None
+    return [Message(**message) for message in json.loads(zlib.decompress(row[1]))]
+
+def load_archived_messages(ticket_data):
+    """Rehydrate a ticket's messages from the archive; None if they are not there or out of date."""
+    started_at = time.monotonic()
+    messages = read_archived_messages(ticket_data)
+    if messages is None:
+        with archive_lock:
+            archive_stats['stale'] += 1
+        return None
+    elapsed = time.monotonic() - started_at
+    with archive_lock:
+        archived_ticket_ids.discard(ticket_data['id'])
+        archive_rehydrated_at[ticket_data['id']] = time.monotonic()
+        if ticket_data['status'] == 'closed':
+            archive_candidates.add(ticket_data['id'])
+        archive_stats['rehydrated'] += 1
+        archive_stats['rehydrate_seconds'] += elapsed
+        archive_stats['max_rehydrate_seconds'] = max(archive_stats['max_rehydrate_seconds'], elapsed)
+    return messages
+
+def archive_idle_tickets():
+    """Archive closed tickets without activity for ARCHIVE_AFTER_DAYS."""
+    cutoff_day = (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime('%Y-%m-%d')
+    recently_rehydrated = time.monotonic() - ARCHIVE_INTERVAL
+    with archive_lock:
+        candidates = list(archive_candidates)
+    archived = 0
+    for ticket_id in candidates:
+        with message_cache_lock:
+            ticket_data = tickets.get(ticket_id)
+            messages = ticket_data.get('messages') if ticket_data else None
+            if messages is None or ticket_data['status'] != 'closed':
+                with archive_lock:
+                    archive_candidates.discard(ticket_id)
+                continue
+            last_activity = (ticket_data['last_message'] or {}).get('timestamp') or ticket_data['created_at']
+            if last_activity[:10] > cutoff_day or archive_rehydrated_at.get(ticket_id, 0) > recently_rehydrated:
+                continue
+            with persist_lock:
+                state = persisted_ticket_state.get(ticket_id)
+                if state is None or state['message_count'] != len(messages) or state['record'] != build_ticket_record(ticket_data):
+                    continue  # Not fully saved yet
+            message_count = len(messages)
         
-        # Upsert ticket (insert or update if exists)
-        result = supabase.table('tickets').upsert(ticket_record).execute()
-        
-        # Save messages
-        for message in ticket_data['messages']:
-            message_record = {
-                'ticket_id': ticket_data['id'],
-                'author': message['author'],
-                'message_type': message.get('message_type', 'text'),
-                'text': message.get('text'),
-                'file_url': message.get('file_url'),
-                'file_name': message.get('file_name'),
-                'file_size': message.get('file_size'),
-                'duration': message.get('duration'),
-                'mime_type': message.get('mime_type'),
-                'metadata': message.get('metadata'),
-                'timestamp': message['timestamp']
+        archive_ticket(ticket_data, messages[:message_count])
+        
+        with message_cache_lock:
+            # Skip if the ticket changed while it was written
+            if tickets.get(ticket_id) is not ticket_data or ticket_data.get('messages') is not messages \
+                    or len(messages) != message_count or ticket_data['status'] != 'closed':
+                continue
+            del ticket_data['messages']
+            ticket_data['archived'] = True
+            if ticket_id in message_cache:
+                message_cache_stats['bytes'] -= message_cache.pop(ticket_id)
+        with archive_lock:
+            archive_candidates.discard(ticket_id)
+            archived_ticket_ids.add(ticket_id)
+            archive_rehydrated_at.pop(ticket_id, None)
+        archived += 1
+    
+    with archive_lock:
+        archive_stats['runs'] += 1
+        archive_stats['archived'] += archived
+    if archived:
+        logger.info(f"Archived {archived} idle closed tickets.")
+
+def archive_loop():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL)
+        try:
+            archive_idle_tickets()
+        except Exception as e:
+            logger.error(f"Error archiving tickets: {e}", exc_info=True)
+
+def start_archiver():
+    if archive_db is None:
+        return
+    archiver_thread = threading.Thread(target=archive_loop, name='ticket-archiver')
+    archiver_thread.daemon = True
+    archiver_thread.start()
+
+def track_archive_candidate(ticket_data):
+    """Keep a ticket's archive eligibility in step with its status."""
+    if archive_db is None:
+        return
+    with archive_lock:
+        if ticket_data['status'] == 'closed' and not ticket_data.get('archived'):
+            archive_candidates.add(ticket_data['id'])
+        else:
+            archive_candidates.discard(ticket_data['id'])
+
+def reset_archive_tracking():
+    """Recompute archive candidates and archived tickets after tickets were reloaded."""
+    if archive_db is None:
+        return
+    with archive_lock:
+        archive_candidates.clear()
+        archived_ticket_ids.clear()
+        archive_rehydrated_at.clear()
+        for ticket_id, ticket_data in list(tickets.items()):
+            if ticket_data.get('archived'):
+                archived_ticket_ids.add(ticket_id)
+            elif ticket_data['status'] == 'closed':
+                archive_candidates.add(ticket_id)
+
+def get_archive_stats():
+    stats = {'enabled': archive_db is not None}
+    if archive_db is None:
+        return stats
+    with archive_lock:
+        stats.update(archive_stats)
+        stats['archived_tickets'] = len(archived_ticket_ids)
+        stats['candidates'] = len(archive_candidates)
+        stored_tickets, stored_bytes = archive_db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(messages)), 0) FROM archived_tickets').fetchone()
+    stats.update({'stored_tickets': stored_tickets, 'stored_bytes': stored_bytes})
+    stats['hot_tickets'] = len(message_cache) if LAZY_MESSAGES else len(tickets) - stats['archived_tickets']
+    stats['file_bytes'] = os.path.getsize(ARCHIVE_FILE) if os.path.exists(ARCHIVE_FILE) else 0
+    stats['avg_rehydrate_ms'] = stats['rehydrate_seconds'] * 1000 / stats['rehydrated'] if stats['rehydrated'] else 0.0
+    return stats
+
+open_archive()
+
+# --- Ticket Locks ---
+# Webhook workers, request threads and the terminal change tickets concurrently.
+# The changes to one sender's tickets are serialized by a lock picked by hashing the
+# sender, one of TICKET_LOCK_STRIPES: finding the sender's open ticket and appending
+# to it or opening a new one happens under it, and so does closing, so a sender never
+# gets two open tickets and no message is appended to a ticket while it is closed. A
+# ticket's lock is the lock of its sender. Senders sharing a stripe wait for each
+# other; contention per stripe is reported under `ticket_locks` in /stats.
+# A stripe is taken before flush_lock and all locks after it (flush_writer_lock is
+# never taken under it), and is only held while tickets change in memory: saving
+# and talking to Green API happen after releasing it.
+TICKET_LOCK_STRIPES = max(int(os.getenv('TICKET_LOCK_STRIPES', '64')), 1)
+
+ticket_lock_stripes = [threading.RLock() for _ in range(TICKET_LOCK_STRIPES)]
+# Acquisitions, contended acquisitions, seconds waited and longest wait per stripe,
+# each updated while holding its stripe
+ticket_lock_counters = [[0, 0, 0.0, 0.0] for _ in range(TICKET_LOCK_STRIPES)]
+
+@contextmanager
+def sender_lock(sender):
+    """Hold the lock serializing changes to a sender's tickets."""
+    stripe = zlib.crc32(str(sender).encode()) % TICKET_LOCK_STRIPES
+    lock = ticket_lock_stripes[stripe]
+    waited = None
+    if not lock.acquire(blocking=False):
+        started = time.perf_counter()
+        lock.acquire()
+        waited = time.perf_counter() - started
+    try:
+        counters = ticket_lock_counters[stripe]
+        counters[0] += 1
+        if waited is not None:
+            counters[1] += 1
+            counters[2] += waited
+            counters[3] = max(counters[3], waited)
+        yield
+    finally:
+        lock.release()
+
+def ticket_lock(ticket_id):
+    """Hold the lock of a ticket, which is the lock of its sender."""
+    ticket_data = tickets.get(ticket_id)
+    return sender_lock(ticket_data['sender_id'] if ticket_data is not None else ticket_id)
+
+def snapshot_ticket(ticket_id, with_messages=False):
+    """Copy of a ticket's header, and of its messages if asked, taken at one point in time.
+
+    Returns None if there is no such ticket.
+    """
+    with ticket_lock(ticket_id):
+        if not with_messages:
+            ticket_data = tickets.get(ticket_id)
+            if ticket_data is None:
+                return None
+            snapshot = dict(ticket_data)
+            snapshot.pop('messages', None)
+            return snapshot
+        while True:
+            if ticket_id in tickets:
+                get_ticket_messages(ticket_id)  # Load outside the cache lock if not resident
+            with message_cache_lock:
+                ticket_data = tickets.get(ticket_id)
+                if ticket_data is None:
+                    return None
+                if 'messages' not in ticket_data:
+                    continue  # Evicted again before we got the lock
+                snapshot = dict(ticket_data)
+                snapshot['messages'] = list(ticket_data['messages'])
+                return snapshot
+
+def snapshot_ticket_window(ticket_id, window, rehydrate=True):
+    """Copy of a ticket's header and of a window of its messages, taken at one point in time.
+
+    window(message_count) returns the (start, end) positions to copy; the copy has
+    them as 'messages', with 'message_start' and the full 'message_count'. Only
+    the window is copied, and for a ticket whose messages are not resident only
+    the window is loaded. Without rehydrate an archived ticket's window is read
+    from the archive and the ticket stays archived. Returns None if there is no
+    such ticket.
+    """
+    with ticket_lock(ticket_id):
+        while True:
+            with message_cache_lock:
+                ticket_data = tickets.get(ticket_id)
+                if ticket_data is None:
+                    return None
+                messages = ticket_data.get('messages')
+                snapshot = dict(ticket_data)
+                message_count = len(messages) if messages is not None else snapshot.get('message_count', 0)
+                start, end = window(message_count)
+                start, end = min(max(start, 0), message_count), min(max(end, 0), message_count)
+                snapshot.update(messages=messages[start:end] if messages is not None else None,
+                                message_start=start, message_count=message_count)
+                if messages is not None:
+                    return snapshot
+            if not rehydrate and ticket_data.get('archived'):
+                archived_messages = read_archived_messages(ticket_data)
+                if archived_messages is not None:
+                    snapshot['messages'] = archived_messages[start:end]
+                    return snapshot
+            if not LAZY_MESSAGES or (rehydrate and ticket_data.get('archived')):
+                get_ticket_messages(ticket_id)  # Load outside the cache lock, then copy again
+                continue
+            # Appends load the messages under the ticket's lock, so the window cannot change meanwhile
+            snapshot['messages'] = load_message_window_from_db(ticket_id, start, end)
+            with message_cache_lock:
+                message_cache_stats['window_loads'] += 1
+            return snapshot
+
+def get_ticket_lock_stats():
+    counters = [list(stripe_counters) for stripe_counters in ticket_lock_counters]
+    acquisitions = sum(stripe_counters[0] for stripe_counters in counters)
+    contended = sum(stripe_counters[1] for stripe_counters in counters)
+    wait_seconds = sum(stripe_counters[2] for stripe_counters in counters)
+    busiest = max(stripe_counters[1] for stripe_counters in counters)
+    return {
+        'stripes': TICKET_LOCK_STRIPES,
+        'acquisitions': acquisitions,
+        'contended': contended,
+        'contention_rate': round(contended / acquisitions, 4) if acquisitions else 0.0,
+        'wait_seconds': round(wait_seconds, 3),
+        'avg_wait_ms': round(wait_seconds * 1000 / contended, 3) if contended else 0.0,
+        'max_wait_ms': round(max(stripe_counters[3] for stripe_counters in counters) * 1000, 3),
+        # Close to 1 when one busy sender causes the waits, which more stripes do not help
+        'busiest_stripe_share': round(busiest / contended, 4) if contended else 0.0
+    }
+
+# --- Ticket Index & Dashboard Aggregates ---
+# Every ticket carries a header (message count, last message, voice/media flags)
+# updated as messages are appended. Ticket IDs are kept sorted newest first,
+# overall and per status, and tickets created per day are counted, so the
+# dashboard renders a page of tickets without scanning all tickets or messages.
+DASHBOARD_PER_PAGE = int(os.getenv('DASHBOARD_PER_PAGE', '50'))
+DASHBOARD_MAX_PER_PAGE = 200
+
+ticket_index = {'all': [], 'open': [], 'closed': []}  # Sorted lists of ticket_sort_key() values
+tickets_created_by_day = Counter()
+ticket_index_lock = threading.Lock()
+
+def summarize_messages(messages):
+    """Header fields describing a ticket's messages."""
+    return {
+        'message_count': len(messages),
+        'last_message': messages[-1] if messages else None,
+        'has_voice': any(msg.get('message_type') == 'audio' for msg in messages),
+        'has_media': any(msg.get('message_type') in ['image', 'video', 'document'] for msg in messages)
+    }
+
+def update_ticket_header(ticket_data, message):
+    """Account for a message appended to a ticket."""
+    ticket_data['message_count'] = ticket_data.get('message_count', 0) + 1
+    ticket_data['last_message'] = message
+    ticket_data['has_voice'] = ticket_data.get('has_voice') or message.get('message_type') == 'audio'
+    ticket_data['has_media'] = ticket_data.get('has_media') or message.get('message_type') in ['image', 'video', 'document']
+    bump_ticket_version(ticket_data)
+
+def bump_ticket_version(ticket_data):
+    """Mark a ticket as changed, invalidating its rendered fragments."""
+    with ticket_changes_lock:
+        ticket_data['version'] = next(ticket_versions)
+        ticket_changes[ticket_data['id']] = ticket_data['version']
+        ticket_changes.move_to_end(ticket_data['id'])
+
+def get_changed_ticket_ids(since, limit):
+    """IDs and versions of tickets changed after version `since`, oldest change first."""
+    changed = []
+    with ticket_changes_lock:
+        for ticket_id, version in reversed(ticket_changes.items()):
+            if version <= since:
+                break
+            changed.append((ticket_id, version))
+    changed.reverse()
+    return changed[:limit], len(changed) > limit
+
+def get_latest_ticket_version():
+    with ticket_changes_lock:
+        return next(reversed(ticket_changes.values()), 0)
+
+def ticket_sort_key(ticket_id):
+    """Sort key putting the highest ticket numbers (T1, T2, T3, etc.) first."""
+    number = int(ticket_id[1:]) if ticket_id.startswith('T') and ticket_id[1:].isdigit() else 0
+    return (-number, ticket_id)
+
+def remove_sorted(sorted_list, key):
+    position = bisect_left(sorted_list, key)
+    if position < len(sorted_list) and sorted_list[position] == key:
+        del sorted_list[position]
+
+def index_ticket(ticket_data):
+    """Add a new ticket to the index and aggregates."""
+    key = ticket_sort_key(ticket_data['id'])
+    with ticket_index_lock:
+        insort(ticket_index['all'], key)
+        insort(ticket_index.setdefault(ticket_data['status'], []), key)
+        tickets_created_by_day[ticket_data['created_at'][:10]] += 1
+
+def set_ticket_status(ticket_data, status):
+    """Change a ticket's status, keeping the index and aggregates in step."""
+    with ticket_index_lock:
+        old_status = ticket_data['status']
+        ticket_data['status'] = status
+        bump_ticket_version(ticket_data)
+        if old_status != status:
+            key = ticket_sort_key(ticket_data['id'])
+            remove_sorted(ticket_index.setdefault(old_status, []), key)
+            insort(ticket_index.setdefault(status, []), key)
+    if old_status != status:
+        track_archive_candidate(ticket_data)
+        publish_event('status-changed', ticket_data['id'], status=status)
+
+def rebuild_ticket_index():
+    """Rebuild the index and aggregates from scratch after tickets were reloaded."""
+    with ticket_index_lock:
+        ticket_index.clear()
+        ticket_index.update({'all': [], 'open': [], 'closed': []})
+        tickets_created_by_day.clear()
+        for ticket_id, ticket_data in list(tickets.items()):
+            key = ticket_sort_key(ticket_id)
+            ticket_index['all'].append(key)
+            ticket_index.setdefault(ticket_data['status'], []).append(key)
+            tickets_created_by_day[ticket_data['created_at'][:10]] += 1
+        for keys in ticket_index.values():
+            keys.sort()
+
+def get_ticket_stats():
+    """Ticket counts shown on the dashboard."""
+    today = datetime.now().strftime('%Y-%m-%d')
+    with ticket_index_lock:
+        total_tickets = len(ticket_index['all'])
+        open_tickets = len(ticket_index['open'])
+        today_tickets = tickets_created_by_day[today]
+    return {
+        'total': total_tickets,
+        'open': open_tickets,
+        'closed': total_tickets - open_tickets,
+        'today': today_tickets
+    }
+
+def get_ticket_page(status, page, per_page):
+    """Ticket IDs on a page of the (optionally status filtered) ticket list, and the list's length."""
+    with ticket_index_lock:
+        keys = ticket_index.get(status or 'all', [])
+        start = (page - 1) * per_page
+        return [ticket_id for _, ticket_id in keys[start:start + per_page]], len(keys)
+
+# --- Search Index ---
+# An inverted index over message text (captions included) and file names, and over
+# each ticket's ID, sender and admin notes. Every message and every ticket header is
+# a document; each term maps to an array of the numbers of the documents containing
+# it. A query merges and intersects these arrays with set operations, so it never
+# scans tickets or messages. Messages are indexed as they are appended. After tickets are
+# (re)loaded the index is rebuilt in the background, from memory or, with
+# LAZY_MESSAGES, by paging through the messages table. With SHARED_STATE, messages
+# other workers add to tickets whose messages are not resident are indexed on the
+# next reload.
+SEARCH_ENABLED = os.getenv('SEARCH_ENABLED', 'true').lower() == 'true'
+SEARCH_PER_PAGE = 20
+SEARCH_MAX_PER_PAGE = 100
+SEARCH_MAX_PREFIX_TERMS = int(os.getenv('SEARCH_MAX_PREFIX_TERMS', '100'))  # Index terms one query word may match
+SEARCH_MAX_QUERY_WORDS = 10
+SEARCH_MAX_TERM_LENGTH = 40
+SEARCH_MAX_NEW_TERMS = 1000  # Unsorted new terms before they are merged into the vocabulary
+SEARCH_BUILD_BATCH = 1000  # Messages indexed per lock hold, and rows per database page
+
+search_word_pattern = re.compile(r'[^\W_]+')
+search_postings = {}  # Term -> array of document numbers, ascending
+search_terms = []  # Sorted vocabulary for prefix matching
+search_new_terms = []  # Terms not yet merged into search_terms, scanned by queries
+search_docs = {
+    'ticket_ids': [],
+    'positions': array('i'),  # Message position, -1 for ticket headers
+    'days': array('I')  # YYYYMMDD
+}
+search_ticket_docs = {}  # Ticket ID -> document number of its current header
+search_dead_docs = set()  # Replaced ticket headers
+search_lock = threading.Lock()
+search_state = {'generation': 0, 'building': False, 'postings': 0}
+search_stats = {'queries': 0, 'query_seconds': 0.0, 'max_query_seconds': 0.0}
+
+def tokenize(text):
+    """Distinct lower-cased words of a text."""
+    return {word for word in search_word_pattern.findall(text.lower()) if len(word) <= SEARCH_MAX_TERM_LENGTH}
+
+def search_day(date_string):
+    """YYYYMMDD number of an ISO date or timestamp."""
+    return int(date_string[:10].replace('-', '')) if date_string else 0
+
+def message_search_text(message):
+    return ' '.join(filter(None, (message.get('text'), message.get('file_name'))))
+
+def ticket_search_text(ticket_data):
+    return ' '.join(filter(None, (
+        ticket_data['id'],
+        ticket_data.get('sender_name'),
+        ticket_data['sender_id'].split('@')[0],
+        ticket_data.get('admin_notes')
+    )))
+
+def add_search_document(ticket_id, position, timestamp, text):
+    """Index a document and return its number. Caller holds search_lock."""
+    doc = len(search_docs['ticket_ids'])
+    search_docs['ticket_ids'].append(ticket_id)
+    search_docs['positions'].append(position)
+    search_docs['days'].append(search_day(timestamp))
+    terms = tokenize(text)
+    for term in terms:
+        documents = search_postings.get(term)
+        if documents is None:
+            documents = search_postings[term] = array('I')
+            search_new_terms.append(term)
+        documents.append(doc)
+    search_state['postings'] += len(terms)
+    return doc
+
+def index_ticket_for_search(ticket_data):
+    """Index a ticket's ID, sender and notes, replacing what was indexed before."""
+    if not SEARCH_ENABLED:
+        return
+    with search_lock:
+        old_doc = search_ticket_docs.get(ticket_data['id'])
+        if old_doc is not None:
+            search_dead_docs.add(old_doc)
+        search_ticket_docs[ticket_data['id']] = add_search_document(
+            ticket_data['id'], -1, ticket_data['created_at'], ticket_search_text(ticket_data))
+
+def index_messages_for_search(ticket_id, start, messages):
+    """Index messages of a ticket, the first of which is at position start."""
+    if not SEARCH_ENABLED:
+        return
+    with search_lock:
+        for position, message in enumerate(messages, start):
+            add_search_document(ticket_id, position, message.get('timestamp'), message_search_text(message))
+
+def rebuild_search_index():
+    """Reset the index after tickets were reloaded and rebuild it in the background."""
+    if not SEARCH_ENABLED:
+        return
+    with message_cache_lock, search_lock:
+        # Messages appended from here on are indexed by append_message
+        search_postings.clear()
+        del search_terms[:], search_new_terms[:]
+        for values in search_docs.values():
+            del values[:]
+        search_ticket_docs.clear()
+        search_dead_docs.clear()
+        search_state.update(generation=search_state['generation'] + 1, building=True, postings=0)
+        generation = search_state['generation']
+        message_counts = {}
+        for ticket_id, ticket_data in list(tickets.items()):
+            search_ticket_docs[ticket_id] = add_search_document(
+                ticket_id, -1, ticket_data['created_at'], ticket_search_text(ticket_data))
+            message_counts[ticket_id] = ticket_data['message_count']
+    threading.Thread(target=build_search_index, args=(generation, message_counts),
+                     name='search-index-build', daemon=True).start()
+
+def iter_messages_to_index(message_counts):
+    """Batches of (ticket ID, position, message) for the first message_counts[ticket ID] messages of each ticket."""
+    if LAZY_MESSAGES:
+        positions = Counter()
+        last_id = 0
+        while True:
+            # Rows are inserted in the order messages are appended, so ID order gives each ticket's positions
+            rows = supabase.table('messages').select('id,ticket_id,text,file_name,timestamp') \
+                .gt('id', last_id).order('id').limit(SEARCH_BUILD_BATCH).execute().data
+            batch = []
+            for row in rows:
+                position = positions[row['ticket_id']]
+                positions[row['ticket_id']] += 1
+                if position < message_counts.get(row['ticket_id'], 0):
+                    batch.append((row['ticket_id'], position, row))
+            yield batch
+            if len(rows) < SEARCH_BUILD_BATCH:
+                return
+            last_id = rows[-1]['id']
+    
+    batch = []
+    for ticket_id, message_count in message_counts.items():
+        ticket_data = tickets.get(ticket_id) or {}
+        messages = ticket_data.get('messages')
+        if messages is None and ticket_data.get('archived'):
+            messages = read_archived_messages(ticket_data)  # Without rehydrating the ticket
+        for position, message in enumerate((messages or [])[:message_count]):
+            batch.append((ticket_id, position, message))
+            if len(batch) >= SEARCH_BUILD_BATCH:
+                yield batch
+                batch = []
+    yield batch
+
+def build_search_index(generation, message_counts):
+    """Index the messages tickets had when the index was reset."""
+    started_at = time.monotonic()
+    indexed = 0
+    try:
+        for batch in iter_messages_to_index(message_counts):
+            with search_lock:
+                if search_state['generation'] != generation:
+                    return  # Tickets were reloaded again meanwhile
+                for ticket_id, position, message in batch:
+                    add_search_document(ticket_id, position, message.get('timestamp'), message_search_text(message))
+            indexed += len(batch)
+        logger.info(f"Indexed {indexed} messages for search in {time.monotonic() - started_at:.1f}s.")
+    except Exception as e:
+        logger.error(f"Failed to build the search index: {e}")
+    finally:
+        with search_lock:
+            if search_state['generation'] == generation:
+                search_state['building'] = False
+
+def expand_search_word(word):
+    """Postings of the index terms starting with a query word, with their weights. Caller holds search_lock."""
+    if len(search_new_terms) > SEARCH_MAX_NEW_TERMS:
+        search_terms.extend(search_new_terms)
+        search_terms.sort()
+        del search_new_terms[:]
+    start = bisect_left(search_terms, word)
+    matches = []
+    for term in search_terms[start:start + SEARCH_MAX_PREFIX_TERMS]:
+        if not term.startswith(word):
+            break
+        matches.append(term)
+    matches.extend(term for term in search_new_terms if term.startswith(word))
+    expansions = []
+    for term in matches[:SEARCH_MAX_PREFIX_TERMS]:
+        documents = search_postings[term]
+        idf = math.log(1 + len(search_docs['ticket_ids']) / len(documents))
+        expansions.append((documents, idf if term == word else idf / 2))  # Exact matches rank higher
+    return expansions
+
+def search_tickets(query, status=None, date_from=None, date_to=None, page=1, per_page=SEARCH_PER_PAGE):
+    """Documents matching every word of a query as a prefix, best first.
+
+    Returns one page of hits ({'ticket_id', 'position', 'score'}; position is None
+    for a match on the ticket itself) and the number of matching documents.
+    """
+    started_at = time.monotonic()
+    words = list(dict.fromkeys(search_word_pattern.findall(query.lower())))[:SEARCH_MAX_QUERY_WORDS]
+    if not words:
+        return [], 0
+    day_from = search_day(date_from) if date_from else 0
+    day_to = search_day(date_to) if date_to else 99999999
+    
+    with search_lock:
+        # Postings are only ever appended to (a rebuild replaces them), so their
+        # first length entries can be read once the lock is released
+        generation = search_state['generation']
+        word_expansions = [[(documents, len(documents), weight) for documents, weight in expand_search_word(word)]
+                           for word in words]
+    
+    # A document scores the weight of the best term it has for each word. The
+    # word with the fewest postings gives the candidates; the others are probed
+    # for just those, unless merging their postings is cheaper.
+    word_expansions.sort(key=lambda expansions: sum(length for _, length, _ in expansions))
+    scores = {}
+    for documents, length, weight in sorted(word_expansions[0], key=lambda expansion: expansion[2]):
+        scores.update(dict.fromkeys(documents[:length], weight))
+    for expansions in word_expansions[1:]:
+        if not scores:
+            break
+        expansions.sort(key=lambda expansion: expansion[2], reverse=True)
+        if len(scores) * len(expansions) * 16 < sum(length for _, length, _ in expansions):
+            matched = {}
+            for doc, score in scores.items():
+                for documents, length, weight in expansions:
+                    index = bisect_left(documents, doc, 0, length)
+                    if index < length and documents[index] == doc:
+                        matched[doc] = score + weight
+                        break
+        else:
+            word_scores = {}
+            for documents, length, weight in reversed(expansions):
+                word_scores.update(dict.fromkeys(documents[:length], weight))
+            matched = {doc: score + word_scores[doc] for doc, score in scores.items() if doc in word_scores}
+        scores = matched
+    
+    with search_lock:
+        if search_state['generation'] != generation:
+            scores = {}  # Tickets were reloaded meanwhile, so document numbers changed
+        for doc in list(search_dead_docs) if len(search_dead_docs) < len(scores) else list(scores):
+            if doc in search_dead_docs:
+                scores.pop(doc, None)
+        if status or date_from or date_to:
+            days, ticket_ids = search_docs['days'], search_docs['ticket_ids']
+            scores = {
+                doc: score for doc, score in scores.items()
+                if day_from <= days[doc] <= day_to
+                and (not status or tickets.get(ticket_ids[doc], {}).get('status') == status)
             }
-            # Check if message already exists to avoid duplicates
-            existing = supabase.table('messages').select('*').eq('ticket_id', ticket_data['id']).eq('timestamp', message['timestamp']).execute()
-            if not existing.data:
-                supabase.table('messages').insert(message_record).execute()
+    
+    # Ties go to the most recently indexed document
+    best = heapq.nlargest(page * per_page, zip(scores.values(), scores.keys()))
+    with search_lock:
+        if search_state['generation'] != generation:
+            best = []
+        hits = [{
+            'ticket_id': search_docs['ticket_ids'][doc],
+            'position': search_docs['positions'][doc] if search_docs['positions'][doc] >= 0 else None,
+            'score': round(score, 3)
+        } for score, doc in best[(page - 1) * per_page:]]
         
-        logger.info(f"Ticket {ticket_data['id']} saved to database successfully.")
+        elapsed = time.monotonic() - started_at
+        search_stats['queries'] += 1
+        search_stats['query_seconds'] += elapsed
+        search_stats['max_query_seconds'] = max(search_stats['max_query_seconds'], elapsed)
+    return hits, len(scores)
+
+def parse_search_date(value):
+    """A YYYY-MM-DD query parameter, or None if it is missing or malformed."""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+def get_search_index_stats():
+    with search_lock:
+        documents = len(search_docs['ticket_ids'])
+        dead_documents = len(search_dead_docs)
+        terms = len(search_postings)
+        stats = dict(search_stats, **search_state)
+        # Estimated: 4 bytes per posting; per term its string, dict entry, array header and
+        # vocabulary slot; per document its ticket ID reference, position and day
+        stats['memory_bytes'] = (
+            stats['postings'] * 4 +
+            terms * (sys.getsizeof('') + 8 + 32 + sys.getsizeof(array('I')) + 8) +
+            documents * (8 + 4 + 4) +
+            sys.getsizeof(search_dead_docs)
+        )
+    del stats['generation']
+    stats.update({'enabled': SEARCH_ENABLED, 'documents': documents - dead_documents, 'dead_documents': dead_documents, 'terms': terms})
+    stats['avg_query_ms'] = stats['query_seconds'] * 1000 / stats['queries'] if stats['queries'] else 0.0
+    return stats
+
+# --- Fragment Cache ---
+# Rendered HTML of dashboard rows/cards and ticket message lists, keyed by
+# (ticket_id, view) and valid for one ticket version. Individual messages are
+# cached too, so a new message only renders itself. Bounded by FRAGMENT_CACHE_MAX_BYTES
+# (0 disables the cache), least recently used fragments are evicted first.
+# The ticket page renders only the last TICKET_MESSAGE_WINDOW messages and fetches
+# older ones by position as the agent scrolls up. Its message counts by type are
+# kept per ticket and only count the messages added since they were last shown.
+FRAGMENT_CACHE_MAX_BYTES = int(os.getenv('FRAGMENT_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+TICKET_MESSAGE_WINDOW = max(int(os.getenv('TICKET_MESSAGE_WINDOW', '50')), 1)
+TICKET_MESSAGE_MAX_LIMIT = 200  # Messages per request for older history
+MESSAGE_TYPE_COUNTS_MAX_TICKETS = 10000
+
+fragment_cache = OrderedDict()  # (ticket_id, view) -> (version, html), least recently used first
+fragment_cache_lock = threading.Lock()
+fragment_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+message_type_counts = OrderedDict()  # Ticket ID -> (messages counted, Counter of their types), least recently used first
+
+def get_fragment(ticket_id, view, version):
+    """Cached HTML of a view of a ticket at the given version, or None."""
+    with fragment_cache_lock:
+        entry = fragment_cache.get((ticket_id, view))
+        if entry is not None and entry[0] == version:
+            fragment_cache.move_to_end((ticket_id, view))
+            fragment_cache_stats['hits'] += 1
+            return entry[1]
+        fragment_cache_stats['misses'] += 1
+        return None
+
+def store_fragment(ticket_id, view, version, html):
+    """Cache rendered HTML of a view of a ticket, replacing older versions."""
+    html = Markup(html)
+    if FRAGMENT_CACHE_MAX_BYTES <= 0:
+        return html
+    with fragment_cache_lock:
+        old_entry = fragment_cache.pop((ticket_id, view), None)
+        if old_entry is not None:
+            fragment_cache_stats['bytes'] -= len(old_entry[1])
+        fragment_cache[(ticket_id, view)] = (version, html)
+        fragment_cache_stats['bytes'] += len(html)
+        while fragment_cache_stats['bytes'] > FRAGMENT_CACHE_MAX_BYTES and len(fragment_cache) > 1:
+            _, (_, evicted_html) = fragment_cache.popitem(last=False)
+            fragment_cache_stats['bytes'] -= len(evicted_html)
+            fragment_cache_stats['evictions'] += 1
+    return html
+
+def format_timestamp(timestamp, date_format):
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).strftime(date_format)
+
+def render_dashboard_ticket(ticket_id, ticket_data):
+    """Dashboard table row and mobile card of a ticket."""
+    version = ticket_data['version']
+    row = get_fragment(ticket_id, 'row', version)
+    card = get_fragment(ticket_id, 'card', version)
+    if row is not None and card is not None:
+        return row, card
+    
+    # Cached fragments were rendered from a snapshot of their version; so are new ones
+    ticket_data = snapshot_ticket(ticket_id) or ticket_data
+    version = ticket_data['version']
+    
+    # Format ticket data for display
+    ticket_display = {
+        'id': ticket_id,
+        'sender_id': ticket_data['sender_id'],
+        'sender_name': ticket_data['sender_name'],
+        'status': ticket_data['status'],
+        'message_count': ticket_data['message_count'],
+        'created_at_formatted': format_timestamp(ticket_data['created_at'], '%Y-%m-%d %H:%M'),
+        'has_voice': ticket_data['has_voice'],
+        'has_media': ticket_data['has_media']
+    }
+    
+    # Get last message
+    if ticket_data['last_message']:
+        last_msg = ticket_data['last_message']
+        ticket_display['last_message'] = (last_msg.get('text') or f"[{last_msg.get('message_type', 'message')}]")[:50]
+        ticket_display['last_message_time'] = format_timestamp(last_msg['timestamp'], '%H:%M')
+    else:
+        ticket_display['last_message'] = 'No messages'
+        ticket_display['last_message_time'] = ''
+    
+    row = store_fragment(ticket_id, 'row', version, render_template('partials/ticket_row.html', ticket=ticket_display))
+    card = store_fragment(ticket_id, 'card', version, render_template('partials/ticket_card.html', ticket=ticket_display))
+    return row, card
+
+def render_message(ticket_id, position, message, sender_name):
+    """HTML of one message of a ticket's conversation history."""
+    # Messages only change when transcribed; the timestamp guards against a reloaded list
+    metadata = message.get('metadata') or {}
+    version = (message['timestamp'], sender_name, metadata.get('transcription_status'))
+    html = get_fragment(ticket_id, f'message:{position}', version)
+    if html is not None:
+        return html
+    
+    message_display = {
+        'author': message.get('author', 'Unknown'),
+        'text': message.get('text', ''),
+        'message_type': message.get('message_type', 'text'),
+        'file_url': message.get('file_url'),
+        'file_name': message.get('file_name'),
+        'file_size': message.get('file_size'),
+        'duration': message.get('duration'),
+        'mime_type': message.get('mime_type'),
+        'media_url': url_for('ticket_media', ticket_id=ticket_id, position=position) if message.get('file_url') else None,
+        'transcription': metadata.get('transcription'),
+        'position': position,
+        'timestamp_formatted': format_timestamp(message['timestamp'], '%Y-%m-%d %H:%M:%S')
+    }
+    html = render_template('partials/message.html', message=message_display, sender_name=sender_name)
+    return store_fragment(ticket_id, f'message:{position}', version, html)
+
+def render_messages(ticket_id, version, messages, sender_name, start=0):
+    """HTML of the last messages of a ticket's conversation history, `messages` starting at position `start`.
+
+    The version must be read before the messages, so cached HTML is never older than its version.
+    """
+    html = get_fragment(ticket_id, 'messages', (version, start))
+    if html is not None:
+        return html
+    html = ''.join(render_message(ticket_id, position, message, sender_name)
+                   for position, message in enumerate(messages, start))
+    return store_fragment(ticket_id, 'messages', (version, start), html)
+
+def count_message_types(ticket_id, snapshot):
+    """Counter of the message types of a ticket, counting only messages added since the last call.
+
+    The snapshot is one of snapshot_ticket_window, whose window is expected to
+    cover the messages added since; older ones are copied separately.
+    """
+    with fragment_cache_lock:
+        counted, counts = message_type_counts.pop(ticket_id, (0, Counter()))
+    message_count, start = snapshot['message_count'], snapshot['message_start']
+    if counted > message_count:
+        counted, counts = 0, Counter()  # Reloaded with fewer messages
+    if counted < start:
+        # Messages are append-only, so the ones before the window are still in place
+        older = snapshot_ticket_window(ticket_id, lambda count: (counted, start))
+        if older is not None:
+            counts = counts + Counter(message.get('message_type', 'text') for message in older['messages'])
+        counted = start
+    if counted < message_count:
+        counts = counts + Counter(message.get('message_type', 'text') for message in snapshot['messages'][counted - start:])
+    with fragment_cache_lock:
+        message_type_counts[ticket_id] = (message_count, counts)
+        while len(message_type_counts) > MESSAGE_TYPE_COUNTS_MAX_TICKETS:
+            message_type_counts.popitem(last=False)
+    return counts
+
+def get_fragment_cache_stats():
+    with fragment_cache_lock:
+        stats = dict(fragment_cache_stats)
+        stats['fragments'] = len(fragment_cache)
+    stats['max_bytes'] = FRAGMENT_CACHE_MAX_BYTES
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+# --- Live Updates (Server-Sent Events) ---
+# Ticket changes are published as events to a bounded in-memory log. Browsers
+# follow it over /events (SSE) or /events/poll (long-poll) and patch the changed
+# rows and messages in place. Cursors are '<stream>-<sequence>'; a cursor from
+# another process or one that fell off the log gets a 'reset' (reload the page).
+EVENT_LOG_SIZE = int(os.getenv('EVENT_LOG_SIZE', '1000'))
+EVENTS_HEARTBEAT = 15  # Seconds between keep-alive comments on idle streams
+EVENTS_STREAM_TIMEOUT = int(os.getenv('EVENTS_STREAM_TIMEOUT', '300'))  # Browsers reconnect with Last-Event-ID
+EVENTS_POLL_TIMEOUT = 25
+
+event_stream_id = os.urandom(4).hex()
+event_log = deque(maxlen=EVENT_LOG_SIZE)
+event_condition = threading.Condition()
+event_stats = {'last_sequence': 0, 'published': 0, 'subscribers': 0}
+
+def publish_event(event_type, ticket_id=None, **data):
+    """Publish a ticket change to live dashboard clients."""
+    with event_condition:
+        event_stats['last_sequence'] += 1
+        event_stats['published'] += 1
+        event = {'id': f"{event_stream_id}-{event_stats['last_sequence']}", 'type': event_type, 'ticket_id': ticket_id}
+        event.update(data)
+        event_log.append((event_stats['last_sequence'], event))
+        event_condition.notify_all()
+
+def get_event_cursor():
+    """Cursor pointing past the latest event."""
+    with event_condition:
+        return f"{event_stream_id}-{event_stats['last_sequence']}"
+
+def parse_event_cursor(cursor):
+    """Sequence number of a cursor issued by this process, or None."""
+    stream_id, _, sequence = (cursor or '').rpartition('-')
+    if stream_id != event_stream_id or not sequence.isdigit():
+        return None
+    return int(sequence)
+
+def wait_for_events(cursor, timeout):
+    """Events after a cursor, waiting up to timeout seconds for one.
+
+    Returns (events, cursor); events is None if the client has to reload.
+    """
+    sequence = parse_event_cursor(cursor)
+    with event_condition:
+        if sequence is None or sequence > event_stats['last_sequence']:
+            return None, get_event_cursor()
+        if event_log and sequence < event_log[0][0] - 1:
+            return None, get_event_cursor()  # Missed events dropped from the log
+        event_condition.wait_for(lambda: event_stats['last_sequence'] > sequence, timeout)
+        events = [event for event_sequence, event in event_log if event_sequence > sequence]
+        return events, f"{event_stream_id}-{event_stats['last_sequence']}"
+
+def stream_events(cursor):
+    """Generate a Server-Sent Events stream starting after a cursor."""
+    with event_condition:
+        event_stats['subscribers'] += 1
+    try:
+        yield 'retry: 3000\n\n'
+        deadline = time.time() + EVENTS_STREAM_TIMEOUT
+        while time.time() < deadline:
+            events, cursor = wait_for_events(cursor, EVENTS_HEARTBEAT)
+            if events is None:
+                yield f"id: {cursor}\ndata: {json.dumps({'type': 'reset'})}\n\n"
+                return
+            if not events:
+                yield ': keep-alive\n\n'
+            for event in events:
+                yield f"id: {event['id']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        with event_condition:
+            event_stats['subscribers'] -= 1
+
+def get_event_stats():
+    with event_condition:
+        stats = dict(event_stats)
+    stats['log_size'] = len(event_log)
+    return stats
+
+@app.context_processor
+def inject_event_cursor():
+    return {'event_cursor': get_event_cursor()}
+
+# --- Shared State (multiple workers) ---
+# With SHARED_STATE enabled several worker processes can serve the app:
+# - ticket numbers come from an allocator shared by all workers
+#   (TICKET_ID_ALLOCATOR: 'database' sequence or a file-locked 'file' counter),
+# - new tickets are inserted immediately, and the database allows one open
+#   ticket per sender; a worker losing that race adopts the winner's ticket
+#   (claiming again, up to TICKET_CLAIM_ATTEMPTS times, if it was closed meanwhile),
+# - every SHARED_STATE_SYNC_INTERVAL seconds each worker reloads the tickets
+#   other workers changed, found through tickets.updated_at.
+# Requires database_migration_shared_state.sql and the ticket_summaries view.
+SHARED_STATE = os.getenv('SHARED_STATE', 'false').lower() == 'true'
+TICKET_ID_ALLOCATOR = os.getenv('TICKET_ID_ALLOCATOR', 'database' if SHARED_STATE else 'local')
+TICKET_ID_FILE = os.getenv('TICKET_ID_FILE', 'ticket_id.seq')
+SHARED_STATE_SYNC_INTERVAL = float(os.getenv('SHARED_STATE_SYNC_INTERVAL', '2'))  # Seconds
+SHARED_STATE_SYNC_OVERLAP = float(os.getenv('SHARED_STATE_SYNC_OVERLAP', '5'))  # Seconds re-read to catch late commits
+TICKET_CLAIM_ATTEMPTS = 3
+
+shared_state = {
+    'watermark': None,  # Highest tickets.updated_at seen
+    'syncs': 0,
+    'failed_syncs': 0,
+    'tickets_refreshed': 0,
+    'ticket_claim_conflicts': 0,
+    'slot': 0  # Journal slot; worker 0 also runs the singleton background jobs
+}
+journal_slot_file = None  # Held open to keep this worker's journal locked
+
+def claim_journal_slot():
+    """Give this worker its own journal directory.
+
+    Workers lock the first free numbered slot, so a restarted worker takes over
+    (and replays) the journal of a worker that is gone.
+    """
+    global JOURNAL_DIR, PENDING_WRITES_FILE, journal_slot_file
+    import fcntl
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    slot = 0
+    while True:
+        lock_file = open(os.path.join(JOURNAL_DIR, f"{slot}.lock"), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            slot += 1
+            continue
+        journal_slot_file = lock_file
+        shared_state['slot'] = slot
+        JOURNAL_DIR = os.path.join(JOURNAL_DIR, str(slot))
+        PENDING_WRITES_FILE = f"{PENDING_WRITES_FILE}.{slot}"
+        logger.info(f"Using journal {JOURNAL_DIR}.")
+        return
+
+def allocate_ticket_id():
+    """Allocate the next ticket ID from the configured allocator."""
+    global next_ticket_id
+    if TICKET_ID_ALLOCATOR == 'database':
+        return f"T{supabase.rpc('next_ticket_number').execute().data}"
+    if TICKET_ID_ALLOCATOR == 'file':
+        return f"T{allocate_ticket_number_from_file()}"
+    with ticket_id_lock:
+        ticket_id = f"T{next_ticket_id}"
+        next_ticket_id += 1
+    return ticket_id
+
+def allocate_ticket_number_from_file():
+    """Allocate a ticket number from a counter file shared by the workers on this host."""
+    import fcntl
+    with ticket_id_lock, open(TICKET_ID_FILE, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            content = f.read().strip()
+            # Never go below what this worker has already seen in the database
+            ticket_number = max(int(content) if content else 1, next_ticket_id)
+            f.seek(0)
+            f.truncate()
+            f.write(str(ticket_number + 1))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return ticket_number
+
+def is_unique_violation(error):
+    return '23505' in str(error) or 'duplicate key' in str(error)
+
+def claim_open_ticket(ticket_data):
+    """Insert a new ticket right away.
+
+    Returns True if inserted, False if the sender already has an open ticket, and
+    None if the database could not be reached.
+    """
+    try:
+        supabase.table('tickets').insert(build_ticket_record(ticket_data)).execute()
         return True
     except Exception as e:
-        logger.error(f"Failed to save ticket {ticket_data['id']} to database: {e}")
+        if is_unique_violation(e):
+            shared_state['ticket_claim_conflicts'] += 1
+            return False
+        logger.warning(f"Could not claim ticket {ticket_data['id']} in database: {e}")
+        return None
+
+def adopt_open_ticket(sender):
+    """Load the open ticket another worker created for a sender.
+
+    Returns its ID, False if the sender has no open ticket (anymore), and None if
+    the database could not be reached.
+    """
+    try:
+        result = supabase.table('ticket_summaries').select('*').eq('sender_id', sender).eq('status', 'open').execute()
+    except Exception as e:
+        logger.warning(f"Could not load the open ticket of sender {sender} from database: {e}")
+        return None
+    if not result.data:
+        return False
+    with flush_lock:
+        refresh_ticket_from_db(result.data[0])
+    return result.data[0]['id']
+
+def refresh_ticket_from_db(summary_row):
+    """Bring the local copy of a ticket in line with its `ticket_summaries` row.
+
+    Local changes not yet written win over the database. Caller holds flush_lock.
+    """
+    ticket_id = summary_row['id']
+    ticket_data = tickets.get(ticket_id)
+    if ticket_data is None:
+        # Ticket opened by another worker
+        if LAZY_MESSAGES:
+            ticket_data = ticket_header_from_summary(summary_row)
+            message_count = ticket_data['message_count']
+        else:
+            ticket_data = ticket_from_record(summary_row)
+            ticket_data['messages'] = load_ticket_messages_from_db(ticket_id)
+            message_count = len(ticket_data['messages'])
+        ticket_data.update(summarize_messages(ticket_data['messages']) if 'messages' in ticket_data else {})
+        tickets[ticket_id] = ticket_data
+        index_ticket(ticket_data)
+        track_archive_candidate(ticket_data)
+        index_ticket_for_search(ticket_data)
+        index_messages_for_search(ticket_id, 0, ticket_data.get('messages', []))
+        with persist_lock:
+            mark_ticket_persisted(ticket_data, message_count=message_count)
+        publish_event('ticket-created', ticket_id)
+    else:
+        with persist_lock:
+            state = persisted_ticket_state.get(ticket_id)
+            notes_changed = header_changed = False
+            if state is not None and build_ticket_record(ticket_data) == state['record']:
+                notes_changed = ticket_data.get('admin_notes') != summary_row.get('admin_notes')
+                header_changed = notes_changed or ticket_data.get('sender_name') != summary_row.get('sender_name')
+                for key in ('sender_name', 'admin_notes'):
+                    ticket_data[key] = summary_row.get(key)
+                set_ticket_status(ticket_data, summary_row.get('status'))  # Also bumps the version
+                state['record'] = build_ticket_record(ticket_data)
+        if header_changed:
+            index_ticket_for_search(ticket_data)
+        if notes_changed:
+            publish_event('notes-updated', ticket_id)
+        
+        with pending_writes_condition:
+            pending_count = len(get_buffered_message_rows(ticket_id))
+        if state is not None and summary_row['message_count'] != state['message_count'] - pending_count:
+            # Other workers added messages
+            if 'messages' in ticket_data:
+                local_count = len(ticket_data['messages'])
+                loaded_messages = load_ticket_messages_from_db(ticket_id)
+                with message_cache_lock, persist_lock:
+                    # Skip if messages were appended meanwhile; the next sync retries
+                    if ticket_data.get('messages') is not None and len(ticket_data['messages']) == local_count == state['message_count']:
+                        index_messages_for_search(ticket_id, local_count, loaded_messages[local_count:])
+                        ticket_data['messages'] = loaded_messages
+                        ticket_data.update(summarize_messages(loaded_messages))
+                        bump_ticket_version(ticket_data)
+                        state['message_count'] = len(loaded_messages)
+                cache_ticket_messages(ticket_id)
+                publish_event('message-appended', ticket_id)
+            else:
+                header = ticket_header_from_summary(summary_row)
+                ticket_data.update({key: header[key] for key in ('last_message', 'has_voice', 'has_media')})
+                ticket_data['message_count'] = header['message_count'] + pending_count
+                bump_ticket_version(ticket_data)
+                with persist_lock:
+                    state['message_count'] = summary_row['message_count'] + pending_count
+                publish_event('message-appended', ticket_id)
+    
+    sender = ticket_data['sender_id']
+    if ticket_data['status'] == 'open':
+        open_tickets_by_sender[sender] = ticket_id
+    elif open_tickets_by_sender.get(sender) == ticket_id:
+        del open_tickets_by_sender[sender]
+    shared_state['tickets_refreshed'] += 1
+
+def sync_shared_state():
+    """Reload tickets changed in the database since the last sync."""
+    since = shared_state['watermark']
+    query = supabase.table('ticket_summaries').select('*')
+    if since:
+        since = (datetime.fromisoformat(since.replace('Z', '+00:00')) - timedelta(seconds=SHARED_STATE_SYNC_OVERLAP)).isoformat()
+        query = query.gt('updated_at', since)
+    with flush_writer_lock, flush_lock:
+        result = query.order('updated_at').execute()
+        for summary_row in result.data:
+            refresh_ticket_from_db(summary_row)
+            if summary_row.get('updated_at') and summary_row['updated_at'] > (shared_state['watermark'] or ''):
+                shared_state['watermark'] = summary_row['updated_at']
+    shared_state['syncs'] += 1
+
+def shared_state_loop():
+    while True:
+        time.sleep(SHARED_STATE_SYNC_INTERVAL)
+        try:
+            sync_shared_state()
+        except Exception as e:
+            shared_state['failed_syncs'] += 1
+            logger.error(f"Failed to sync shared state: {e}")
+
+def start_shared_state_sync():
+    sync_thread = threading.Thread(target=shared_state_loop, name="shared-state-sync")
+    sync_thread.daemon = True
+    sync_thread.start()
+
+def get_shared_state_stats():
+    stats = dict(shared_state)
+    stats['enabled'] = SHARED_STATE
+    stats['ticket_id_allocator'] = TICKET_ID_ALLOCATOR
+    return stats
+
+# --- Warm Start ---
+# With WARM_START enabled, the in-memory tickets are pickled to JOURNAL_DIR every
+# WARM_START_SNAPSHOT_INTERVAL seconds and at shutdown, right after a flush so the
+# snapshot matches the database. A restart loads that snapshot and serves
+# immediately while a background catch-up refreshes tickets changed since then:
+# tickets with a newer updated_at and tickets of messages with a higher id than
+# when the snapshot was taken (needs the ticket_summaries view). /ready reports
+# 'warm', 'catching-up' and then 'ready'. Without a snapshot, startup loads
+# everything from the database as before.
+WARM_START = os.getenv('WARM_START', 'false').lower() == 'true'
+WARM_START_SNAPSHOT_INTERVAL = float(os.getenv('WARM_START_SNAPSHOT_INTERVAL', '300'))  # Seconds
+WARM_START_SNAPSHOT_NAME = 'state.pickle'
+WARM_START_PAGE_SIZE = 1000
+WARM_START_SNAPSHOT_ATTEMPTS = 3  # Flushes before a snapshot is skipped because writes keep arriving
+
+warm_start_state = {
+    'state': 'starting',
+    'snapshot_load_seconds': None,
+    'snapshot_saved_at': None,  # Of the snapshot loaded at startup
+    'catch_up_seconds': None,
+    'caught_up_tickets': 0,
+    'failed_catch_ups': 0,
+    'ready_after_seconds': None,  # Since the module started loading
+    'snapshots_written': 0,
+    'last_snapshot_seconds': None
+}
+process_started = time.monotonic()
+
+def snapshot_message(message):
+    """A message as a plain tuple, which pickles and loads several times faster than the object."""
+    media = message.media
+    if media is not None:
+        media = (media.file_url, media.file_name, media.file_size, media.duration, media.mime_type, media.metadata)
+    return (message.author, message.timestamp, message.message_type, message.text, media)
+
+def restore_message(row):
+    """The Message for a tuple from snapshot_message()."""
+    message = Message.__new__(Message)
+    message.author, message.timestamp, message.message_type, message.text, media = row
+    message.id_message = None
+    if media is not None:
+        media_info = MediaInfo.__new__(MediaInfo)
+        media_info.file_url, media_info.file_name, media_info.file_size, media_info.duration, media_info.mime_type, media_info.metadata = media
+        media_info.raw_payload = None  # Stays in the database
+        media = media_info
+    message.media = media
+    return message
+
+def get_database_watermarks():
+    """Return the newest tickets.updated_at and messages.id in the database."""
+    ticket_rows = supabase.table('tickets').select('updated_at').order('updated_at', desc=True).limit(1).execute().data
+    message_rows = supabase.table('messages').select('id').order('id', desc=True).limit(1).execute().data
+    return (ticket_rows[0]['updated_at'] if ticket_rows else None), (message_rows[0]['id'] if message_rows else 0)
+
+def write_state_snapshot():
+    """Pickle the tickets for the next warm start. Returns False if they could not be flushed first."""
+    started = time.monotonic()
+    # Taken before the flush, so anything newer is caught up after a restart
+    watermark, message_watermark = get_database_watermarks()
+    for attempt in range(WARM_START_SNAPSHOT_ATTEMPTS):
+        # Flush without holding up saves and message loads, then copy the tickets
+        # only if nothing was buffered meanwhile
+        if not flush_pending_writes():
+            return False
+        with flush_lock, message_cache_lock, persist_lock:
+            with pending_writes_condition:
+                if get_unflushed_row_count():
+                    continue
+            captured = []
+            for ticket_data in list(tickets.values()):
+                ticket_copy = dict(ticket_data)
+                if LAZY_MESSAGES:
+                    ticket_copy.pop('messages', None)  # Loaded on demand, as after a cold start
+                elif 'messages' in ticket_copy:
+                    ticket_copy['messages'] = list(ticket_copy['messages'])
+                captured.append(ticket_copy)
+            break
+    else:
+        logger.warning("Skipping the state snapshot: new writes kept arriving during the flush.")
         return False
+    
+    for ticket_copy in captured:
+        ticket_copy.pop('version', None)
+        if 'messages' in ticket_copy:
+            ticket_copy['messages'] = [snapshot_message(message) for message in ticket_copy['messages']]
+        if ticket_copy.get('last_message') is not None:
+            ticket_copy['last_message'] = snapshot_message(ticket_copy['last_message'])
+    snapshot = {
+        'saved_at': datetime.now().isoformat(),
+        'watermark': watermark,
+        'message_watermark': message_watermark,
+        'tickets': captured
+    }
+    path = journal_path(WARM_START_SNAPSHOT_NAME)
+    with open(f"{path}.tmp", 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
+    warm_start_state['snapshots_written'] += 1
+    warm_start_state['last_snapshot_seconds'] = time.monotonic() - started
+    logger.info(f"Saved {len(captured)} tickets to {path} in {warm_start_state['last_snapshot_seconds']:.2f}s.")
+    return True
+
+def load_state_snapshot():
+    """Load the tickets from the warm start snapshot. Returns the snapshot, or None without one."""
+    global tickets
+    path = journal_path(WARM_START_SNAPSHOT_NAME)
+    if not os.path.exists(path):
+        return None
+    started = time.monotonic()
+    gc_enabled = gc.isenabled()
+    gc.disable()  # Millions of new objects, none of them garbage
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+        loaded_tickets = {}
+        for ticket_data in snapshot['tickets']:
+            if 'messages' in ticket_data:
+                ticket_data['messages'] = [restore_message(row) for row in ticket_data['messages']]
+            if ticket_data.get('last_message') is not None:
+                ticket_data['last_message'] = restore_message(ticket_data['last_message'])
+            bump_ticket_version(ticket_data)
+            loaded_tickets[ticket_data['id']] = ticket_data
+        
+        with flush_lock:
+            tickets = loaded_tickets
+            clear_message_cache()
+            persisted_ticket_state.clear()
+            for ticket_data in tickets.values():
+                mark_ticket_persisted(ticket_data, message_count=ticket_data['message_count'])
+            apply_pending_writes()
+            index_loaded_tickets()
+            shared_state['watermark'] = snapshot['watermark']
+    finally:
+        if gc_enabled:
+            gc.enable()
+    
+    warm_start_state['state'] = 'warm'
+    warm_start_state['snapshot_saved_at'] = snapshot['saved_at']
+    warm_start_state['snapshot_load_seconds'] = time.monotonic() - started
+    logger.info(f"Loaded {len(tickets)} tickets from {path} in {warm_start_state['snapshot_load_seconds']:.2f}s.")
+    return snapshot
+
+def catch_up_from_db(watermark, message_watermark):
+    """Refresh the tickets changed in the database since the watermarks. Returns how many."""
+    with flush_writer_lock, flush_lock:
+        # Everything local goes in first, so refreshed tickets include it
+        if not flush_pending_writes():
+            raise Exception("pending writes could not be flushed")
+        
+        changed_ticket_ids = set()
+        query = supabase.table('tickets').select('id')
+        if watermark:
+            since = datetime.fromisoformat(watermark.replace('Z', '+00:00')) - timedelta(seconds=SHARED_STATE_SYNC_OVERLAP)
+            query = query.gt('updated_at', since.isoformat())
+        changed_ticket_ids.update(row['id'] for row in query.execute().data)
+        last_message_id = message_watermark
+        while True:
+            message_rows = supabase.table('messages').select('id,ticket_id').gt('id', last_message_id) \
+                .order('id').limit(WARM_START_PAGE_SIZE).execute().data
+            changed_ticket_ids.update(row['ticket_id'] for row in message_rows)
+            if len(message_rows) < WARM_START_PAGE_SIZE:
+                break
+            last_message_id = message_rows[-1]['id']
+        
+        changed_ticket_ids = sorted(changed_ticket_ids)
+        for start in range(0, len(changed_ticket_ids), ARCHIVE_LOAD_CHUNK):
+            summary_rows = supabase.table('ticket_summaries').select('*') \
+                .in_('id', changed_ticket_ids[start:start + ARCHIVE_LOAD_CHUNK]).execute().data
+            for summary_row in summary_rows:
+                refresh_ticket_from_db(summary_row)
+                if summary_row.get('updated_at') and summary_row['updated_at'] > (shared_state['watermark'] or ''):
+                    shared_state['watermark'] = summary_row['updated_at']
+    return len(changed_ticket_ids)
+
+def warm_start_catch_up_loop(snapshot):
+    """Catch up from the database until it succeeds, then report ready."""
+    while True:
+        warm_start_state['state'] = 'catching-up'
+        started = time.monotonic()
+        try:
+            warm_start_state['caught_up_tickets'] = catch_up_from_db(snapshot['watermark'], snapshot['message_watermark'])
+            break
+        except Exception as e:
+            warm_start_state['state'] = 'warm'
+            warm_start_state['failed_catch_ups'] += 1
+            logger.error(f"Failed to catch up from database: {e}")
+            time.sleep(WRITE_BEHIND_RETRY_DELAY)
+    warm_start_state['catch_up_seconds'] = time.monotonic() - started
+    logger.info(f"Caught up {warm_start_state['caught_up_tickets']} tickets from database in {warm_start_state['catch_up_seconds']:.2f}s.")
+    mark_ready()
+    start_state_snapshots()
+
+def mark_ready():
+    warm_start_state['state'] = 'ready'
+    warm_start_state['ready_after_seconds'] = time.monotonic() - process_started
+
+def state_snapshot_loop():
+    while True:
+        time.sleep(WARM_START_SNAPSHOT_INTERVAL)
+        try:
+            write_state_snapshot()
+        except Exception as e:
+            logger.error(f"Failed to save state snapshot: {e}")
+
+def save_state_snapshot_at_exit():
+    """Leave a fresh snapshot behind on shutdown, so the next start has little to catch up."""
+    if warm_start_state['state'] != 'ready':
+        return  # Never snapshot state that has not caught up
+    try:
+        write_state_snapshot()
+    except Exception as e:
+        logger.error(f"Failed to save state snapshot at exit: {e}")
+
+def start_state_snapshots():
+    if not WARM_START or journal_file is None:
+        return
+    snapshot_thread = threading.Thread(target=state_snapshot_loop, name="state-snapshots")
+    snapshot_thread.daemon = True
+    snapshot_thread.start()
+    atexit.register(save_state_snapshot_at_exit)
+
+def warm_start():
+    """Load the tickets at startup: from the snapshot if there is one, else from the database."""
+    snapshot = None
+    if WARM_START:
+        try:
+            snapshot = load_state_snapshot()
+        except Exception as e:
+            logger.error(f"Failed to load state snapshot, loading from database: {e}")
+    if snapshot is None:
+        load_tickets_from_db()
+        mark_ready()
+        start_state_snapshots()
+        return
+    catch_up_thread = threading.Thread(target=warm_start_catch_up_loop, args=(snapshot,), name="warm-start-catch-up")
+    catch_up_thread.daemon = True
+    catch_up_thread.start()
+
+def get_warm_start_stats():
+    stats = dict(warm_start_state)
+    stats['enabled'] = WARM_START
+    return stats
+
+# Load tickets on startup, including writes a previous process could not flush
+if SHARED_STATE:
+    claim_journal_slot()
+recover_journal()
+warm_start()
+seed_webhook_dedup()
+if SHARED_STATE:
+    start_shared_state_sync()
+start_archiver()
+start_journal_compactor()
+
+# --- Green API Client ---
+# Outbound Green API calls go through a send queue worked by GREEN_API_CONCURRENCY
+# sender threads. Senders share keep-alive connections to api.green-api.com and
+# media.green-api.com, stay within GREEN_API_RATE_LIMIT requests per second, and
+# retry connection errors and 429/5xx responses with exponential backoff. Agent
+# replies are sent ahead of automatic messages. Callers still wait for the result.
+GREEN_API_CONNECT_TIMEOUT = float(os.getenv('GREEN_API_CONNECT_TIMEOUT', '5'))
+GREEN_API_READ_TIMEOUT = float(os.getenv('GREEN_API_READ_TIMEOUT', '30'))
+GREEN_API_UPLOAD_TIMEOUT = float(os.getenv('GREEN_API_UPLOAD_TIMEOUT', '120'))  # Read timeout of file uploads
+GREEN_API_MAX_RETRIES = int(os.getenv('GREEN_API_MAX_RETRIES', '3'))
+GREEN_API_BACKOFF = float(os.getenv('GREEN_API_BACKOFF', '0.5'))  # Seconds before the first retry, doubled for each further one
+GREEN_API_MAX_BACKOFF = 30
+GREEN_API_RATE_LIMIT = float(os.getenv('GREEN_API_RATE_LIMIT', '10'))  # Per process; 0 = unlimited
+GREEN_API_CONCURRENCY = int(os.getenv('GREEN_API_CONCURRENCY', '4'))
+GREEN_API_QUEUE_TIMEOUT = float(os.getenv('GREEN_API_QUEUE_TIMEOUT', '60'))  # Seconds a send may wait for a sender
+GREEN_API_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+PRIORITY_AGENT = 0
+PRIORITY_AUTOMATIC = 1
+
+green_api_session = requests.Session()
+green_api_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max(GREEN_API_CONCURRENCY, 1)))
+green_api_queue = queue.PriorityQueue()
+green_api_sequence = count()  # Keeps sends of equal priority in order
+green_api_senders = []
+green_api_senders_lock = threading.Lock()
+green_api_rate = {'next_slot': 0.0}
+green_api_rate_lock = threading.Lock()
+green_api_stats = {}  # Green API method -> counters
+green_api_stats_lock = threading.Lock()
+
+def start_green_api_senders():
+    """Start the sender threads (once per process)."""
+    with green_api_senders_lock:
+        if green_api_senders:
+            return
+        for sender_index in range(max(GREEN_API_CONCURRENCY, 1)):
+            sender = threading.Thread(target=green_api_sender, name=f"green-api-sender-{sender_index}")
+            sender.daemon = True
+            sender.start()
+            green_api_senders.append(sender)
+
+def green_api_sender():
+    """Perform queued Green API requests, highest priority first."""
+    while True:
+        _, _, job = green_api_queue.get()
+        with green_api_stats_lock:
+            if job['cancelled']:
+                green_api_queue.task_done()
+                continue
+            job['started'].set()
+        try:
+            job['response'] = perform_green_api_request(job['method'], job['url'], job['timeout'], job['kwargs'])
+        except Exception as e:
+            job['error'] = e
+        finally:
+            job['done'].set()
+            green_api_queue.task_done()
+
+def green_api_post(host, method, priority=PRIORITY_AUTOMATIC, read_timeout=GREEN_API_READ_TIMEOUT, **kwargs):
+    """POST to a Green API method through the send queue and return the response.
+
+    Raises if the request fails after all retries or is not started within GREEN_API_QUEUE_TIMEOUT.
+    """
+    start_green_api_senders()
+    started_at = time.monotonic()
+    try:
+        return run_green_api_job(method, host, priority, read_timeout, kwargs)
+    finally:
+        add_trace_call(f"green_api {method}", time.monotonic() - started_at)
+
+def run_green_api_job(method, host, priority, read_timeout, kwargs):
+    """Queue a request for the sender threads and wait for its outcome."""
+    job = {
+        'method': method,
+        'url': green_api_url(host, method),
+        'timeout': (GREEN_API_CONNECT_TIMEOUT, read_timeout),
+        'kwargs': kwargs,
+        'started': threading.Event(),
+        'done': threading.Event(),
+        'cancelled': False,
+        'response': None,
+        'error': None
+    }
+    enqueued_at = time.monotonic()
+    green_api_queue.put((priority, next(green_api_sequence), job))
+    job['started'].wait(GREEN_API_QUEUE_TIMEOUT)
+    with green_api_stats_lock:
+        endpoint_stats = get_endpoint_stats(method)
+        if not job['started'].is_set():
+            job['cancelled'] = True
+            endpoint_stats['queue_timeouts'] += 1
+            raise TimeoutError(f"Green API {method} request not started within {GREEN_API_QUEUE_TIMEOUT}s")
+    record_green_api_queue_wait(method, time.monotonic() - enqueued_at)
+    job['done'].wait()
+    if job['error'] is not None:
+        raise job['error']
+    return job['response']
+
+def reserve_rate_limit_slot():
+    """Reserve the next request slot within GREEN_API_RATE_LIMIT. Returns the seconds to wait for it."""
+    if GREEN_API_RATE_LIMIT <= 0:
+        return 0.0
+    with green_api_rate_lock:
+        now = time.monotonic()
+        slot = max(now, green_api_rate['next_slot'])
+        green_api_rate['next_slot'] = slot + 1 / GREEN_API_RATE_LIMIT
+    return slot - now
+
+def wait_for_rate_limit():
+    """Block until the next request fits within GREEN_API_RATE_LIMIT."""
+    delay = reserve_rate_limit_slot()
+    if delay > 0:
+        time.sleep(delay)
+
+def green_api_url(host, method):
+    return f"https://{host}.green-api.com/waInstance{INSTANCE_ID}/{method}/{API_TOKEN_INSTANCE}"
+
+def green_api_retry_delay(method, attempt, retry_after=None):
+    """Backoff before retry number `attempt` of a Green API call, counted as a retry."""
+    delay = min(max(GREEN_API_BACKOFF * 2 ** (attempt - 1), retry_after or 0), GREEN_API_MAX_BACKOFF)
+    with green_api_stats_lock:
+        get_endpoint_stats(method)['retries'] += 1
+    logger.warning(f"Green API {method} failed, retrying in {delay:.1f}s (attempt {attempt} of {GREEN_API_MAX_RETRIES}).")
+    return delay
+
+def perform_green_api_request(method, url, timeout, kwargs):
+    """POST with retries of connection errors and 429/5xx responses."""
+    attempt = 0
+    while True:
+        wait_for_rate_limit()
+        for _, file_spec in (kwargs.get('files') or {}).items():
+            file_spec[1].seek(0)  # Upload from the start again on retries
+        started_at = time.monotonic()
+        retry_after = None
+        try:
+            response = green_api_session.post(url, timeout=timeout, **kwargs)
+        except requests.exceptions.ConnectionError:
+            record_green_api_call(method, time.monotonic() - started_at, failed=True)
+            if attempt >= GREEN_API_MAX_RETRIES:
+                raise
+        else:
+            failed = response.status_code != 200
+            record_green_api_call(method, time.monotonic() - started_at, failed=failed)
+            if response.status_code not in GREEN_API_RETRY_STATUSES or attempt >= GREEN_API_MAX_RETRIES:
+                return response
+            if response.headers.get('Retry-After', '').isdigit():
+                retry_after = int(response.headers['Retry-After'])
+        
+        attempt += 1
+        time.sleep(green_api_retry_delay(method, attempt, retry_after))
+
+def get_endpoint_stats(method):
+    """Counters of a Green API method. Caller holds green_api_stats_lock."""
+    if method not in green_api_stats:
+        green_api_stats[method] = {
+            'requests': 0,
+            'failed': 0,
+            'retries': 0,
+            'queue_timeouts': 0,
+            'total_latency_seconds': 0.0,
+            'max_latency_seconds': 0.0,
+            'total_queue_wait_seconds': 0.0,
+            'max_queue_wait_seconds': 0.0
+        }
+    return green_api_stats[method]
+
+def record_green_api_queue_wait(method, wait):
+    with green_api_stats_lock:
+        endpoint_stats = get_endpoint_stats(method)
+        endpoint_stats['total_queue_wait_seconds'] += wait
+        endpoint_stats['max_queue_wait_seconds'] = max(endpoint_stats['max_queue_wait_seconds'], wait)
+
+def record_green_api_call(method, latency, failed=False):
+    observe('ticket_system_green_api_request_seconds', latency, method=method)
+    if failed:
+        increment('ticket_system_green_api_errors_total', method=method)
+    with green_api_stats_lock:
+        endpoint_stats = get_endpoint_stats(method)
+        endpoint_stats['requests'] += 1
+        endpoint_stats['failed'] += int(failed)
+        endpoint_stats['total_latency_seconds'] += latency
+        endpoint_stats['max_latency_seconds'] = max(endpoint_stats['max_latency_seconds'], latency)
+
+def get_green_api_stats():
+    """Request counts, latencies and queue waits per Green API method."""
+    with green_api_stats_lock:
+        endpoints = {method: dict(endpoint_stats) for method, endpoint_stats in green_api_stats.items()}
+    for endpoint_stats in endpoints.values():
+        requests_made = endpoint_stats['requests']
+        endpoint_stats['avg_latency_seconds'] = endpoint_stats['total_latency_seconds'] / requests_made if requests_made else 0.0
+    return {
+        'senders': len(green_api_senders),
+        'depth': green_api_queue.qsize(),
+        'rate_limit': GREEN_API_RATE_LIMIT,
+        'endpoints': endpoints
+    }
+
+# --- Media Cache ---
+# Inbound voice notes and files are downloaded in the background as soon as they
+# arrive (Green API download URLs expire) and stored on disk under the SHA-256 of
+# their content, so identical forwards are stored once. blobs/ holds the content,
+# refs/ maps the SHA-256 of a download URL to the content hash. The dashboard plays
+# and downloads media through /ticket/<id>/media/<position>, which supports Range
+# requests. The cache is bounded by MEDIA_CACHE_MAX_BYTES, least recently used first;
+# an evicted blob takes the refs pointing to it along.
+MEDIA_CACHE_DIR = os.path.abspath(os.getenv('MEDIA_CACHE_DIR', 'media_cache'))
+MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+MEDIA_DOWNLOAD_WORKERS = int(os.getenv('MEDIA_DOWNLOAD_WORKERS', '2'))
+MEDIA_DOWNLOAD_TIMEOUT = (5, 60)  # Connect and read timeouts in seconds
+MEDIA_CHUNK_SIZE = 1024 * 1024
+
+media_session = requests.Session()
+media_download_queue = queue.Queue()
+media_downloaders = []
+media_downloads_in_flight = {}  # URL key -> threading.Event set when the download finished
+media_blobs = OrderedDict()  # Content hash -> size in bytes, least recently used first
+media_refs = {}  # URL key -> content hash its ref points to
+media_blob_refs = {}  # Content hash -> URL keys of the refs pointing to it
+media_lock = threading.Lock()
+media_stats = {'hits': 0, 'misses': 0, 'downloads': 0, 'downloaded_bytes': 0, 'deduplicated': 0, 'failed': 0, 'evictions': 0, 'bytes': 0}
+
+def media_url_key(file_url):
+    return hashlib.sha256(file_url.encode('utf-8')).hexdigest()
+
+def media_blob_path(content_hash):
+    return os.path.join(MEDIA_CACHE_DIR, 'blobs', content_hash[:2], content_hash)
+
+def media_ref_path(url_key):
+    return os.path.join(MEDIA_CACHE_DIR, 'refs', url_key)
+
+def load_media_cache():
+    """Index the blobs and refs already on disk, blobs least recently used first, and drop refs to missing blobs."""
+    if os.path.isdir(MEDIA_CACHE_DIR):
+        for file_name in os.listdir(MEDIA_CACHE_DIR):
+            if file_name.startswith('.download-'):
+                os.remove(os.path.join(MEDIA_CACHE_DIR, file_name))  # Interrupted download
+    blobs = []
+    for root, _, file_names in os.walk(os.path.join(MEDIA_CACHE_DIR, 'blobs')):
+        for file_name in file_names:
+            file_stat = os.stat(os.path.join(root, file_name))
+            blobs.append((file_stat.st_mtime, file_name, file_stat.st_size))
+    refs = []
+    refs_dir = os.path.join(MEDIA_CACHE_DIR, 'refs')
+    for url_key in os.listdir(refs_dir) if os.path.isdir(refs_dir) else []:
+        try:
+            with open(media_ref_path(url_key)) as ref_file:
+                refs.append((url_key, ref_file.read().strip()))
+        except OSError:
+            pass
+    with media_lock:
+        media_blobs.clear()
+        media_refs.clear()
+        media_blob_refs.clear()
+        for _, content_hash, size in sorted(blobs):
+            media_blobs[content_hash] = size
+        media_stats['bytes'] = sum(media_blobs.values())
+        for url_key, content_hash in refs:
+            if content_hash in media_blobs and not url_key.endswith('.tmp'):
+                add_media_ref(url_key, content_hash)
+            else:
+                remove_media_file(media_ref_path(url_key))  # Its blob was evicted, or an interrupted write
+    if blobs:
+        logger.info(f"Media cache holds {len(blobs)} files ({media_stats['bytes']} bytes).")
+
+def get_cached_media_path(file_url):
+    """Path of a cached media file, or None."""
+    try:
+        with open(media_ref_path(media_url_key(file_url))) as ref_file:
+            content_hash = ref_file.read().strip()
+    except OSError:
+        return None
+    with media_lock:
+        if content_hash not in media_blobs:
+            return None  # Evicted
+        media_blobs.move_to_end(content_hash)
+    path = media_blob_path(content_hash)
+    try:
+        os.utime(path)  # Keeps the LRU order across restarts
+    except OSError:
+        return None
+    return path
+
+def store_media(file_url, chunks):
+    """Write content to the cache under its hash and point the URL at it. Returns the path."""
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = new_media_temp_file()
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            for chunk in chunks:
+                digest.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return commit_media(file_url, temp_path, digest.hexdigest(), size)
+
+def new_media_temp_file():
+    """Open a temporary file in the cache directory to download into. Returns (fd, path)."""
+    os.makedirs(os.path.join(MEDIA_CACHE_DIR, 'refs'), exist_ok=True)
+    return tempfile.mkstemp(dir=MEDIA_CACHE_DIR, prefix='.download-')
+
+def commit_media(file_url, temp_path, content_hash, size):
+    """Move a downloaded temporary file into the cache under its hash and point the URL at it. Returns the path."""
+    path = media_blob_path(content_hash)
+    try:
+        with media_lock:
+            duplicate = content_hash in media_blobs
+            if not duplicate:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+                media_blobs[content_hash] = size
+                media_stats['bytes'] += size
+            else:
+                media_blobs.move_to_end(content_hash)
+                media_stats['deduplicated'] += 1
+            # The ref is written under the lock, so the blob cannot be evicted without it
+            url_key = media_url_key(file_url)
+            ref_temp_path = media_ref_path(url_key) + '.tmp'
+            with open(ref_temp_path, 'w') as ref_file:
+                ref_file.write(content_hash)
+            os.replace(ref_temp_path, media_ref_path(url_key))
+            add_media_ref(url_key, content_hash)
+            evict_media(keep=content_hash)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path
 
-def load_tickets_from_db():
-    """Load all tickets and messages from Supabase database."""
-    global tickets, open_tickets_by_sender, next_ticket_id
+def evict_media(keep=None):
+    """Delete least recently used blobs until the cache is within budget. Caller holds media_lock."""
+    for content_hash in list(media_blobs):
+        if media_stats['bytes'] <= MEDIA_CACHE_MAX_BYTES:
+            break
+        if content_hash == keep:
+            continue
+        remove_media_file(media_blob_path(content_hash))
+        for url_key in media_blob_refs.pop(content_hash, ()):
+            del media_refs[url_key]
+            remove_media_file(media_ref_path(url_key))
+        media_stats['bytes'] -= media_blobs.pop(content_hash)
+        media_stats['evictions'] += 1
+
+def add_media_ref(url_key, content_hash):
+    """Register the ref of a URL, replacing where it pointed before. Caller holds media_lock."""
+    previous_hash = media_refs.get(url_key)
+    if previous_hash is not None:
+        media_blob_refs[previous_hash].discard(url_key)
+    media_refs[url_key] = content_hash
+    media_blob_refs.setdefault(content_hash, set()).add(url_key)
+
+def remove_media_file(path):
     try:
-        # Load tickets
-        tickets_result = supabase.table('tickets').select('*').execute()
-        
-        # Load messages
-        messages_result = supabase.table('messages').select('*').order('timestamp').execute()
-        
-        # Reset in-memory storage
-        tickets = {}
-        open_tickets_by_sender = {}
-        
-        # Process tickets
-        for ticket_row in tickets_result.data:
-            ticket_id = ticket_row['id']
-            tickets[ticket_id] = {
-                'id': ticket_id,
-                'sender_id': ticket_row['sender_id'],
-                'sender_name': ticket_row['sender_name'],
-                'status': ticket_row['status'],
-                'created_at': ticket_row['created_at'],
-                'admin_notes': ticket_row.get('admin_notes', ''),
-                'messages': []
-            }
-            
-            # Track open tickets
-            if ticket_row['status'] == 'open':
-                open_tickets_by_sender[ticket_row['sender_id']] = ticket_id
-        
-        # Process messages
-        for message_row in messages_result.data:
-            ticket_id = message_row['ticket_id']
-            if ticket_id in tickets:
-                message_data = {
-                    'author': message_row['author'],
-                    'message_type': message_row.get('message_type', 'text'),
-                    'text': message_row.get('text'),
-                    'timestamp': message_row['timestamp']
-                }
-                
-                # Add media fields if they exist
-                if message_row.get('file_url'):
-                    message_data.update({
-                        'file_url': message_row['file_url'],
-                        'file_name': message_row.get('file_name'),
-                        'file_size': message_row.get('file_size'),
-                        'duration': message_row.get('duration'),
-                        'mime_type': message_row.get('mime_type'),
-                        'metadata': message_row.get('metadata')
-                    })
-                
-                tickets[ticket_id]['messages'].append(message_data)
-        
-        # Calculate next ticket ID
-        if tickets:
-            max_id = max([int(tid[1:]) for tid in tickets.keys() if tid.startswith('T')])
-            next_ticket_id = max_id + 1
-        else:
-            next_ticket_id = 1
-            
-        logger.info(f"Loaded {len(tickets)} tickets from database.")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to load tickets from database: {e}")
-        # Fallback to JSON file if database fails
-        return load_tickets_from_json()
+        os.remove(path)
+    except OSError:
+        pass
 
-def load_tickets_from_json():
-    """Fallback: Load tickets from JSON file."""
-    global tickets, open_tickets_by_sender, next_ticket_id
+def download_media(file_url):
+    """Download a media file into the cache, unless another thread already is. Returns the path or None."""
+    url_key = media_url_key(file_url)
+    in_flight = claim_media_download(url_key)
+    if in_flight is not None:
+        in_flight.wait(MEDIA_DOWNLOAD_TIMEOUT[1])
+        return get_cached_media_path(file_url)
+    
     try:
-        if os.path.exists(TICKETS_FILE):
-            with open(TICKETS_FILE, 'r') as f:
-                data = json.load(f)
-            tickets = data.get('tickets', {})
-            open_tickets_by_sender = data.get('open_tickets_by_sender', {})
-            next_ticket_id = data.get('next_ticket_id', 1)
-            logger.info(f"Loaded {len(tickets)} tickets from JSON file (fallback).")
+        path = get_cached_media_path(file_url)
+        if path is not None:
+            return path
+        started_at = time.monotonic()
+        try:
+            with media_session.get(file_url, stream=True, timeout=MEDIA_DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                path = store_media(file_url, response.iter_content(chunk_size=MEDIA_CHUNK_SIZE))
+        except Exception as e:
+            logger.error(f"Failed to download media {file_url}: {e}")
+            record_media_download(time.monotonic() - started_at)
+            return None
+        record_media_download(time.monotonic() - started_at, os.path.getsize(path))
+        return path
+    finally:
+        release_media_download(url_key)
+
+def claim_media_download(url_key):
+    """Mark a download as in flight. Returns the Event of the download already in flight instead, if any."""
+    with media_lock:
+        in_flight = media_downloads_in_flight.get(url_key)
+        if in_flight is None:
+            media_downloads_in_flight[url_key] = threading.Event()
+    return in_flight
+
+def release_media_download(url_key):
+    with media_lock:
+        media_downloads_in_flight.pop(url_key).set()
+
+def record_media_download(elapsed, size=None):
+    """Account for a download that took `elapsed` seconds; a size of None means it failed."""
+    observe('ticket_system_media_download_seconds', elapsed)
+    add_trace_call('media download', elapsed)
+    with media_lock:
+        if size is None:
+            media_stats['failed'] += 1
         else:
-            logger.info("No existing tickets file found. Starting with empty data.")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to load tickets from JSON file: {e}")
-        tickets = {}
-        open_tickets_by_sender = {}
-        next_ticket_id = 1
-        return False
+            media_stats['downloads'] += 1
+            media_stats['downloaded_bytes'] += size
+
+def start_media_downloaders():
+    """Start the background download threads (once per process)."""
+    with media_lock:
+        if media_downloaders:
+            return
+        for downloader_index in range(max(MEDIA_DOWNLOAD_WORKERS, 1)):
+            downloader = threading.Thread(target=media_downloader, name=f"media-downloader-{downloader_index}")
+            downloader.daemon = True
+            downloader.start()
+            media_downloaders.append(downloader)
+
+def media_downloader():
+    while True:
+        file_url = media_download_queue.get()
+        try:
+            download_media(file_url)
+        finally:
+            media_download_queue.task_done()
 
-# --- Legacy JSON Functions (keeping as backup) ---
-def save_tickets():
-    """Save tickets and related data to JSON file (backup)."""
+def queue_media_download(file_url):
+    """Download an inbound media file in the background."""
+    if not file_url:
+        return
+    start_media_downloaders()
+    media_download_queue.put(file_url)
+
+def cache_media_file(file_url, file_path):
+    """Store a local copy of a media file, e.g. one we just uploaded."""
+    if not file_url:
+        return
     try:
-        data = {
-            'tickets': tickets,
-            'open_tickets_by_sender': open_tickets_by_sender,
-            'next_ticket_id': next_ticket_id
-        }
-        with open(TICKETS_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
-        logger.debug(f"Tickets backed up to JSON file. Total tickets: {len(tickets)}")
+        with open(file_path, 'rb') as media_file:
+            store_media(file_url, iter(lambda: media_file.read(MEDIA_CHUNK_SIZE), b''))
     except Exception as e:
-        logger.error(f"Failed to backup tickets to JSON file: {e}")
+        logger.error(f"Failed to cache media file {file_path}: {e}")
 
-# Load tickets from database on startup
-load_tickets_from_db()
+def get_media(file_url):
+    """Path of a media file in the cache, downloading it if needed. None if it cannot be fetched."""
+    path = get_cached_media_path(file_url)
+    with media_lock:
+        media_stats['hits' if path else 'misses'] += 1
+    return path or download_media(file_url)
+
+def get_media_cache_stats():
+    with media_lock:
+        stats = dict(media_stats)
+        stats['files'] = len(media_blobs)
+        stats['refs'] = len(media_refs)
+        stats['downloads_in_flight'] = len(media_downloads_in_flight)
+    stats['queued'] = media_download_queue.qsize()
+    stats['max_bytes'] = MEDIA_CACHE_MAX_BYTES
+    return stats
+
+load_media_cache()
 
 # --- Green API Communication & Ticket Management ---
+def create_ticket(sender, sender_name, first_message):
+    """Open a new ticket for a sender, starting with the given message. Caller holds the sender's lock.
+
+    Returns None if another worker already opened a ticket for the sender; that
+    ticket is then loaded and registered as the sender's open ticket. Raises if
+    the database refused the ticket but the other one could not be adopted, so
+    the webhook fails instead of buffering a row the database rejects.
+    """
+    ticket_id = allocate_ticket_id()
+    ticket_data = {
+        'id': ticket_id,
+        'sender_id': sender,
+        'sender_name': sender_name,
+        'status': 'open',
+        'created_at': datetime.now().isoformat(),
+        'admin_notes': "",
+        'messages': [compact_message(first_message)]
+    }
+    ticket_data.update(summarize_messages(ticket_data['messages']))
+    bump_ticket_version(ticket_data)
+    claimed = claim_open_ticket(ticket_data) if SHARED_STATE else None
+    attempts = 1
+    while claimed is False:
+        adopted = adopt_open_ticket(sender)
+        if adopted:
+            logger.info(f"Sender {sender} already has an open ticket opened by another worker.")
+            return None
+        if adopted is None or attempts >= TICKET_CLAIM_ATTEMPTS:
+            # Buffering the ticket would only have the database reject it again
+            raise Exception(f"could not open or adopt a ticket for sender {sender}")
+        claimed = claim_open_ticket(ticket_data)  # Closed meanwhile
+        attempts += 1
+        if claimed is None:
+            raise Exception(f"could not open a ticket for sender {sender}: database unreachable")
+    if claimed:
+        # The ticket row is in the database, its messages are not yet
+        mark_ticket_persisted(ticket_data, message_count=0)
+    else:
+        # Nothing of a new ticket is in the database yet
+        mark_ticket_persisted(ticket_data, record={}, message_count=0)
+    tickets[ticket_id] = ticket_data
+    open_tickets_by_sender[sender] = ticket_id
+    index_ticket(ticket_data)
+    index_ticket_for_search(ticket_data)
+    index_messages_for_search(ticket_id, 0, ticket_data['messages'])
+    cache_ticket_messages(ticket_id)
+    publish_event('ticket-created', ticket_id)
+    logger.info(f"Created new ticket {ticket_id} for sender {sender}.")
+    return ticket_id
+
+def close_ticket(ticket_id):
+    """Close an open ticket. Returns False if it is already closed."""
+    with ticket_lock(ticket_id):
+        ticket_data = tickets[ticket_id]
+        if ticket_data['status'] == 'closed':
+            return False
+        set_ticket_status(ticket_data, 'closed')
+        if open_tickets_by_sender.get(ticket_data['sender_id']) == ticket_id:
+            del open_tickets_by_sender[ticket_data['sender_id']]
+        return True
+
 def send_whatsapp_message(chat_id, text, ticket_id=None, author="Agent"):
     """Sends a WhatsApp message and logs it to the ticket history if a ticket_id is provided."""
     try:
-        url = f"https://api.green-api.com/waInstance{INSTANCE_ID}/sendMessage/{API_TOKEN_INSTANCE}"
         payload = {
             "chatId": chat_id,
             "message": text
         }
-        headers = {
-            "Content-Type": "application/json"
-        }
+        priority = PRIORITY_AGENT if author == "Agent" else PRIORITY_AUTOMATIC
         
         logger.info(f"Attempting to send message to {chat_id}: {text}")
-        response = requests.post(url, json=payload, headers=headers)
+        response = green_api_post('api', 'sendMessage', priority=priority, json=payload)
         
         if response.status_code == 200:
-            logger.info(f"Message sent successfully to {chat_id}.")
-            
-            # Add message to ticket history if ticket_id is provided
-            if ticket_id and ticket_id in tickets:
-                message_entry = {
-                    "author": author,
-                    "text": text,
-                    "message_type": "text",
-                    "timestamp": datetime.now().isoformat()
-                }
-                tickets[ticket_id]["messages"].append(message_entry)
-                logger.info(f"Message from '{author}' saved to ticket {ticket_id}.")
-                
-                # Save to database
-                save_ticket_to_db(tickets[ticket_id])
+            record_sent_message(chat_id, text, ticket_id, author)
         else:
             logger.error(f"Failed to send message to {chat_id}. Status: {response.status_code}, Response: {response.text}")
     except Exception as e:
         logger.error(f"Error sending message to {chat_id}: {e}")
 
+def record_sent_message(chat_id, text, ticket_id, author):
+    """Add a message that was sent to the ticket history if a ticket_id is provided, and save the ticket."""
+    logger.info(f"Message sent successfully to {chat_id}.")
+    if ticket_id and ticket_id in tickets:
+        message_entry = {
+            "author": author,
+            "text": text,
+            "message_type": "text",
+            "timestamp": datetime.now().isoformat()
+        }
+        append_message(ticket_id, message_entry)
+        logger.info(f"Message from '{author}' saved to ticket {ticket_id}.")
+        
+        # Save to database
+        save_ticket_to_db(tickets[ticket_id])
+
 def send_whatsapp_file(chat_id, file_path, file_name, caption="", ticket_id=None, author="Agent"):
     """Sends a file via WhatsApp using Green API's SendFileByUpload method."""
     try:
-        # Use media host for file uploads
-        url = f"https://media.green-api.com/waInstance{INSTANCE_ID}/sendFileByUpload/{API_TOKEN_INSTANCE}"
-        
         # Prepare the file for upload
         with open(file_path, 'rb') as file:
             files = {
@@ -265,42 +3692,13 @@ def send_whatsapp_file(chat_id, file_path, file_name, caption="", ticket_id=None
                 data['caption'] = caption
             
             logger.info(f"Attempting to send file to {chat_id}: {file_name}")
-            response = requests.post(url, files=files, data=data)
+            # Use media host for file uploads
+            priority = PRIORITY_AGENT if author == "Agent" else PRIORITY_AUTOMATIC
+            response = green_api_post('media', 'sendFileByUpload', priority=priority,
+                                      read_timeout=GREEN_API_UPLOAD_TIMEOUT, files=files, data=data)
             
             if response.status_code == 200:
-                result = response.json()
-                logger.info(f"File sent successfully to {chat_id}. File URL: {result.get('urlFile', 'N/A')}")
-                
-                # Add file message to ticket history if ticket_id is provided
-                if ticket_id and ticket_id in tickets:
-                    # Determine message type based on file extension
-                    file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
-                    if file_ext in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
-                        message_type = 'image'
-                    elif file_ext in ['mp4', 'avi', 'mov', 'mkv', 'webm']:
-                        message_type = 'video'
-                    elif file_ext in ['mp3', 'wav', 'ogg', 'aac', 'm4a']:
-                        message_type = 'audio'
-                    else:
-                        message_type = 'document'
-                    
-                    message_entry = {
-                        "author": author,
-                        "text": caption or f"Sent {message_type}: {file_name}",
-                        "message_type": message_type,
-                        "file_url": result.get('urlFile'),
-                        "file_name": file_name,
-                        "file_size": os.path.getsize(file_path) if os.path.exists(file_path) else None,
-                        "mime_type": f"{message_type}/*",
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    tickets[ticket_id]["messages"].append(message_entry)
-                    logger.info(f"File message from '{author}' saved to ticket {ticket_id}.")
-                    
-                    # Save to database
-                    save_ticket_to_db(tickets[ticket_id])
-                
-                return result
+                return record_sent_file(chat_id, response.json(), file_path, file_name, caption, ticket_id, author)
             else:
                 logger.error(f"Failed to send file to {chat_id}. Status: {response.status_code}, Response: {response.text}")
                 return None
@@ -308,185 +3706,665 @@ def send_whatsapp_file(chat_id, file_path, file_name, caption="", ticket_id=None
         logger.error(f"Error sending file to {chat_id}: {e}")
         return None
 
-def convert_audio_to_mp3(input_file_path, output_file_path):
-    """Convert audio file to MP3 format using ffmpeg for better WhatsApp compatibility."""
-    try:
-        # Check if ffmpeg is available
-        result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
-        if result.returncode != 0:
-            logger.warning("ffmpeg not found. Audio conversion skipped.")
-            return False
+def record_sent_file(chat_id, result, file_path, file_name, caption, ticket_id, author):
+    """Add a file that was sent to the ticket history if a ticket_id is provided, and save the ticket.
+
+    Returns the Green API result.
+    """
+    logger.info(f"File sent successfully to {chat_id}. File URL: {result.get('urlFile', 'N/A')}")
+    if ticket_id and ticket_id in tickets:
+        # Determine message type based on file extension
+        file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
+        if file_ext in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
+            message_type = 'image'
+        elif file_ext in ['mp4', 'avi', 'mov', 'mkv', 'webm']:
+            message_type = 'video'
+        elif file_ext in ['mp3', 'wav', 'ogg', 'aac', 'm4a']:
+            message_type = 'audio'
+        else:
+            message_type = 'document'
         
-        # Convert audio to MP3 with WhatsApp-compatible settings
-        cmd = [
-            'ffmpeg', '-i', input_file_path,
-            '-acodec', 'mp3',
-            '-ab', '128k',  # 128kbps bitrate
-            '-ar', '44100',  # 44.1kHz sample rate
-            '-ac', '1',      # Mono audio (WhatsApp prefers mono for voice messages)
-            '-y',            # Overwrite output file
-            output_file_path
-        ]
+        message_entry = {
+            "author": author,
+            "text": caption or f"Sent {message_type}: {file_name}",
+            "message_type": message_type,
+            "file_url": result.get('urlFile'),
+            "file_name": file_name,
+            "file_size": os.path.getsize(file_path) if os.path.exists(file_path) else None,
+            "mime_type": f"{message_type}/*",
+            "timestamp": datetime.now().isoformat()
+        }
+        cache_media_file(result.get('urlFile'), file_path)
+        append_message(ticket_id, message_entry)
+        logger.info(f"File message from '{author}' saved to ticket {ticket_id}.")
         
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
-            logger.info(f"Audio converted successfully: {input_file_path} -> {output_file_path}")
-            return True
+        # Save to database
+        save_ticket_to_db(tickets[ticket_id])
+    return result
+
+# --- Audio Transcoding ---
+# ffmpeg runs with one thread per job and at most TRANSCODE_WORKERS jobs at a time
+# (one core is left for serving requests). Audio is piped through stdin/stdout,
+# results are cached by input hash, and a job that cannot start within
+# TRANSCODE_QUEUE_TIMEOUT seconds is given up, so bursts cannot pile up processes.
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', str(max((os.cpu_count() or 2) - 1, 1))))
+TRANSCODE_QUEUE_TIMEOUT = float(os.getenv('TRANSCODE_QUEUE_TIMEOUT', '30'))
+TRANSCODE_TIMEOUT = float(os.getenv('TRANSCODE_TIMEOUT', '120'))  # Seconds an ffmpeg run may take
+TRANSCODE_CACHE_MAX_BYTES = int(os.getenv('TRANSCODE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+TRANSCODE_PROFILES = {
+    # WhatsApp-compatible MP3: 128kbps, 44.1kHz, mono (WhatsApp prefers mono for voice messages)
+    'mp3': ['-acodec', 'mp3', '-ab', '128k', '-ar', '44100', '-ac', '1', '-f', 'mp3']
+}
+
+transcode_slots = threading.BoundedSemaphore(max(TRANSCODE_WORKERS, 1))
+transcode_cache = OrderedDict()  # (input hash, profile) -> output bytes, least recently used first
+transcode_lock = threading.Lock()
+transcode_state = {'ffmpeg_available': None}
+transcode_stats = {
+    'jobs': 0,
+    'cache_hits': 0,
+    'failed': 0,
+    'queue_timeouts': 0,
+    'waiting': 0,
+    'running': 0,
+    'cache_bytes': 0,
+    'total_wait_seconds': 0.0,
+    'max_wait_seconds': 0.0,
+    'total_run_seconds': 0.0,
+    'max_run_seconds': 0.0
+}
+
+def ffmpeg_available():
+    """Whether ffmpeg can be run; probed once per process."""
+    with transcode_lock:
+        if transcode_state['ffmpeg_available'] is None:
+            try:
+                result = subprocess.run(['ffmpeg', '-version'], capture_output=True, timeout=10)
+                transcode_state['ffmpeg_available'] = result.returncode == 0
+            except (OSError, subprocess.SubprocessError):
+                transcode_state['ffmpeg_available'] = False
+            if not transcode_state['ffmpeg_available']:
+                logger.warning("ffmpeg not found. Audio conversion skipped.")
+        return transcode_state['ffmpeg_available']
+
+def lookup_transcode(input_data, profile):
+    """Cache key of a transcoding job, and its output if cached."""
+    cache_key = (hashlib.sha256(input_data).hexdigest(), profile)
+    with transcode_lock:
+        if cache_key in transcode_cache:
+            transcode_cache.move_to_end(cache_key)
+            transcode_stats['cache_hits'] += 1
+            return cache_key, transcode_cache[cache_key]
+    return cache_key, None
+
+def transcode_command(profile):
+    return ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-threads', '1', '-i', 'pipe:0'] + TRANSCODE_PROFILES[profile] + ['pipe:1']
+
+def start_transcode_wait():
+    with transcode_lock:
+        transcode_stats['waiting'] += 1
+
+def finish_transcode_wait(wait, acquired):
+    """Account for a job that got a slot after `wait` seconds, or gave up waiting."""
+    with transcode_lock:
+        transcode_stats['waiting'] -= 1
+        if not acquired:
+            transcode_stats['queue_timeouts'] += 1
         else:
-            logger.error(f"Audio conversion failed: {result.stderr}")
-            return False
-            
+            transcode_stats['running'] += 1
+            transcode_stats['total_wait_seconds'] += wait
+            transcode_stats['max_wait_seconds'] = max(transcode_stats['max_wait_seconds'], wait)
+    if not acquired:
+        logger.warning(f"Audio conversion not started within {TRANSCODE_QUEUE_TIMEOUT}s; too many conversions queued.")
+
+def finish_transcode(cache_key, output_data, run_time):
+    """Account for a finished ffmpeg run and cache its output."""
+    observe('ticket_system_transcode_seconds', run_time, profile=cache_key[1])
+    add_trace_call(f"ffmpeg {cache_key[1]}", run_time)
+    with transcode_lock:
+        transcode_stats['running'] -= 1
+        transcode_stats['jobs'] += 1
+        transcode_stats['failed'] += int(output_data is None)
+        transcode_stats['total_run_seconds'] += run_time
+        transcode_stats['max_run_seconds'] = max(transcode_stats['max_run_seconds'], run_time)
+    
+    if output_data is not None and len(output_data) <= TRANSCODE_CACHE_MAX_BYTES:
+        with transcode_lock:
+            if cache_key not in transcode_cache:
+                transcode_cache[cache_key] = output_data
+                transcode_stats['cache_bytes'] += len(output_data)
+            while transcode_stats['cache_bytes'] > TRANSCODE_CACHE_MAX_BYTES:
+                _, evicted = transcode_cache.popitem(last=False)
+                transcode_stats['cache_bytes'] -= len(evicted)
+
+def transcode_audio(input_data, profile='mp3'):
+    """Transcode audio bytes with ffmpeg. Returns the output bytes, or None if that is not possible."""
+    cache_key, output_data = lookup_transcode(input_data, profile)
+    if output_data is not None:
+        return output_data
+    if not ffmpeg_available():
+        return None
+    
+    enqueued_at = time.monotonic()
+    start_transcode_wait()
+    acquired = transcode_slots.acquire(timeout=TRANSCODE_QUEUE_TIMEOUT)
+    finish_transcode_wait(time.monotonic() - enqueued_at, acquired)
+    if not acquired:
+        return None
+    
+    started_at = time.monotonic()
+    try:
+        process = subprocess.Popen(transcode_command(profile), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = process.communicate(input_data, timeout=TRANSCODE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            logger.error(f"Audio conversion timed out after {TRANSCODE_TIMEOUT}s.")
+        else:
+            if process.returncode == 0 and stdout:
+                output_data = stdout
+            else:
+                logger.error(f"Audio conversion failed: {stderr.decode('utf-8', 'replace')}")
     except Exception as e:
         logger.error(f"Error during audio conversion: {e}")
+    finally:
+        transcode_slots.release()
+        finish_transcode(cache_key, output_data, time.monotonic() - started_at)
+    return output_data
+
+def get_transcode_stats():
+    with transcode_lock:
+        stats = dict(transcode_stats)
+    stats['workers'] = TRANSCODE_WORKERS
+    stats['ffmpeg_available'] = transcode_state['ffmpeg_available']
+    stats['avg_run_seconds'] = stats['total_run_seconds'] / stats['jobs'] if stats['jobs'] else 0.0
+    return stats
+
+# --- Voice Transcription ---
+# Voice notes stored with metadata.transcription_status 'pending' are picked up
+# from the database, grouped into batches of up to TRANSCRIPTION_BATCH_SECONDS of
+# audio and transcribed by TRANSCRIPTION_WORKERS threads using the engine named by
+# TRANSCRIPTION_ENGINE. Results go to voice_transcriptions and the messages'
+# metadata in bulk. Engines take a list of jobs ({'audio': bytes, 'mime_type',
+# 'duration'}) and return one {'text', 'confidence', 'language'} dict, or None if a
+# job could not be transcribed, per job. With SHARED_STATE only worker 0 transcribes.
+TRANSCRIPTION_ENGINE = os.getenv('TRANSCRIPTION_ENGINE', '')  # '' disables transcription
+TRANSCRIPTION_WORKERS = int(os.getenv('TRANSCRIPTION_WORKERS', '2'))
+TRANSCRIPTION_BATCH_SECONDS = int(os.getenv('TRANSCRIPTION_BATCH_SECONDS', '300'))
+TRANSCRIPTION_POLL_INTERVAL = float(os.getenv('TRANSCRIPTION_POLL_INTERVAL', '15'))
+TRANSCRIPTION_FETCH_LIMIT = 100
+WHISPER_MODEL = os.getenv('WHISPER_MODEL', 'base')
+
+transcription_queue = queue.Queue(maxsize=max(TRANSCRIPTION_WORKERS, 1))  # Batches; full means all workers are busy
+transcription_in_flight = set()  # Message IDs queued or being transcribed
+transcription_lock = threading.Lock()
+transcription_wakeup = threading.Event()
+transcription_state = {'whisper_model': None}
+transcription_stats = {'batches': 0, 'transcribed': 0, 'failed': 0, 'audio_seconds': 0.0, 'engine_seconds': 0.0}
+
+def transcribe_with_stub(jobs):
+    """Placeholder engine for development and tests."""
+    return [{'text': f"[Voice message, {job['duration']}s]", 'confidence': 0.0, 'language': 'en'} for job in jobs]
+
+def transcribe_with_whisper(jobs):
+    """Local, offline transcription with faster-whisper (pip install faster-whisper)."""
+    with transcription_lock:
+        if transcription_state['whisper_model'] is None:
+            from faster_whisper import WhisperModel
+            transcription_state['whisper_model'] = WhisperModel(WHISPER_MODEL, device='cpu', compute_type='int8')
+        model = transcription_state['whisper_model']
+    results = []
+    for job in jobs:
+        try:
+            segments, info = model.transcribe(io.BytesIO(job['audio']))
+            segments = list(segments)
+            confidence = sum(math.exp(segment.avg_logprob) for segment in segments) / len(segments) if segments else 0.0
+            results.append({
+                'text': ' '.join(segment.text.strip() for segment in segments),
+                'confidence': confidence,
+                'language': info.language
+            })
+        except Exception as e:
+            logger.error(f"Whisper could not transcribe a voice message: {e}")
+            results.append(None)
+    return results
+
+TRANSCRIPTION_ENGINES = {
+    'stub': transcribe_with_stub,
+    'whisper': transcribe_with_whisper
+}
+
+def fetch_pending_transcriptions():
+    """Stored voice messages still waiting for a transcription, oldest first."""
+    result = supabase.table('messages').select('*') \
+        .eq('message_type', 'audio') \
+        .eq('metadata->>transcription_status', 'pending') \
+        .order('id') \
+        .limit(TRANSCRIPTION_FETCH_LIMIT) \
+        .execute()
+    with transcription_lock:
+        return [row for row in result.data if row['id'] not in transcription_in_flight and row.get('file_url')]
+
+def batch_by_duration(rows):
+    """Group message rows into batches of up to TRANSCRIPTION_BATCH_SECONDS of audio."""
+    batches = []
+    batch, batch_seconds = [], 0
+    for row in rows:
+        duration = row.get('duration') or 0
+        if batch and batch_seconds + duration > TRANSCRIPTION_BATCH_SECONDS:
+            batches.append(batch)
+            batch, batch_seconds = [], 0
+        batch.append(row)
+        batch_seconds += duration
+    if batch:
+        batches.append(batch)
+    return batches
+
+def transcription_poller():
+    """Feed pending voice messages to the transcription workers."""
+    while True:
+        try:
+            rows = fetch_pending_transcriptions()
+        except Exception as e:
+            logger.error(f"Failed to fetch pending voice transcriptions: {e}")
+            rows = []
+        for batch in batch_by_duration(rows):
+            with transcription_lock:
+                transcription_in_flight.update(row['id'] for row in batch)
+            transcription_queue.put(batch)  # Blocks while all workers are busy
+        if len(rows) < TRANSCRIPTION_FETCH_LIMIT:
+            transcription_wakeup.wait(TRANSCRIPTION_POLL_INTERVAL)
+            transcription_wakeup.clear()
+
+def transcription_worker():
+    while True:
+        batch = transcription_queue.get()
+        try:
+            transcribe_batch(batch)
+        except Exception as e:
+            logger.error(f"Error transcribing voice messages: {e}", exc_info=True)
+        finally:
+            with transcription_lock:
+                transcription_in_flight.difference_update(row['id'] for row in batch)
+            transcription_queue.task_done()
+
+def transcribe_batch(rows):
+    """Transcribe a batch of voice message rows and store the results."""
+    jobs, job_rows, results = [], [], {}
+    for row in rows:
+        path = get_media(row['file_url'])
+        if path is None:
+            results[row['id']] = None  # Audio is gone
+            continue
+        with open(path, 'rb') as audio_file:
+            jobs.append({'audio': audio_file.read(), 'mime_type': row.get('mime_type'), 'duration': row.get('duration') or 0})
+        job_rows.append(row)
+    
+    started_at = time.monotonic()
+    if jobs:
+        for row, result in zip(job_rows, TRANSCRIPTION_ENGINES[TRANSCRIPTION_ENGINE](jobs)):
+            results[row['id']] = result
+    engine_seconds = time.monotonic() - started_at
+    
+    transcription_rows, message_rows = [], []
+    for row in rows:
+        result = results.get(row['id'])
+        metadata = dict(row.get('metadata') or {})
+        if result is None:
+            metadata['transcription_status'] = 'failed'
+        else:
+            metadata.update({
+                'transcription_status': 'completed',
+                'transcription': result['text'],
+                'transcription_confidence': round(result['confidence'], 2)
+            })
+            transcription_rows.append({
+                'message_id': row['id'],
+                'transcription_text': result['text'],
+                'confidence_score': round(result['confidence'], 2),
+                'language_code': result.get('language') or 'en',
+                'transcription_service': TRANSCRIPTION_ENGINE
+            })
+        message_rows.append(dict(row, metadata=metadata))
+    if transcription_rows:
+        supabase.table('voice_transcriptions').upsert(transcription_rows, on_conflict='message_id').execute()
+    supabase.table('messages').upsert(message_rows).execute()
+    
+    for row in message_rows:
+        apply_transcription(row)
+    with transcription_lock:
+        transcription_stats['batches'] += 1
+        transcription_stats['transcribed'] += len(transcription_rows)
+        transcription_stats['failed'] += len(rows) - len(transcription_rows)
+        transcription_stats['audio_seconds'] += sum(job['duration'] for job in jobs)
+        transcription_stats['engine_seconds'] += engine_seconds
+    logger.info(f"Transcribed {len(transcription_rows)} of {len(rows)} voice messages.")
+
+def apply_transcription(message_row):
+    """Update the in-memory copy of a transcribed voice message."""
+    ticket_data = tickets.get(message_row['ticket_id'])
+    if ticket_data is None:
+        return
+    with message_cache_lock:
+        messages = ticket_data.get('messages') or []
+        for position, message in enumerate(messages):
+            if message.get('file_url') == message_row['file_url'] and message['timestamp'] == message_row['timestamp']:
+                messages[position] = message.replace(metadata=message_row['metadata'])
+                break
+        else:
+            return  # Not resident; loaded with the transcription later
+        bump_ticket_version(ticket_data)
+    publish_event('message-updated', ticket_data['id'], position=position)
+
+def start_transcription():
+    """Start the transcription poller and workers if an engine is configured."""
+    if not TRANSCRIPTION_ENGINE:
+        return
+    if TRANSCRIPTION_ENGINE not in TRANSCRIPTION_ENGINES:
+        logger.error(f"Unknown TRANSCRIPTION_ENGINE '{TRANSCRIPTION_ENGINE}'; voice messages will not be transcribed.")
+        return
+    if SHARED_STATE and shared_state['slot'] != 0:
+        return
+    threads = [threading.Thread(target=transcription_poller, name='transcription-poller')]
+    threads += [threading.Thread(target=transcription_worker, name=f"transcription-worker-{worker_index}")
+                for worker_index in range(max(TRANSCRIPTION_WORKERS, 1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    logger.info(f"Transcribing voice messages with the '{TRANSCRIPTION_ENGINE}' engine.")
+
+def get_transcription_stats():
+    with transcription_lock:
+        stats = dict(transcription_stats)
+        stats['in_flight'] = len(transcription_in_flight)
+    stats['engine'] = TRANSCRIPTION_ENGINE or None
+    return stats
+
+start_transcription()
+
+# --- Webhook Ingestion Queue ---
+# Webhooks are acknowledged as soon as they are queued and processed by a pool of
+# worker threads. Each sender is pinned to one worker, so messages from the same
+# chat are handled strictly in order while different chats proceed concurrently.
+# Set WEBHOOK_WORKERS=0 to process webhooks inline within the request.
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))  # Per worker
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '10'))  # Seconds to finish queued work on shutdown
+WEBHOOK_MESSAGE_TYPES = ('textMessage', 'audioMessage', 'imageMessage', 'videoMessage', 'documentMessage')  # Handled types
+
+webhook_queues = []
+webhook_workers_lock = threading.Lock()
+webhook_stats_lock = threading.Lock()
+webhook_queue_stats = {
+    'enqueued': 0,
+    'processed': 0,
+    'failed': 0,
+    'rejected': 0,
+    'in_flight': 0,
+    'pending': 0,  # Accepted by the async server (async_main.py) and not started yet
+    'total_wait_seconds': 0.0,
+    'max_wait_seconds': 0.0
+}
+
+def get_webhook_sender(data):
+    """Extract the chat ID a webhook belongs to, or None."""
+    message_data = data.get('messageData') or {}
+    sender_data = data.get('senderData') or {}
+    return message_data.get('chatId') or sender_data.get('chatId') or sender_data.get('sender')
+
+def get_webhook_message_type(data):
+    """The typeMessage of a webhook as a metric label; unknown types are lumped together."""
+    message_type = (data.get('messageData') or {}).get('typeMessage')
+    return message_type if message_type in WEBHOOK_MESSAGE_TYPES else 'other'
+
+def start_webhook_workers():
+    """Start the webhook worker threads (once per process)."""
+    with webhook_workers_lock:
+        if webhook_queues:
+            return
+        for worker_index in range(WEBHOOK_WORKERS):
+            worker_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+            worker = threading.Thread(target=webhook_worker, args=(worker_queue,), name=f"webhook-worker-{worker_index}")
+            worker.daemon = True
+            worker.start()
+            webhook_queues.append(worker_queue)
+        logger.info(f"Started {WEBHOOK_WORKERS} webhook workers.")
+
+def webhook_worker(worker_queue):
+    """Process queued webhooks one at a time, in arrival order."""
+    while True:
+        data, enqueued_at = worker_queue.get()
+        count_webhook_started(time.monotonic() - enqueued_at)
+        message_type = get_webhook_message_type(data)
+        try:
+            with traced(f"webhook worker {message_type}"), \
+                    timed('ticket_system_webhook_processing_seconds', type=message_type):
+                process_webhook(data)
+            outcome = 'processed'
+        except Exception as e:
+            logger.error(f"Error processing webhook: {e}", exc_info=True)
+            outcome = 'failed'
+        finally:
+            count_webhook_finished(outcome)
+            worker_queue.task_done()
+
+def count_webhook_started(wait, pending=False):
+    """Account for a queued webhook whose processing starts after `wait` seconds.
+
+    `pending` says whether the async server counted it as pending until now.
+    """
+    observe('ticket_system_webhook_stage_seconds', wait, stage='queue')
+    with webhook_stats_lock:
+        webhook_queue_stats['in_flight'] += 1
+        webhook_queue_stats['pending'] -= int(pending)
+        webhook_queue_stats['total_wait_seconds'] += wait
+        webhook_queue_stats['max_wait_seconds'] = max(webhook_queue_stats['max_wait_seconds'], wait)
+
+def count_webhook_finished(outcome):
+    with webhook_stats_lock:
+        webhook_queue_stats['in_flight'] -= 1
+        webhook_queue_stats[outcome] += 1
+
+def enqueue_webhook(data, sender):
+    """Queue a webhook on its sender's worker. Returns False if that worker's queue is full."""
+    start_webhook_workers()
+    shard = zlib.crc32((sender or '').encode('utf-8')) % len(webhook_queues)
+    try:
+        webhook_queues[shard].put_nowait((data, time.monotonic()))
+    except queue.Full:
+        with webhook_stats_lock:
+            webhook_queue_stats['rejected'] += 1
         return False
+    with webhook_stats_lock:
+        webhook_queue_stats['enqueued'] += 1
+    return True
+
+def drain_webhook_queues():
+    """Give queued webhooks a chance to finish before the process exits."""
+    if not webhook_queues:
+        return
+    deadline = time.monotonic() + WEBHOOK_DRAIN_TIMEOUT
+    while time.monotonic() < deadline:
+        if not any(q.unfinished_tasks for q in webhook_queues):
+            return
+        time.sleep(0.05)
+    logger.warning(f"Exiting with {get_webhook_queue_stats()['depth']} webhooks still queued.")
+
+atexit.register(drain_webhook_queues)
+
+def get_webhook_queue_stats():
+    """Current queue depth, in-flight count and wait times of the webhook workers."""
+    with webhook_stats_lock:
+        stats = dict(webhook_queue_stats)
+    started = stats['processed'] + stats['failed'] + stats['in_flight']
+    stats['workers'] = len(webhook_queues)
+    stats['depth'] = sum(q.qsize() for q in webhook_queues) + stats.pop('pending')
+    stats['avg_wait_seconds'] = stats['total_wait_seconds'] / started if started else 0.0
+    return stats
 
 # --- Webhook Handler ---
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    data = request.json
-    webhook_type = data.get('typeWebhook')
+    """Validate a Green API webhook, queue it for processing and acknowledge it."""
+    with timed('ticket_system_webhook_stage_seconds', stage='parse'):
+        data = request.get_json(silent=True)
+        valid = isinstance(data, dict) and bool(data.get('typeWebhook'))
+    if not valid:
+        return jsonify({"status": "error", "message": "Invalid webhook payload"}), 400
     logger.debug(f"Received raw data: {data}")
 
-    try:
-        if webhook_type == 'incomingMessageReceived':
-            message_data = data.get('messageData', {})
-            message_type = message_data.get('typeMessage')
-            
-            # Extract sender information from messageData
-            sender = message_data.get('chatId')
-            sender_name = message_data.get('senderName', 'Unknown')
-            
-            # Fallback to senderData if available (for compatibility)
-            sender_data = data.get('senderData', {})
-            if not sender:
-                sender = sender_data.get('sender')
-            if sender_name == 'Unknown':
-                sender_name = sender_data.get('senderName') or sender_data.get('chatName') or 'Unknown'
-            
-            global next_ticket_id
+    if data['typeWebhook'] != 'incomingMessageReceived':
+        # Log other notification types but take no action
+        logger.debug(f"Received non-actionable webhook: {data['typeWebhook']}")
+        return jsonify({"status": "ok"}), 200
 
-            # Handle different message types
-            if message_type == 'textMessage':
-                message_text = message_data.get('textMessageData', {}).get('textMessage')
-                
-                if not (sender and message_text):
-                    logger.info(f"Ignoring empty text message from {sender}.")
-                    return jsonify({"status": "ignored"}), 200
-                
-                logger.info(f"--- New Message from {sender} ({sender_name}): '{message_text}' ---")
-                
-                # Handle !close command
-                if message_text.strip().lower() == '!close':
-                    if sender in open_tickets_by_sender:
-                        ticket_id_to_close = open_tickets_by_sender.pop(sender)
-                        tickets[ticket_id_to_close]['status'] = 'closed'
-                        reply_text = f"Ticket {ticket_id_to_close} has been closed. Thank you!"
-                        logger.info(f"Ticket {ticket_id_to_close} for sender {sender} closed by command.")
-                        send_whatsapp_message(sender, reply_text, ticket_id=ticket_id_to_close, author="System")
-                        save_ticket_to_db(tickets[ticket_id_to_close])  # Save tickets after closing
-                    else:
-                        reply_text = "You do not have any open tickets to close."
-                        logger.info(f"Sender {sender} tried to close a ticket, but has no open tickets.")
-                        send_whatsapp_message(sender, reply_text, author="System")
-                    return jsonify({"status": "ok"}), 200
-
-                # Handle regular text message
-                text_message = {
-                    'author': sender_name,
-                    'message_type': 'text',
-                    'text': message_text,
-                    'timestamp': datetime.now().isoformat()
-                }
-                
-                if sender in open_tickets_by_sender:
-                    ticket_id = open_tickets_by_sender[sender]
-                    logger.info(f"Appending message to existing open ticket {ticket_id}.")
-                    tickets[ticket_id]['messages'].append(text_message)
-                    save_ticket_to_db(tickets[ticket_id])  # Save tickets after updating
-                else:
-                    ticket_id = f"T{next_ticket_id}"
-                    next_ticket_id += 1
-                    open_tickets_by_sender[sender] = ticket_id
-                    tickets[ticket_id] = {
-                        'id': ticket_id,
-                        'sender_id': sender,
-                        'sender_name': sender_name,
-                        'status': 'open',
-                        'created_at': datetime.now().isoformat(),
-                        'admin_notes': "",
-                        'messages': [text_message]
-                    }
-                    logger.info(f"Created new ticket {ticket_id} for sender {sender}.")
-                    reply_text = f"Thank you for contacting us! Your ticket ID is #{ticket_id}. An agent will be with you shortly."
-                    send_whatsapp_message(sender, reply_text, ticket_id=ticket_id, author="System")
-                    save_ticket_to_db(tickets[ticket_id])  # Save tickets after creating
-                    
-            elif message_type == 'audioMessage':
-                # Handle voice messages
-                voice_message = handle_voice_message(message_data.get('fileMessageData', {}), sender, sender_name)
-                if voice_message:
-                    if sender in open_tickets_by_sender:
-                        ticket_id = open_tickets_by_sender[sender]
-                        logger.info(f"Appending voice message to existing open ticket {ticket_id}.")
-                        tickets[ticket_id]['messages'].append(voice_message)
-                        save_ticket_to_db(tickets[ticket_id])  # Save tickets after updating
-                    else:
-                        ticket_id = f"T{next_ticket_id}"
-                        next_ticket_id += 1
-                        open_tickets_by_sender[sender] = ticket_id
-                        tickets[ticket_id] = {
-                            'id': ticket_id,
-                            'sender_id': sender,
-                            'sender_name': sender_name,
-                            'status': 'open',
-                            'created_at': datetime.now().isoformat(),
-                            'admin_notes': "",
-                            'messages': [voice_message]
-                        }
-                        logger.info(f"Created new ticket {ticket_id} for sender {sender}.")
-                        reply_text = f"Thank you for contacting us! Your ticket ID is #{ticket_id}. An agent will be with you shortly."
-                        send_whatsapp_message(sender, reply_text, ticket_id=ticket_id, author="System")
-                        save_ticket_to_db(tickets[ticket_id])  # Save tickets after creating
-                        
-            elif message_type in ['imageMessage', 'videoMessage', 'documentMessage']:
-                # Handle media messages
-                media_type = message_type.replace('Message', '').lower()
-                media_message = handle_media_message(message_data.get('fileMessageData', {}), sender, sender_name, media_type)
-                if media_message:
-                    if sender in open_tickets_by_sender:
-                        ticket_id = open_tickets_by_sender[sender]
-                        logger.info(f"Appending {media_type} message to existing open ticket {ticket_id}.")
-                        tickets[ticket_id]['messages'].append(media_message)
-                        save_ticket_to_db(tickets[ticket_id])  # Save tickets after updating
-                    else:
-                        ticket_id = f"T{next_ticket_id}"
-                        next_ticket_id += 1
-                        open_tickets_by_sender[sender] = ticket_id
-                        tickets[ticket_id] = {
-                            'id': ticket_id,
-                            'sender_id': sender,
-                            'sender_name': sender_name,
-                            'status': 'open',
-                            'created_at': datetime.now().isoformat(),
-                            'admin_notes': "",
-                            'messages': [media_message]
-                        }
-                        logger.info(f"Created new ticket {ticket_id} for sender {sender}.")
-                        reply_text = f"Thank you for contacting us! Your ticket ID is #{ticket_id}. An agent will be with you shortly."
-                        send_whatsapp_message(sender, reply_text, ticket_id=ticket_id, author="System")
-                        save_ticket_to_db(tickets[ticket_id])  # Save tickets after creating
-            else:
-                # Log other message types but take no action
-                logger.info(f"Received unsupported message type '{message_type}' from {sender} ({sender_name})")
-                
-        else:
-            # Log other notification types but take no action
-            logger.debug(f"Received non-actionable webhook: {webhook_type}")
+    id_message = data.get('idMessage')
+    with timed('ticket_system_webhook_stage_seconds', stage='dedup'):
+        claimed = claim_webhook(id_message)
+    if not claimed:
+        logger.info(f"Ignoring redelivered webhook {id_message}.")
+        return jsonify({"status": "ok", "duplicate": True}), 200
 
+    if WEBHOOK_WORKERS <= 0:
+        try:
+            with timed('ticket_system_webhook_processing_seconds', type=get_webhook_message_type(data)):
+                process_webhook(data)
+        except Exception as e:
+            release_webhook(id_message)
+            logger.error(f"Error processing webhook: {e}", exc_info=True)
+            return jsonify({"status": "error", "message": str(e)}), 500
         return jsonify({"status": "ok"}), 200
-    except Exception as e:
-        logger.error(f"Error processing webhook: {e}", exc_info=True)
-        return jsonify({"status": "error", "message": str(e)}), 500
+
+    if not enqueue_webhook(data, get_webhook_sender(data)):
+        # Green API redelivers on failure, so shed load instead of blocking
+        release_webhook(id_message)
+        logger.warning("Webhook queue full, rejecting webhook.")
+        return jsonify({"status": "error", "message": "Queue full"}), 503
+    return jsonify({"status": "ok"}), 200
+
+def process_webhook(data):
+    """Apply an incoming message webhook to the tickets."""
+    parsed = parse_webhook(data)
+    if parsed is None:
+        return
+    action, sender, sender_name, message = parsed
+    if action == 'close':
+        close_by_command(sender)
+    else:
+        queue_media_download(message.get('file_url'))  # Download before the URL expires
+        add_incoming_message(sender, sender_name, message)
+
+def parse_webhook(data):
+    """Turn an incoming message webhook into ('close', sender, sender_name, None) or
+    ('message', sender, sender_name, message). Returns None if there is nothing to do.
+    """
+    message_data = data.get('messageData', {})
+    message_type = message_data.get('typeMessage')
+    id_message = data.get('idMessage')
+    
+    # Extract sender information from messageData
+    sender = message_data.get('chatId')
+    sender_name = message_data.get('senderName', 'Unknown')
+    
+    # Fallback to senderData if available (for compatibility)
+    sender_data = data.get('senderData', {})
+    if not sender:
+        sender = sender_data.get('sender')
+    if sender_name == 'Unknown':
+        sender_name = sender_data.get('senderName') or sender_data.get('chatName') or 'Unknown'
+
+    # Handle different message types
+    if message_type == 'textMessage':
+        message_text = message_data.get('textMessageData', {}).get('textMessage')
+        
+        if not (sender and message_text):
+            logger.info(f"Ignoring empty text message from {sender}.")
+            return None
+        
+        logger.info(f"--- New Message from {sender} ({sender_name}): '{message_text}' ---")
+        
+        # Handle !close command
+        if message_text.strip().lower() == '!close':
+            return 'close', sender, sender_name, None
+
+        # Handle regular text message
+        text_message = {
+            'author': sender_name,
+            'message_type': 'text',
+            'text': message_text,
+            'timestamp': datetime.now().isoformat(),
+            'id_message': id_message
+        }
+        return 'message', sender, sender_name, text_message
+            
+    elif message_type == 'audioMessage':
+        # Handle voice messages
+        with timed('ticket_system_webhook_stage_seconds', stage='media'):
+            voice_message = handle_voice_message(message_data.get('fileMessageData', {}), sender, sender_name)
+        if voice_message:
+            voice_message['id_message'] = id_message
+            return 'message', sender, sender_name, voice_message
+                
+    elif message_type in ['imageMessage', 'videoMessage', 'documentMessage']:
+        # Handle media messages
+        media_type = message_type.replace('Message', '').lower()
+        with timed('ticket_system_webhook_stage_seconds', stage='media'):
+            media_message = handle_media_message(message_data.get('fileMessageData', {}), sender, sender_name, media_type)
+        if media_message:
+            media_message['id_message'] = id_message
+            return 'message', sender, sender_name, media_message
+    else:
+        # Log other message types but take no action
+        logger.info(f"Received unsupported message type '{message_type}' from {sender} ({sender_name})")
+    return None
+
+def close_by_command(sender):
+    """Close the sender's open ticket after a !close message and confirm it."""
+    ticket_id, reply_text = close_sender_ticket(sender)
+    with timed('ticket_system_webhook_stage_seconds', stage='reply'):
+        send_whatsapp_message(sender, reply_text, ticket_id=ticket_id, author="System")
+    if ticket_id is not None:
+        with timed('ticket_system_webhook_stage_seconds', stage='persist'):
+            save_ticket_to_db(tickets[ticket_id])  # Save tickets after closing
+
+def close_sender_ticket(sender):
+    """Close the sender's open ticket. Returns its ID (None if there was none) and the reply to send."""
+    with timed('ticket_system_webhook_stage_seconds', stage='ticket'), sender_lock(sender):
+        ticket_id_to_close = open_tickets_by_sender.get(sender)
+        closed = ticket_id_to_close is not None and close_ticket(ticket_id_to_close)
+    if closed:
+        logger.info(f"Ticket {ticket_id_to_close} for sender {sender} closed by command.")
+        return ticket_id_to_close, f"Ticket {ticket_id_to_close} has been closed. Thank you!"
+    logger.info(f"Sender {sender} tried to close a ticket, but has no open tickets.")
+    return None, "You do not have any open tickets to close."
+
+def add_incoming_message(sender, sender_name, message):
+    """Append an inbound message to the sender's open ticket, opening a new ticket if needed."""
+    ticket_id, created = record_incoming_message(sender, sender_name, message)
+    if created:
+        with timed('ticket_system_webhook_stage_seconds', stage='reply'):
+            send_whatsapp_message(sender, ticket_created_reply(ticket_id), ticket_id=ticket_id, author="System")
+    with timed('ticket_system_webhook_stage_seconds', stage='persist'):
+        save_ticket_to_db(tickets[ticket_id])  # Save tickets after creating or updating
+    return ticket_id
+
+def record_incoming_message(sender, sender_name, message):
+    """Add an inbound message to the tickets. Returns the ticket ID and whether the ticket is new."""
+    with timed('ticket_system_webhook_stage_seconds', stage='ticket'), sender_lock(sender):
+        created = False
+        if sender not in open_tickets_by_sender:
+            ticket_id = create_ticket(sender, sender_name, message)
+            created = ticket_id is not None
+        if not created:
+            ticket_id = open_tickets_by_sender[sender]
+            logger.info(f"Appending {message['message_type']} message to existing open ticket {ticket_id}.")
+            append_message(ticket_id, message)
+    return ticket_id, created
+
+def ticket_created_reply(ticket_id):
+    return f"Thank you for contacting us! Your ticket ID is #{ticket_id}. An agent will be with you shortly."
 
 def handle_voice_message(message_data, sender, sender_name):
     """Handle voice message from WhatsApp webhook."""
@@ -498,20 +4376,7 @@ def handle_voice_message(message_data, sender, sender_name):
         duration = message_data.get('seconds', 0)
         mime_type = message_data.get('mimeType', 'audio/ogg')
         
-        # Download the voice message
-        temp_dir = tempfile.gettempdir()
-        temp_file_path = os.path.join(temp_dir, file_name)
-        response = requests.get(file_url, stream=True)
-        with open(temp_file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                f.write(chunk)
-        
-        # Convert to MP3 if necessary
-        if mime_type != 'audio/mpeg':
-            output_file_path = os.path.join(temp_dir, f"{os.path.splitext(file_name)[0]}.mp3")
-            if convert_audio_to_mp3(temp_file_path, output_file_path):
-                file_name = os.path.basename(output_file_path)
-                temp_file_path = output_file_path
+        transcription_wakeup.set()
         
         # Create message entry for voice message
         voice_message = {
@@ -594,66 +4459,115 @@ def dashboard():
     refreshed = request.args.get('refreshed')
     error = request.args.get('error')
     
-    # Calculate stats
-    total_tickets = len(tickets)
-    open_tickets = sum(1 for t in tickets.values() if t['status'] == 'open')
-    closed_tickets = total_tickets - open_tickets
-    
-    # Today's tickets
-    today = datetime.now().strftime('%Y-%m-%d')
-    today_tickets = sum(1 for t in tickets.values() if t['created_at'].startswith(today))
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', DASHBOARD_PER_PAGE, type=int), 1), DASHBOARD_MAX_PER_PAGE)
     
-    stats = {
-        'total': total_tickets,
-        'open': open_tickets,
-        'closed': closed_tickets,
-        'today': today_tickets
+    # Stats and ticket order are maintained as tickets change
+    stats = get_ticket_stats()
+    page_ticket_ids, filtered_total = get_ticket_page(filter_status, page, per_page)
+    pagination = {
+        'page': page,
+        'per_page': per_page,
+        'pages': max((filtered_total + per_page - 1) // per_page, 1),
+        'total': filtered_total
     }
     
-    # Filter tickets
     filtered_tickets = []
-    # Sort tickets by ticket number (T1, T2, T3, etc.) - extract number and sort numerically
-    sorted_ticket_items = sorted(tickets.items(), key=lambda x: int(x[0][1:]) if x[0].startswith('T') else 0, reverse=True)
-    
-    for ticket_id, ticket_data in sorted_ticket_items:
-        if filter_status and ticket_data['status'] != filter_status:
+    for ticket_id in page_ticket_ids:
+        ticket_data = tickets.get(ticket_id)
+        if ticket_data is None:
             continue
-            
-        # Format ticket data for display
-        ticket_display = {
-            'id': ticket_id,
-            'sender_id': ticket_data['sender_id'],
-            'sender_name': ticket_data['sender_name'],
-            'status': ticket_data['status'],
-            'message_count': len(ticket_data['messages']),
-            'created_at_formatted': datetime.fromisoformat(ticket_data['created_at'].replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M'),
-            'has_voice': any(msg.get('message_type') == 'audio' for msg in ticket_data['messages']),
-            'has_media': any(msg.get('message_type') in ['image', 'video', 'document'] for msg in ticket_data['messages'])
-        }
-        
-        # Get last message
-        if ticket_data['messages']:
-            last_msg = ticket_data['messages'][-1]
-            ticket_display['last_message'] = last_msg.get('text', f"[{last_msg.get('message_type', 'message')}]")[:50]
-            ticket_display['last_message_time'] = datetime.fromisoformat(last_msg['timestamp'].replace('Z', '+00:00')).strftime('%H:%M')
-        else:
-            ticket_display['last_message'] = 'No messages'
-            ticket_display['last_message_time'] = ''
-            
-        filtered_tickets.append(ticket_display)
+        row, card = render_dashboard_ticket(ticket_id, ticket_data)
+        filtered_tickets.append({'id': ticket_id, 'row': row, 'card': card})
     
     return render_template('dashboard.html', 
                          tickets=filtered_tickets, 
                          stats=stats, 
-                         filter_status=filter_status)
+                         filter_status=filter_status,
+                         pagination=pagination)
+
+@app.route('/dashboard/ticket/<ticket_id>')
+def dashboard_ticket(ticket_id):
+    """Rendered dashboard row and card of a ticket, for live updates."""
+    ticket_data = snapshot_ticket(ticket_id)
+    if ticket_data is None:
+        return jsonify({'success': False, 'message': 'Ticket not found'}), 404
+    row, card = render_dashboard_ticket(ticket_id, ticket_data)
+    return jsonify({
+        'success': True,
+        'id': ticket_id,
+        'status': ticket_data['status'],
+        'row': row,
+        'card': card,
+        'stats': get_ticket_stats()
+    })
+
+def search_from_request():
+    """Run the search described by the request's query parameters."""
+    status = request.args.get('status')
+    search = {
+        'query': request.args.get('q', '').strip(),
+        'status': status if status in ('open', 'closed') else None,
+        'from': parse_search_date(request.args.get('from')),
+        'to': parse_search_date(request.args.get('to')),
+        'page': max(request.args.get('page', 1, type=int), 1),
+        'per_page': min(max(request.args.get('per_page', SEARCH_PER_PAGE, type=int), 1), SEARCH_MAX_PER_PAGE)
+    }
+    hits, total = search_tickets(search['query'], search['status'], search['from'], search['to'],
+                                 search['page'], search['per_page'])
+    search.update({
+        'total': total,
+        'pages': max((total + search['per_page'] - 1) // search['per_page'], 1),
+        'results': [result for result in map(describe_search_hit, hits) if result is not None]
+    })
+    return search
+
+def describe_search_hit(hit):
+    """Ticket and message details of a search hit, or None if it is gone."""
+    ticket_data = tickets.get(hit['ticket_id'])
+    if ticket_data is None:
+        return None
+    result = dict(hit, sender_name=ticket_data['sender_name'], status=ticket_data['status'],
+                  url=url_for('ticket_detail', ticket_id=hit['ticket_id']))
+    if hit['position'] is None:
+        result.update({
+            'author': None,
+            'message_type': None,
+            'text': ticket_data.get('admin_notes') or '',
+            'file_name': None,
+            'timestamp': ticket_data['created_at']
+        })
+    else:
+        # Only the hit's message, without loading or rehydrating the ticket's history
+        snapshot = snapshot_ticket_window(hit['ticket_id'], lambda message_count: (hit['position'], hit['position'] + 1),
+                                          rehydrate=False)
+        if not snapshot or not snapshot['messages']:
+            return None
+        message = snapshot['messages'][0]
+        result.update({
+            'author': message.get('author'),
+            'message_type': message.get('message_type', 'text'),
+            'text': (message.get('text') or '')[:200],
+            'file_name': message.get('file_name'),
+            'timestamp': message['timestamp']
+        })
+    result['timestamp_formatted'] = format_timestamp(result['timestamp'], '%Y-%m-%d %H:%M')
+    return result
+
+@app.route('/search')
+def search():
+    """Search messages, customers and notes."""
+    return render_template('search.html', search=search_from_request())
 
 @app.route('/ticket/<ticket_id>')
 def ticket_detail(ticket_id):
     """Show detailed view of a specific ticket."""
-    if ticket_id not in tickets:
+    ticket_data = snapshot_ticket_window(ticket_id, lambda count: (count - TICKET_MESSAGE_WINDOW, count))
+    if ticket_data is None:
         return redirect(url_for('dashboard'))
     
-    ticket_data = tickets[ticket_id]
+    version = ticket_data['version']
+    first_position = ticket_data['message_start']
     
     # Format ticket for display
     ticket_display = {
@@ -661,38 +4575,86 @@ def ticket_detail(ticket_id):
         'sender_id': ticket_data['sender_id'],
         'sender_name': ticket_data['sender_name'],
         'status': ticket_data['status'],
-        'created_at_formatted': datetime.fromisoformat(ticket_data['created_at'].replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M'),
+        'created_at_formatted': format_timestamp(ticket_data['created_at'], '%Y-%m-%d %H:%M'),
         'admin_notes': ticket_data.get('admin_notes', ''),
-        'messages': []
+        'messages_html': render_messages(ticket_id, version, ticket_data['messages'], ticket_data['sender_name'], start=first_position),
+        'first_position': first_position,
+        'message_window': TICKET_MESSAGE_WINDOW
     }
     
-    # Format messages
-    for msg in ticket_data['messages']:
-        message_display = {
-            'author': msg.get('author', 'Unknown'),
-            'text': msg.get('text', ''),
-            'message_type': msg.get('message_type', 'text'),
-            'file_url': msg.get('file_url'),
-            'file_name': msg.get('file_name'),
-            'file_size': msg.get('file_size'),
-            'duration': msg.get('duration'),
-            'mime_type': msg.get('mime_type'),
-            'timestamp_formatted': datetime.fromisoformat(msg['timestamp'].replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
-        }
-        ticket_display['messages'].append(message_display)
+    # Message counts by kind
+    message_types = count_message_types(ticket_id, ticket_data)
+    ticket_display.update({
+        'message_count': ticket_data['message_count'],
+        'text_count': message_types['text'],
+        'voice_count': message_types['audio'],
+        'media_count': message_types['image'] + message_types['video'] + message_types['document']
+    })
     
     return render_template('ticket_detail.html', ticket=ticket_display)
 
+@app.route('/ticket/<ticket_id>/messages')
+def ticket_messages(ticket_id):
+    """Rendered messages of a ticket.
+
+    With ?before=<cursor>, the `limit` messages before that position, for scrolling back;
+    the returned `cursor` fetches the ones before those. Otherwise the messages from
+    `start` up to `end`, for live updates.
+    """
+    def window(message_count):
+        if 'before' in request.args:
+            end = min(request.args.get('before', message_count, type=int), message_count)
+            limit = min(max(request.args.get('limit', TICKET_MESSAGE_WINDOW, type=int), 1), TICKET_MESSAGE_MAX_LIMIT)
+            return end - limit, end
+        return request.args.get('start', 0, type=int), request.args.get('end', message_count, type=int)
+    
+    ticket_data = snapshot_ticket_window(ticket_id, window)
+    if ticket_data is None:
+        return jsonify({'success': False, 'message': 'Ticket not found'}), 404
+    start = ticket_data['message_start']
+    html = ''.join(render_message(ticket_id, position, message, ticket_data['sender_name'])
+                   for position, message in enumerate(ticket_data['messages'], start))
+    return jsonify({
+        'success': True,
+        'html': html,
+        'cursor': start,
+        'more': start > 0,
+        'message_count': ticket_data['message_count'],
+        'status': ticket_data['status'],
+        'admin_notes': ticket_data.get('admin_notes', '')
+    })
+
+@app.route('/ticket/<ticket_id>/media/<int:position>')
+def ticket_media(ticket_id, position):
+    """Serve the media file of a message from the media cache."""
+    if ticket_id not in tickets:
+        return jsonify({'success': False, 'message': 'Ticket not found'}), 404
+    # Only this message; players send a Range request per chunk
+    snapshot = snapshot_ticket_window(ticket_id, lambda message_count: (position, position + 1))
+    if not snapshot or not snapshot['messages'] or not snapshot['messages'][0].get('file_url'):
+        return jsonify({'success': False, 'message': 'Media not found'}), 404
+    
+    message = snapshot['messages'][0]
+    path = get_media(message['file_url'])
+    if path is None:
+        return redirect(message['file_url'])  # Let the browser try the original URL
+    mime_type = message.get('mime_type')
+    if not mime_type or '*' in mime_type:
+        mime_type = mimetypes.guess_type(message.get('file_name') or '')[0] or 'application/octet-stream'
+    try:
+        # Content never changes for a cache path; send_file answers Range requests with 206
+        return send_file_response(path, mimetype=mime_type, download_name=message.get('file_name'), conditional=True, max_age=86400)
+    except FileNotFoundError:
+        return redirect(message['file_url'])  # Evicted meanwhile
+
 @app.route('/send_reply/<ticket_id>', methods=['POST'])
 def send_reply(ticket_id):
     """Send a reply to a ticket via web interface."""
-    if ticket_id not in tickets:
-        return jsonify({'success': False, 'message': 'Ticket not found'})
+    problem = reply_ticket_problem(ticket_id)
+    if problem:
+        return jsonify({'success': False, 'message': problem})
     
     ticket = tickets[ticket_id]
-    if ticket['status'] == 'closed':
-        return jsonify({'success': False, 'message': 'Ticket is closed'})
-    
     data = request.get_json()
     message = data.get('message', '').strip()
     
@@ -722,45 +4684,31 @@ def send_file(ticket_id):
             return jsonify({'success': False, 'message': 'No file selected'})
         
         # Get ticket info
-        if ticket_id not in tickets:
-            return jsonify({'success': False, 'message': 'Ticket not found'})
+        problem = reply_ticket_problem(ticket_id)
+        if problem:
+            return jsonify({'success': False, 'message': problem})
         
-        ticket = tickets[ticket_id]
-        if ticket['status'] == 'closed':
-            return jsonify({'success': False, 'message': 'Ticket is closed'})
+        chat_id = tickets[ticket_id]['sender_id']
         
-        chat_id = ticket['sender_id']
-        
-        # Save uploaded file temporarily
         filename = secure_filename(file.filename)
-        temp_dir = tempfile.gettempdir()
-        temp_file_path = os.path.join(temp_dir, filename)
-        file.save(temp_file_path)
         
         # Check if it's an audio file and convert to MP3 if needed
-        final_file_path = temp_file_path
-        final_filename = filename
-        
+        file_data = file.read()
         if file.content_type and file.content_type.startswith('audio/'):
             # Convert audio to MP3 for better WhatsApp compatibility
-            mp3_filename = os.path.splitext(filename)[0] + '.mp3'
-            mp3_file_path = os.path.join(temp_dir, mp3_filename)
-            
-            if convert_audio_to_mp3(temp_file_path, mp3_file_path):
-                final_file_path = mp3_file_path
-                final_filename = mp3_filename
-                logger.info(f"Audio file converted to MP3: {filename} -> {mp3_filename}")
-            else:
-                logger.warning(f"Audio conversion failed, using original file: {filename}")
-        
-        # Send file via WhatsApp
-        result = send_whatsapp_file(chat_id, final_file_path, final_filename, caption, ticket_id)
+            filename, file_data = converted_upload(filename, file_data, transcode_audio(file_data, 'mp3'))
         
-        # Clean up temporary file
+        # Save the file to upload under a unique temporary name
+        fd, temp_file_path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
         try:
-            os.remove(final_file_path)
-        except:
-            pass
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(file_data)
+            
+            # Send file via WhatsApp
+            result = send_whatsapp_file(chat_id, temp_file_path, filename, caption, ticket_id)
+        finally:
+            # Clean up temporary file
+            os.remove(temp_file_path)
         
         if result:
             return jsonify({'success': True, 'message': 'File sent successfully'})
@@ -771,6 +4719,23 @@ def send_file(ticket_id):
         logger.error(f"Error in send_file route: {e}")
         return jsonify({'success': False, 'message': f'Server error: {str(e)}'})
 
+def reply_ticket_problem(ticket_id):
+    """Why a ticket cannot be replied to, or None if it can."""
+    if ticket_id not in tickets:
+        return 'Ticket not found'
+    if tickets[ticket_id]['status'] == 'closed':
+        return 'Ticket is closed'
+    return None
+
+def converted_upload(filename, file_data, mp3_data):
+    """The name and content to send for an uploaded audio file, given its MP3 conversion (None if that failed)."""
+    if mp3_data is None:
+        logger.warning(f"Audio conversion failed, using original file: {filename}")
+        return filename, file_data
+    mp3_filename = os.path.splitext(filename)[0] + '.mp3'
+    logger.info(f"Audio file converted to MP3: {filename} -> {mp3_filename}")
+    return mp3_filename, mp3_data
+
 @app.route('/save_notes/<ticket_id>', methods=['POST'])
 def save_notes(ticket_id):
     """Save admin notes for a ticket."""
@@ -782,7 +4747,11 @@ def save_notes(ticket_id):
     
     try:
         # Update ticket with admin notes
-        tickets[ticket_id]['admin_notes'] = notes
+        with ticket_lock(ticket_id):
+            tickets[ticket_id]['admin_notes'] = notes
+            bump_ticket_version(tickets[ticket_id])
+            index_ticket_for_search(tickets[ticket_id])
+        publish_event('notes-updated', ticket_id)
         
         # Save to database
         save_ticket_to_db(tickets[ticket_id])
@@ -800,18 +4769,12 @@ def close_ticket_web(ticket_id):
         return jsonify({'success': False, 'message': 'Ticket not found'})
     
     ticket = tickets[ticket_id]
-    if ticket['status'] == 'closed':
-        return jsonify({'success': False, 'message': 'Ticket is already closed'})
-    
     try:
-        # Close the ticket
-        tickets[ticket_id]['status'] = 'closed'
+        # Close the ticket, unless another request or the customer just did
+        if not close_ticket(ticket_id):
+            return jsonify({'success': False, 'message': 'Ticket is already closed'})
         sender_id = ticket['sender_id']
         
-        # Remove from open tickets mapping
-        if sender_id in open_tickets_by_sender:
-            del open_tickets_by_sender[sender_id]
-        
         # Send notification to user
         close_message = f"Your ticket #{ticket_id} has been closed by our support team. Thank you for contacting us!"
         send_whatsapp_message(sender_id, close_message, ticket_id=ticket_id, author="System")
@@ -825,6 +4788,243 @@ def close_ticket_web(ticket_id):
         logger.error(f"Error closing ticket via web interface: {e}")
         return jsonify({'success': False, 'message': str(e)})
 
+@app.route('/events')
+def events():
+    """Server-Sent Events stream of ticket changes."""
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor') or get_event_cursor()
+    return Response(stream_with_context(stream_events(cursor)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/events/poll')
+def poll_events():
+    """Long-poll fallback for /events: ticket changes after a cursor."""
+    cursor = request.args.get('cursor') or get_event_cursor()
+    timeout = min(max(request.args.get('timeout', EVENTS_POLL_TIMEOUT, type=float), 0), EVENTS_POLL_TIMEOUT)
+    events, cursor = wait_for_events(cursor, timeout)
+    return jsonify({'cursor': cursor, 'reset': events is None, 'events': events or []})
+
+# --- JSON API ---
+# Read API for wallboards and tooling. /api/tickets?since=<cursor> returns tickets
+# changed after the cursor (all tickets without one); cursors are ticket versions
+# qualified by the process that issued them, so a cursor from before a restart or
+# from another worker gets a full listing ('reset': true). Message cursors are
+# positions in the append-only message history. Responses carry weak ETags and are
+# gzipped for clients that accept it.
+API_MAX_LIMIT = 1000
+API_GZIP_MIN_BYTES = 1024
+
+def ticket_to_json(ticket_data):
+    return {
+        'id': ticket_data['id'],
+        'sender_id': ticket_data['sender_id'],
+        'sender_name': ticket_data['sender_name'],
+        'status': ticket_data['status'],
+        'created_at': ticket_data['created_at'],
+        'admin_notes': ticket_data.get('admin_notes', ''),
+        'message_count': ticket_data['message_count'],
+        'last_message': dict(ticket_data['last_message']) if ticket_data['last_message'] else None,
+        'has_voice': ticket_data['has_voice'],
+        'has_media': ticket_data['has_media'],
+        'version': ticket_data['version']
+    }
+
+def api_not_modified(etag):
+    """304 response if the client already has this ETag, else None."""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    return None
+
+def api_response(payload, etag):
+    """JSON response with a weak ETag, gzipped if the client accepts it."""
+    body = json.dumps(payload).encode('utf-8')
+    response = Response(body, mimetype='application/json')
+    if len(body) >= API_GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag, weak=True)
+    return response
+
+def api_limit():
+    return min(max(request.args.get('limit', API_MAX_LIMIT, type=int), 1), API_MAX_LIMIT)
+
+@app.route('/api/tickets')
+def api_tickets():
+    """Tickets changed since a cursor."""
+    cursor = request.args.get('since')
+    since = parse_event_cursor(cursor) if cursor else None
+    limit = api_limit()
+    latest_version = get_latest_ticket_version()
+    etag = f"tickets-{event_stream_id}-{latest_version}-{since}-{limit}"
+    not_modified = api_not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+    
+    changed, more = get_changed_ticket_ids(since or 0, limit)
+    changed_tickets = []
+    for ticket_id, version in changed:
+        ticket_data = snapshot_ticket(ticket_id)
+        if ticket_data is not None:
+            changed_tickets.append(ticket_to_json(ticket_data))
+    next_version = changed[-1][1] if more else max(latest_version, since or 0)
+    return api_response({
+        'cursor': f"{event_stream_id}-{next_version}",
+        'reset': since is None,
+        'more': more,
+        'tickets': changed_tickets
+    }, etag)
+
+@app.route('/api/tickets/<ticket_id>/messages')
+def api_ticket_messages(ticket_id):
+    """Messages of a ticket after a position."""
+    after = max(request.args.get('after', 0, type=int), 0)
+    limit = api_limit()
+    raw = request.args.get('raw', 'false').lower() == 'true'  # Include the raw webhook payloads
+    message_etag = lambda version: f"messages-{event_stream_id}-{ticket_id}-{version}-{after}-{limit}-{raw}"
+    # Answer unchanged pages from the header alone, without copying or loading messages
+    ticket_header = snapshot_ticket(ticket_id)
+    if ticket_header is None:
+        return jsonify({'success': False, 'message': 'Ticket not found'}), 404
+    not_modified = api_not_modified(message_etag(ticket_header['version']))
+    if not_modified is not None:
+        return not_modified
+    
+    ticket_data = snapshot_ticket_window(ticket_id, lambda message_count: (after, after + limit))
+    if ticket_data is None:
+        return jsonify({'success': False, 'message': 'Ticket not found'}), 404
+    etag = message_etag(ticket_data['version'])  # The ticket may have changed since the header was read
+    page = ticket_data['messages']
+    page_json = [dict(message) for message in page]
+    if raw:
+        for message_json, payload in zip(page_json, load_original_message_data(ticket_id, after, page)):
+            message_json['original_message_data'] = payload
+    return api_response({
+        'ticket_id': ticket_id,
+        'cursor': after + len(page),
+        'more': after + len(page) < ticket_data['message_count'],
+        'messages': page_json
+    }, etag)
+
+@app.route('/api/search')
+def api_search():
+    """Search results as JSON; see /search for the parameters."""
+    if not request.args.get('q', '').strip():
+        return jsonify({'success': False, 'message': 'Missing search query'}), 400
+    search = search_from_request()
+    return jsonify(dict(search, success=True))
+
+@app.route('/stats')
+def stats():
+    """Operational statistics of the background subsystems."""
+    return jsonify({
+        'webhook_queue': get_webhook_queue_stats(),
+        'write_behind': get_write_behind_stats(),
+        'journal': get_journal_stats(),
+        'message_cache': get_message_cache_stats(),
+        'shared_state': get_shared_state_stats(),
+        'fragment_cache': get_fragment_cache_stats(),
+        'events': get_event_stats(),
+        'green_api': get_green_api_stats(),
+        'media_cache': get_media_cache_stats(),
+        'transcoding': get_transcode_stats(),
+        'transcription': get_transcription_stats(),
+        'search_index': get_search_index_stats(),
+        'archive': get_archive_stats(),
+        'warm_start': get_warm_start_stats(),
+        'webhook_dedup': get_webhook_dedup_stats(),
+        'ticket_locks': get_ticket_lock_stats(),
+        'slow_requests': get_slow_request_stats()
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Latency histograms and gauges in the Prometheus text format."""
+    if not METRICS_ENABLED:
+        return jsonify({'success': False, 'message': 'Metrics are disabled'}), 404
+    ticket_stats = get_ticket_stats()
+    resident_messages = sum(len(ticket_data.get('messages') or ()) for ticket_data in list(tickets.values()))
+    with message_cache_lock:
+        message_cache_bytes = message_cache_stats['bytes']
+    gauges = {
+        'ticket_system_tickets': [({'status': 'open'}, ticket_stats['open']), ({'status': 'closed'}, ticket_stats['closed'])],
+        'ticket_system_resident_messages': [({}, resident_messages)],
+        'ticket_system_message_cache_bytes': [({}, message_cache_bytes)],
+        'ticket_system_queue_depth': [
+            ({'queue': 'webhook'}, get_webhook_queue_stats()['depth']),
+            ({'queue': 'green_api'}, green_api_queue.qsize()),
+            ({'queue': 'media_download'}, media_download_queue.qsize()),
+            ({'queue': 'transcription'}, transcription_queue.qsize()),
+            ({'queue': 'pending_writes'}, get_pending_row_count())
+        ]
+    }
+    return Response(render_metrics(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.before_request
+def start_request_trace():
+    rule = request.url_rule
+    if rule is None:
+        start_trace(f"{request.method} {request.path}")
+    elif rule.endpoint not in SLOW_REQUEST_EXCLUDED_ENDPOINTS:
+        start_trace(f"{request.method} {rule.rule}")
+
+@app.after_request
+def record_request_status(response):
+    trace = getattr(trace_local, 'trace', None)
+    if trace is not None:
+        trace['status'] = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    finish_trace()
+
+def debug_denied():
+    """The error response for a /debug/* request, or None if it may proceed.
+
+    The routes only exist when DEBUG_TOKEN is set, and then need it in the X-Debug-Token
+    header. Not in the query string, where it would end up in access logs.
+    """
+    if not DEBUG_TOKEN:
+        return jsonify({'success': False, 'message': 'Not found'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Debug-Token', '').encode(), DEBUG_TOKEN.encode()):
+        return jsonify({'success': False, 'message': 'Invalid debug token'}), 403
+    return None
+
+@app.route('/debug/profile')
+def debug_profile():
+    """Sample all threads for ?seconds= (default 10) and return their collapsed stacks."""
+    denied = debug_denied()
+    if denied:
+        return denied
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), PROFILE_MAX_SECONDS)
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({'success': False, 'message': 'A profile is already running'}), 409
+    try:
+        logger.info(f"Profiling all threads for {seconds:.1f}s.")
+        stacks = sample_stacks(seconds, PROFILE_SAMPLE_INTERVAL, include_idle=request.args.get('idle') == 'true')
+    finally:
+        profile_lock.release()
+    return Response(''.join(f"{stack} {samples}\n" for stack, samples in stacks.most_common()), mimetype='text/plain')
+
+@app.route('/debug/slow')
+def debug_slow():
+    """The latest requests that took longer than SLOW_REQUEST_THRESHOLD, newest first."""
+    denied = debug_denied()
+    if denied:
+        return denied
+    with slow_request_lock:
+        recorded = list(slow_requests)
+    return jsonify({'success': True, 'threshold_seconds': SLOW_REQUEST_THRESHOLD, 'requests': recorded[::-1]})
+
+@app.route('/ready')
+def ready():
+    """Readiness probe: 200 once the tickets are caught up with the database, 503 before."""
+    stats = get_warm_start_stats()
+    return jsonify(stats), 200 if stats['state'] == 'ready' else 503
+
 # --- Terminal Interface for Agent ---
 def terminal_input_thread():
     """Runs in a separate thread to handle agent commands from the terminal."""
@@ -852,7 +5052,7 @@ def terminal_input_thread():
                 print("--- All Tickets ---")
                 for ticket_id, ticket_data in sorted(tickets.items()):
                     print(f"  - ID: {ticket_id}, Sender: {ticket_data.get('sender_name', 'N/A')} ({ticket_data['sender_id']}), Status: {ticket_data['status']}")
-                    for msg in ticket_data['messages']:
+                    for msg in get_ticket_messages(ticket_id):
                         print(f"    - [{msg['timestamp']}] {msg.get('author', 'N/A')}: {msg['text']}")
                 print("-------------------")
 
@@ -888,18 +5088,11 @@ def terminal_input_thread():
                     print(f"Error: Ticket '{ticket_id_to_close}' not found.")
                     continue
                 
-                ticket = tickets[ticket_id_to_close]
-                if ticket['status'] == 'closed':
+                # Close the ticket
+                if not close_ticket(ticket_id_to_close):
                     print(f"Error: Ticket '{ticket_id_to_close}' is already closed.")
                     continue
-                
-                # Close the ticket
-                tickets[ticket_id_to_close]['status'] = 'closed'
-                sender_id = ticket['sender_id']
-                
-                # Remove from open tickets mapping
-                if sender_id in open_tickets_by_sender:
-                    del open_tickets_by_sender[sender_id]
+                sender_id = tickets[ticket_id_to_close]['sender_id']
                 
                 # Send notification to user
                 close_message = f"Your ticket #{ticket_id_to_close} has been closed by our support team. Thank you for contacting us!"
@@ -23,6 +23,8 @@ CREATE TABLE IF NOT EXISTS messages (
   duration INTEGER, -- For audio/video files (in seconds)
   mime_type TEXT, -- MIME type of the file
   metadata JSONB, -- Additional metadata (e.g., transcription status, file info)
+  id_message TEXT, -- Green API ID of incoming messages, for webhook deduplication
+  message_key TEXT, -- Generated by the app, so a message written twice is stored once
   timestamp TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
@@ -45,6 +47,9 @@ CREATE INDEX IF NOT EXISTS idx_messages_ticket_id ON messages(ticket_id);
 CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp);
 CREATE INDEX IF NOT EXISTS idx_messages_type ON messages(message_type);
 CREATE INDEX IF NOT EXISTS idx_voice_transcriptions_message_id ON voice_transcriptions(message_id);
+CREATE INDEX IF NOT EXISTS idx_messages_pending_transcription ON messages(id) WHERE message_type = 'audio' AND metadata->>'transcription_status' = 'pending';
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_id_message ON messages(id_message);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_message_key ON messages(message_key);
 
 -- Create updated_at trigger for tickets table
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -71,6 +76,28 @@ SELECT
 FROM messages m
 LEFT JOIN voice_transcriptions vt ON m.id = vt.message_id;
 
+-- Create a view with per-ticket message summaries (used when LAZY_MESSAGES is enabled)
+CREATE OR REPLACE VIEW ticket_summaries AS
+SELECT 
+    t.*,
+    COUNT(m.id) AS message_count,
+    COALESCE(BOOL_OR(m.message_type = 'audio'), FALSE) AS has_voice,
+    COALESCE(BOOL_OR(m.message_type IN ('image', 'video', 'document')), FALSE) AS has_media,
+    lm.author AS last_message_author,
+    lm.message_type AS last_message_type,
+    lm.text AS last_message_text,
+    lm.timestamp AS last_message_at
+FROM tickets t
+LEFT JOIN messages m ON m.ticket_id = t.id
+LEFT JOIN LATERAL (
+    SELECT author, message_type, text, timestamp
+    FROM messages
+    WHERE ticket_id = t.id
+    ORDER BY timestamp DESC, id DESC
+    LIMIT 1
+) lm ON TRUE
+GROUP BY t.id, lm.author, lm.message_type, lm.text, lm.timestamp;
+
 -- Insert some sample data (optional)
 -- This will help test the migration from JSON to database
 -- You can remove this section if you don't want sample data
@@ -0,0 +1,70 @@
+"""main.py wired to the bench's Supabase and Green API stand-ins, shared by the tests.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import fakes
+
+os.chdir(tempfile.mkdtemp(prefix='ticket-tests-'))  # app.log, journal, caches
+os.environ['JOURNAL_DIR'] = os.path.join(os.getcwd(), 'journal')
+os.environ['WRITE_BEHIND_BATCH_ROWS'] = '2'
+os.environ['GREEN_API_RATE_LIMIT'] = '0'
+sys.modules['supabase'] = fakes.make_supabase_module(fakes.FakeDatabase())
+import main
+
+green_api = fakes.FakeGreenApi()
+green_api.install(main.green_api_session, main.media_session)
+
+# Keep logging to app.log, but not to the terminal
+for handler in list(main.logger.handlers):
+    if not isinstance(handler, main.logging.FileHandler):
+        main.logger.removeHandler(handler)
+
+def use_database(database):
+    """Point main.py at a fresh database with nothing buffered. Flushes then only happen when a test calls them."""
+    main.supabase = fakes.FakeClient(database)
+    main.write_behind_thread = threading.current_thread()
+    with main.pending_writes_condition:
+        main.pending_ticket_rows.clear()
+        main.pending_message_rows.clear()
+        main.dead_letter_rows.clear()
+        main.write_behind_stats['consecutive_failures'] = 0
+
+def open_ticket(sender, texts, timestamp='2026-01-01T00:00:00'):
+    """Open a ticket with a customer message per text, saved and flushed. Returns its ID."""
+    for text in texts:
+        message = {'author': 'Customer', 'message_type': 'text', 'text': text, 'timestamp': timestamp}
+        ticket_id, _ = main.record_incoming_message(sender, 'Customer', message)
+    main.save_ticket_to_db(main.tickets[ticket_id])
+    assert main.flush_pending_writes()
+    return ticket_id
+
+def text_webhook(id_message, sender, text):
+    """A Green API webhook of an incoming text message."""
+    return {
+        'typeWebhook': 'incomingMessageReceived',
+        'idMessage': id_message,
+        'senderData': {'chatId': sender, 'sender': sender, 'senderName': 'Customer'},
+        'messageData': {'typeMessage': 'textMessage', 'chatId': sender, 'senderName': 'Customer',
+                        'textMessageData': {'textMessage': text}}
+    }
+
+def message_texts(ticket_id):
+    return [message['text'] for message in main.get_ticket_messages(ticket_id)]
+
+def wait_until(condition, timeout=5):
+    """Wait for a background thread to make a condition true."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for the condition')
+        time.sleep(0.005)
@@ -0,0 +1,56 @@
+"""Archiving idle closed tickets to the SQLite cold tier and rehydrating them.
+
+    python -m pytest tests
+"""
+import unittest
+
+from support import fakes, main, message_texts, open_ticket, use_database
+
+OLD_TIMESTAMP = '2020-01-01T00:00:00'
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.database = fakes.FakeDatabase()
+        use_database(self.database)
+        self.assertIsNotNone(main.archive_db)
+
+    def archive_closed_ticket(self, sender, texts):
+        ticket_id = open_ticket(sender, texts, timestamp=OLD_TIMESTAMP)
+        self.assertTrue(main.close_ticket(ticket_id))
+        main.save_ticket_to_db(main.tickets[ticket_id])
+        self.assertTrue(main.flush_pending_writes())
+        main.archive_idle_tickets()
+        return ticket_id
+
+    def test_idle_closed_ticket_is_archived_and_rehydrated_on_access(self):
+        texts = ['zyxarchived question', 'second message']
+        ticket_id = self.archive_closed_ticket('archive-idle@c.us', texts)
+        ticket_data = main.tickets[ticket_id]
+        self.assertTrue(ticket_data.get('archived'))
+        self.assertNotIn('messages', ticket_data)
+        self.assertEqual(ticket_data['message_count'], 2)
+
+        # Search results read the archive without rehydrating the ticket
+        [result] = main.app.test_client().get('/api/search?q=zyxarchived').get_json()['results']
+        self.assertEqual(result['text'], 'zyxarchived question')
+        self.assertTrue(ticket_data.get('archived'))
+
+        rehydrated = main.archive_stats['rehydrated']
+        self.assertEqual(message_texts(ticket_id), texts)
+        self.assertNotIn('archived', ticket_data)
+        self.assertEqual(main.archive_stats['rehydrated'], rehydrated + 1)
+        self.assertEqual(self.database.calls['messages.select'], 0)  # Not from the database
+
+    def test_recent_and_open_tickets_stay_in_memory(self):
+        open_id = open_ticket('archive-open@c.us', ['still open'], timestamp=OLD_TIMESTAMP)
+        recent_id = open_ticket('archive-recent@c.us', ['closed today'], timestamp=main.datetime.now().isoformat())
+        self.assertTrue(main.close_ticket(recent_id))
+        main.save_ticket_to_db(main.tickets[recent_id])
+        self.assertTrue(main.flush_pending_writes())
+        main.archive_idle_tickets()
+        for ticket_id in (open_id, recent_id):
+            self.assertIn('messages', main.tickets[ticket_id])
+            self.assertFalse(main.tickets[ticket_id].get('archived'))
+
+if __name__ == '__main__':
+    unittest.main()
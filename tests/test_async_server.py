@@ -0,0 +1,73 @@
+"""async_main.py's handlers for webhooks, replies and uploads, served by aiohttp.
+
+    python -m pytest tests
+"""
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from support import fakes, green_api, main, open_ticket, text_webhook, use_database
+
+try:
+    import aiohttp
+    from aiohttp.test_utils import AioHTTPTestCase
+    import async_main
+except ImportError:
+    raise unittest.SkipTest('aiohttp is not installed')
+
+class AsyncServerTest(AioHTTPTestCase):
+    def setUp(self):
+        self.database = fakes.FakeDatabase()
+        use_database(self.database)
+        patcher = mock.patch.object(async_main, 'create_http_session', lambda: fakes.FakeGreenApiSession(green_api))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    async def get_application(self):
+        return await async_main.create_app()
+
+    async def test_webhook_opens_a_ticket_once(self):
+        sent = green_api.calls['sendMessage']
+        webhook = text_webhook('async-first', 'async-webhook@c.us', 'hello from the loop')
+        response = await self.client.post('/webhook', json=webhook)
+        self.assertEqual(await response.json(), {'status': 'ok'})
+        await asyncio.gather(*async_main.webhook_tasks)
+
+        [ticket_id] = [ticket_id for ticket_id, ticket_data in list(main.tickets.items())
+                       if ticket_data['sender_id'] == 'async-webhook@c.us']
+        self.assertEqual([message['text'] for message in main.get_ticket_messages(ticket_id)][0], 'hello from the loop')
+        self.assertEqual(green_api.calls['sendMessage'], sent + 1)  # The ticket created reply
+
+        response = await self.client.post('/webhook', json=webhook)
+        self.assertEqual(await response.json(), {'status': 'ok', 'duplicate': True})
+        response = await self.client.post('/webhook', data='not json')
+        self.assertEqual(response.status, 400)
+
+    async def test_send_reply(self):
+        ticket_id = open_ticket('async-reply@c.us', ['hello'])
+        response = await self.client.post(f'/send_reply/{ticket_id}', json={'message': 'On it'})
+        self.assertEqual(await response.json(), {'success': True, 'message': 'Reply sent successfully'})
+        last = main.get_ticket_messages(ticket_id)[-1]
+        self.assertEqual((last['author'], last['text']), ('Agent', 'On it'))
+
+        response = await self.client.post(f'/send_reply/{ticket_id}', json={'message': '  '})
+        self.assertEqual(await response.json(), {'success': False, 'message': 'Message cannot be empty'})
+
+    async def test_uploaded_audio_is_transcoded_by_the_thread_pool(self):
+        ticket_id = open_ticket('async-upload@c.us', ['hello'])
+        calls = []
+        def transcode_audio(input_data, profile='mp3'):
+            calls.append((input_data, profile, threading.current_thread() is threading.main_thread()))
+            return b'mp3 data'
+        form = aiohttp.FormData()
+        form.add_field('file', b'ogg data', filename='note.ogg', content_type='audio/ogg')
+        with mock.patch.object(main, 'transcode_audio', transcode_audio):
+            response = await self.client.post(f'/send_file/{ticket_id}', data=form)
+        self.assertEqual(await response.json(), {'success': True, 'message': 'File sent successfully'})
+        self.assertEqual(calls, [(b'ogg data', 'mp3', False)])  # Not on the loop
+        self.assertEqual(main.get_ticket_messages(ticket_id)[-1]['file_name'], 'note.mp3')
+
+if __name__ == '__main__':
+    unittest.main()
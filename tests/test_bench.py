@@ -0,0 +1,65 @@
+"""The benchmark harness: its workload, statistics and baseline comparison.
+
+    python -m pytest tests
+"""
+import argparse
+import contextlib
+import io
+import unittest
+
+from support import fakes, green_api, main, use_database
+
+import run
+import workload
+
+def result(**values):
+    return dict({'throughput': 100.0, 'processed_per_second': 90.0, 'p50_ms': 2.0, 'p95_ms': 5.0, 'p99_ms': 9.0,
+                 'db_calls_per_request': 1.0, 'http_calls_per_request': 0.5, 'requests': 100,
+                 'statuses': {'200': 100}, 'db_calls_by_kind': {}, 'http_calls_by_kind': {}}, **values)
+
+class BenchTest(unittest.TestCase):
+    def test_same_seed_gives_same_webhooks(self):
+        first, second = (workload.WebhookWorkload(seed=7).webhooks(50) for _ in range(2))
+        strip = lambda webhooks: [dict(webhook, timestamp=None) for webhook in webhooks]
+        self.assertEqual(strip(first), strip(second))
+        self.assertNotEqual(strip(first), strip(workload.WebhookWorkload(seed=8).webhooks(50)))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([run.percentile(values, percent) for percent in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(run.percentile([], 50), 0.0)
+
+    def test_rounds_combine_best_latency_and_throughput(self):
+        combined = run.combine_rounds([
+            result(throughput=80.0, p50_ms=3.0, requests=100, statuses={'200': 100}),
+            result(throughput=120.0, p50_ms=4.0, requests=100, statuses={'200': 99, '503': 1}),
+            result(throughput=100.0, p50_ms=2.5, requests=100, statuses={'200': 100}),
+        ])
+        self.assertEqual((combined['throughput'], combined['p50_ms'], combined['rounds']), (120.0, 2.5, 3))
+        self.assertEqual(combined['statuses'], {'200': 299, '503': 1})
+
+    def test_baseline_comparison_flags_regressions_only_for_the_same_settings(self):
+        config = {'mode': 'sync', 'requests': 100, 'scenarios': ['webhooks'], 'python': '3', 'machine': 'here'}
+        baseline = {'config': config, 'scenarios': {'webhooks': result()}}
+        slower = {'webhooks': result(throughput=50.0, p99_ms=90.0)}
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(run.compare_with_baseline(slower, config, baseline, tolerance=0.2), ['webhooks throughput'])
+            self.assertEqual(run.compare_with_baseline(slower, dict(config, requests=200), baseline, tolerance=0.2), [])
+            self.assertEqual(run.compare_with_baseline({'webhooks': result(throughput=90.0)}, config, baseline, tolerance=0.2), [])
+
+    def test_scenario_measures_webhooks_end_to_end(self):
+        database = fakes.FakeDatabase()
+        use_database(database)
+        measured = run.measure('webhooks', main, database, green_api, workload.WebhookWorkload(seed=3), argparse.Namespace(requests=40, threads=4))
+        self.assertEqual((measured['requests'], measured['errors']), (40, 0))
+        self.assertEqual(measured['db_calls'], sum(measured['db_calls_by_kind'].values()))
+
+        # Every customer message was processed and written before measure returned
+        webhooks = workload.WebhookWorkload(seed=3).webhooks(40)
+        expected = sum(1 for webhook in webhooks
+                       if (webhook['messageData'].get('textMessageData') or {}).get('textMessage') != '!close')
+        stored = [row for rows in database.messages_by_ticket.values() for row in rows if row['author'] != 'System']
+        self.assertEqual(len(stored), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""The pre-sorted ticket index and aggregates behind the paginated dashboard.
+
+    python -m pytest tests
+"""
+import unittest
+
+from support import fakes, main, open_ticket, use_database
+
+def all_ticket_ids(status=None):
+    ticket_ids, total = main.get_ticket_page(status, 1, 10 ** 6)
+    assert total == len(ticket_ids)
+    return ticket_ids
+
+class DashboardIndexTest(unittest.TestCase):
+    def setUp(self):
+        use_database(fakes.FakeDatabase())
+        self.client = main.app.test_client()
+
+    def test_newest_tickets_come_first_and_pages_split_the_list(self):
+        older = open_ticket('dashboard-older@c.us', ['hello'])
+        newer = open_ticket('dashboard-newer@c.us', ['hello'])
+        ticket_ids = all_ticket_ids()
+        self.assertLess(ticket_ids.index(newer), ticket_ids.index(older))
+        first_page, total = main.get_ticket_page(None, 1, 2)
+        second_page, _ = main.get_ticket_page(None, 2, 2)
+        self.assertEqual(first_page + second_page, ticket_ids[:4])
+        self.assertEqual(total, len(ticket_ids))
+
+    def test_closing_moves_the_ticket_and_updates_the_stats(self):
+        ticket_id = open_ticket('dashboard-close@c.us', ['hello'])
+        stats = main.get_ticket_stats()
+        self.assertIn(ticket_id, all_ticket_ids('open'))
+        self.assertTrue(main.close_ticket(ticket_id))
+        self.assertNotIn(ticket_id, all_ticket_ids('open'))
+        self.assertIn(ticket_id, all_ticket_ids('closed'))
+        self.assertEqual(main.get_ticket_stats(), dict(stats, open=stats['open'] - 1, closed=stats['closed'] + 1))
+
+    def test_rebuilt_index_matches_the_maintained_one(self):
+        open_ticket('dashboard-rebuild@c.us', ['hello'])
+        maintained = {status: all_ticket_ids(status) for status in (None, 'open', 'closed')}
+        stats = main.get_ticket_stats()
+        main.rebuild_ticket_index()
+        self.assertEqual({status: all_ticket_ids(status) for status in (None, 'open', 'closed')}, maintained)
+        self.assertEqual(main.get_ticket_stats(), stats)
+
+    def test_dashboard_renders_the_requested_page(self):
+        open_ticket('dashboard-page-1@c.us', ['hello'])
+        open_ticket('dashboard-page-2@c.us', ['hello'])
+        newest, second = all_ticket_ids()[:2]
+        for page, shown, hidden in ((1, newest, second), (2, second, newest)):
+            response = self.client.get(f'/dashboard?per_page=1&page={page}')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(f'data-ticket-id="{shown}"'.encode(), response.data)
+            self.assertNotIn(f'data-ticket-id="{hidden}"'.encode(), response.data)
+        response = self.client.get('/dashboard?page=100000')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'data-ticket-id="T', response.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+"""The /debug/* routes, only served with DEBUG_TOKEN set and the token in a header.
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import main
+
+class DebugRoutesTest(unittest.TestCase):
+    def setUp(self):
+        self.client = main.app.test_client()
+
+    def test_routes_are_missing_without_a_token(self):
+        with mock.patch.object(main, 'DEBUG_TOKEN', ''):
+            for path in ('/debug/slow', '/debug/profile?seconds=0.1'):
+                self.assertEqual(self.client.get(path).status_code, 404)
+                self.assertEqual(self.client.get(path, headers={'X-Debug-Token': ''}).status_code, 404)
+
+    def test_token_is_only_accepted_in_the_header(self):
+        with mock.patch.object(main, 'DEBUG_TOKEN', 'secret'):
+            self.assertEqual(self.client.get('/debug/slow').status_code, 403)
+            self.assertEqual(self.client.get('/debug/slow', query_string={'token': 'secret'}).status_code, 403)
+            self.assertEqual(self.client.get('/debug/slow', headers={'X-Debug-Token': 'wrong'}).status_code, 403)
+            self.assertEqual(self.client.get('/debug/slow', headers={'X-Debug-Token': 'sécret'}).status_code, 403)
+
+            response = self.client.get('/debug/slow', headers={'X-Debug-Token': 'secret'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['threshold_seconds'], main.SLOW_REQUEST_THRESHOLD)
+            response = self.client.get('/debug/profile', query_string={'seconds': 0.1}, headers={'X-Debug-Token': 'secret'})
+            self.assertEqual((response.status_code, response.mimetype), (200, 'text/plain'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""The JSON API's change cursors, conditional GETs and compression.
+
+    python -m pytest tests
+"""
+import gzip
+import json
+import unittest
+
+from support import fakes, main, open_ticket, use_database
+
+class DeltaApiTest(unittest.TestCase):
+    def setUp(self):
+        use_database(fakes.FakeDatabase())
+        self.client = main.app.test_client()
+
+    def get(self, path, status=200, **kwargs):
+        response = self.client.get(path, **kwargs)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def append_agent_message(self, ticket_id, text):
+        main.append_message(ticket_id, {'author': 'Agent', 'message_type': 'text', 'text': text,
+                                        'timestamp': '2026-01-01T00:01:00'})
+
+    def test_tickets_since_a_cursor_are_the_changed_ones(self):
+        quiet = open_ticket('api-quiet@c.us', ['hello'])
+        busy = open_ticket('api-busy@c.us', ['hello'])
+        listing = self.get('/api/tickets').get_json()
+        self.assertTrue(listing['reset'])
+        self.assertTrue({quiet, busy} <= {ticket['id'] for ticket in listing['tickets']})
+
+        self.append_agent_message(busy, 'reply')
+        changes = self.get('/api/tickets', query_string={'since': listing['cursor']}).get_json()
+        self.assertFalse(changes['reset'])
+        self.assertEqual([(ticket['id'], ticket['message_count']) for ticket in changes['tickets']], [(busy, 2)])
+        self.assertEqual(self.get('/api/tickets', query_string={'since': changes['cursor']}).get_json()['tickets'], [])
+
+    def test_limited_changes_continue_from_the_cursor(self):
+        cursor = self.get('/api/tickets').get_json()['cursor']
+        ticket_ids = [open_ticket(f'api-page-{number}@c.us', ['hello']) for number in range(3)]
+        first = self.get('/api/tickets', query_string={'since': cursor, 'limit': 2}).get_json()
+        self.assertTrue(first['more'])
+        rest = self.get('/api/tickets', query_string={'since': first['cursor'], 'limit': 2}).get_json()
+        self.assertFalse(rest['more'])
+        self.assertEqual([ticket['id'] for ticket in first['tickets'] + rest['tickets']], ticket_ids)
+
+    def test_unknown_cursor_gets_a_full_listing(self):
+        self.assertTrue(self.get('/api/tickets', query_string={'since': 'otherprocess-5'}).get_json()['reset'])
+
+    def test_unchanged_responses_are_not_modified(self):
+        ticket_id = open_ticket('api-etag@c.us', ['hello'])
+        for path in ('/api/tickets', f'/api/tickets/{ticket_id}/messages'):
+            etag = self.get(path).headers['ETag']
+            self.get(path, status=304, headers={'If-None-Match': etag})
+        self.append_agent_message(ticket_id, 'reply')
+        self.assertEqual(self.get(path, headers={'If-None-Match': etag}).get_json()['cursor'], 2)
+
+    def test_messages_after_a_position(self):
+        ticket_id = open_ticket('api-messages@c.us', ['one', 'two', 'three'])
+        page = self.get(f'/api/tickets/{ticket_id}/messages', query_string={'after': 1, 'limit': 1}).get_json()
+        self.assertEqual(([message['text'] for message in page['messages']], page['cursor'], page['more']), (['two'], 2, True))
+        self.get('/api/tickets/T0/messages', status=404)
+
+    def test_large_responses_are_gzipped(self):
+        ticket_id = open_ticket('api-gzip@c.us', [f'message number {number}' for number in range(50)])
+        response = self.get(f'/api/tickets/{ticket_id}/messages', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))['messages']), 50)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+"""Saving only what changed in a ticket since it was last saved.
+
+    python -m pytest tests
+"""
+import unittest
+
+from support import fakes, main, open_ticket, use_database
+
+class DeltaSaveTest(unittest.TestCase):
+    def setUp(self):
+        self.database = fakes.FakeDatabase()
+        use_database(self.database)
+
+    def buffered_rows(self):
+        with main.pending_writes_condition:
+            return list(main.pending_ticket_rows.values()), list(main.pending_message_rows)
+
+    def append_agent_message(self, ticket_id, text):
+        main.append_message(ticket_id, {'author': 'Agent', 'message_type': 'text', 'text': text,
+                                        'timestamp': '2026-01-01T00:01:00'})
+
+    def test_unchanged_ticket_writes_nothing(self):
+        ticket_id = open_ticket('delta-unchanged@c.us', ['hello'])
+        self.assertTrue(main.save_ticket_to_db(main.tickets[ticket_id]))
+        self.assertEqual(self.buffered_rows(), ([], []))
+
+    def test_only_appended_messages_are_written(self):
+        ticket_id = open_ticket('delta-append@c.us', ['hello', 'anyone there?'])
+        self.append_agent_message(ticket_id, 'yes')
+        self.assertTrue(main.save_ticket_to_db(main.tickets[ticket_id]))
+        ticket_rows, message_rows = self.buffered_rows()
+        self.assertEqual(ticket_rows, [])
+        self.assertEqual([row['text'] for row in message_rows], ['yes'])
+        self.assertTrue(main.flush_pending_writes())
+        self.assertEqual([row['text'] for row in self.database.messages_by_ticket[ticket_id]], ['hello', 'anyone there?', 'yes'])
+
+    def test_changed_fields_write_the_ticket_row_only(self):
+        ticket_id = open_ticket('delta-notes@c.us', ['hello'])
+        main.tickets[ticket_id]['admin_notes'] = 'called back'
+        self.assertTrue(main.save_ticket_to_db(main.tickets[ticket_id]))
+        ticket_rows, message_rows = self.buffered_rows()
+        self.assertEqual([row['admin_notes'] for row in ticket_rows], ['called back'])
+        self.assertEqual(message_rows, [])
+
+    def test_unknown_ticket_is_reconciled_with_stored_count(self):
+        ticket_id = open_ticket('delta-unknown@c.us', ['hello', 'again'])
+        with main.persist_lock:
+            del main.persisted_ticket_state[ticket_id]  # As if saved by an earlier process
+        self.append_agent_message(ticket_id, 'answer')
+        selects = self.database.calls['messages.select']
+        self.assertTrue(main.save_ticket_to_db(main.tickets[ticket_id]))
+        self.assertEqual(self.database.calls['messages.select'], selects + 1)
+        self.assertTrue(main.flush_pending_writes())
+        self.assertEqual([row['text'] for row in self.database.messages_by_ticket[ticket_id]], ['hello', 'again', 'answer'])
+
+if __name__ == '__main__':
+    unittest.main()
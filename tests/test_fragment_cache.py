@@ -0,0 +1,62 @@
+"""Rendered dashboard rows and ticket messages cached per ticket version.
+
+    python -m pytest tests
+"""
+import unittest
+from collections import Counter
+from unittest import mock
+
+from support import fakes, main, open_ticket, use_database
+
+class FragmentCacheTest(unittest.TestCase):
+    def setUp(self):
+        use_database(fakes.FakeDatabase())
+        self.client = main.app.test_client()
+        self.rendered = Counter()  # Template -> renders
+        def render_template(template, **context):
+            self.rendered[template] += 1
+            return original(template, **context)
+        original = main.render_template
+        patcher = mock.patch.object(main, 'render_template', render_template)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def append_agent_message(self, ticket_id, text):
+        main.append_message(ticket_id, {'author': 'Agent', 'message_type': 'text', 'text': text,
+                                        'timestamp': '2026-01-01T00:01:00'})
+
+    def test_dashboard_row_is_rendered_once_per_version(self):
+        ticket_id = open_ticket('fragment-row@c.us', ['hello'])
+        with main.app.test_request_context():
+            row, card = main.render_dashboard_ticket(ticket_id, main.tickets[ticket_id])
+            self.assertEqual(main.render_dashboard_ticket(ticket_id, main.tickets[ticket_id]), (row, card))
+            self.assertEqual(self.rendered['partials/ticket_row.html'], 1)
+
+            self.append_agent_message(ticket_id, 'fresh reply')
+            new_row, _ = main.render_dashboard_ticket(ticket_id, main.tickets[ticket_id])
+        self.assertEqual(self.rendered['partials/ticket_row.html'], 2)
+        self.assertIn('fresh reply', new_row)
+
+    def test_new_message_only_renders_itself(self):
+        ticket_id = open_ticket('fragment-messages@c.us', ['one', 'two', 'three'])
+        self.assertEqual(self.client.get(f'/ticket/{ticket_id}').status_code, 200)
+        self.assertEqual(self.rendered['partials/message.html'], 3)
+        self.client.get(f'/ticket/{ticket_id}')
+        self.assertEqual(self.rendered['partials/message.html'], 3)
+
+        self.append_agent_message(ticket_id, 'four')
+        response = self.client.get(f'/ticket/{ticket_id}')
+        self.assertEqual(self.rendered['partials/message.html'], 4)
+        self.assertIn(b'four', response.data)
+
+    def test_cache_is_bounded_least_recently_used_first(self):
+        with mock.patch.object(main, 'FRAGMENT_CACHE_MAX_BYTES', 10):
+            main.store_fragment('fragment-bound', 'a', 1, 'x' * 6)
+            main.store_fragment('fragment-bound', 'b', 1, 'y' * 6)
+            self.assertIsNone(main.get_fragment('fragment-bound', 'a', 1))
+            self.assertEqual(main.get_fragment('fragment-bound', 'b', 1), 'y' * 6)
+            self.assertIsNone(main.get_fragment('fragment-bound', 'b', 2))  # Another version
+            self.assertLessEqual(main.get_fragment_cache_stats()['bytes'], 10)
+
+if __name__ == '__main__':
+    unittest.main()
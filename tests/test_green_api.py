@@ -0,0 +1,106 @@
+"""The Green API send queue: priorities, retries and the rate limit.
+
+    python -m pytest tests
+"""
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from support import fakes, green_api, main, wait_until
+
+class ScriptedGreenApi(fakes.FakeGreenApi):
+    """Records the message of every request, and can fail or hold requests."""
+
+    def __init__(self, failures=()):
+        super().__init__()
+        self.failures = list(failures)  # Per request: an exception to raise, a status to answer, or None
+        self.entered = []  # (message, monotonic time) in the order requests arrived
+        self.permits = None  # A semaphore each request waits on, if set
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            self.entered.append((json.loads(request.body or b'{}').get('message'), time.monotonic()))
+            failure = self.failures.pop(0) if self.failures else None
+        if self.permits is not None:
+            self.permits.acquire()
+        if isinstance(failure, Exception):
+            raise failure
+        response = super().send(request, **kwargs)
+        if failure:
+            response.status_code = failure
+        return response
+
+class GreenApiTest(unittest.TestCase):
+    def use_green_api(self, fake, **settings):
+        fake.install(main.green_api_session)
+        self.addCleanup(green_api.install, main.green_api_session)
+        for name, value in dict({'GREEN_API_BACKOFF': 0.01}, **settings).items():
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.start_green_api_senders()
+        return fake
+
+    def post(self, message, priority=main.PRIORITY_AUTOMATIC):
+        return main.green_api_post('api', 'sendMessage', priority=priority, json={'chatId': 'test@c.us', 'message': message})
+
+    def test_agent_replies_go_ahead_of_automatic_messages(self):
+        fake = self.use_green_api(ScriptedGreenApi())
+        fake.permits = threading.Semaphore(0)
+        senders = len(main.green_api_senders)
+        threads = []
+        def send(message, priority):
+            thread = threading.Thread(target=self.post, args=(message, priority))
+            thread.start()
+            threads.append(thread)
+
+        for index in range(senders):  # Keep every sender busy
+            send(f'busy {index}', main.PRIORITY_AUTOMATIC)
+        wait_until(lambda: len(fake.entered) == senders)
+        for message, priority in (('automatic 1', main.PRIORITY_AUTOMATIC), ('automatic 2', main.PRIORITY_AUTOMATIC),
+                                  ('agent', main.PRIORITY_AGENT)):
+            queued = main.green_api_queue.qsize()
+            send(message, priority)
+            wait_until(lambda: main.green_api_queue.qsize() == queued + 1)
+
+        # Free one sender at a time; each takes the best queued request
+        for expected in range(senders + 1, senders + 4):
+            fake.permits.release()
+            wait_until(lambda: len(fake.entered) == expected)
+        for _ in range(senders + 3):
+            fake.permits.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([message for message, _ in fake.entered[senders:]], ['agent', 'automatic 1', 'automatic 2'])
+
+    def test_connection_errors_and_unavailable_responses_are_retried(self):
+        fake = self.use_green_api(ScriptedGreenApi([requests.ConnectionError('reset'), 503]))
+        retries = main.get_green_api_stats()['endpoints'].get('sendMessage', {}).get('retries', 0)
+        response = self.post('retried')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(fake.entered), 3)
+        self.assertEqual(main.get_green_api_stats()['endpoints']['sendMessage']['retries'], retries + 2)
+
+    def test_gives_up_after_max_retries(self):
+        fake = self.use_green_api(ScriptedGreenApi([requests.ConnectionError('reset')] * 3), GREEN_API_MAX_RETRIES=2)
+        with self.assertRaises(requests.ConnectionError):
+            self.post('lost')
+        self.assertEqual(len(fake.entered), 3)
+
+    def test_requests_are_spaced_by_the_rate_limit(self):
+        fake = self.use_green_api(ScriptedGreenApi(), GREEN_API_RATE_LIMIT=20)
+        threads = [threading.Thread(target=self.post, args=(f'limited {index}',)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        times = sorted(entered_at for _, entered_at in fake.entered)
+        self.assertEqual(len(times), 4)
+        self.assertGreaterEqual(times[-1] - times[0], 3 / 20 - 0.01)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""The write-ahead journal: replay after a crash, and compaction into the snapshot.
+
+    python -m pytest tests
+"""
+import os
+import unittest
+from unittest import mock
+
+from support import fakes, main, open_ticket, use_database
+
+class UnreachableDatabase(fakes.FakeDatabase):
+    def execute(self, query):
+        if query.operation in ('insert', 'upsert'):
+            raise Exception('connection refused')
+        return super().execute(query)
+
+def journal_message_texts(ticket_id):
+    return [row['text'] for kind, row in main.iter_journal_rows() if kind == 'message' and row['ticket_id'] == ticket_id]
+
+class JournalTest(unittest.TestCase):
+    def test_unflushed_rows_are_replayed_after_a_crash(self):
+        use_database(UnreachableDatabase())
+        message = {'author': 'Customer', 'message_type': 'text', 'text': 'journaled', 'timestamp': '2026-01-01T00:00:00'}
+        ticket_id, _ = main.record_incoming_message('journal-crash@c.us', 'Customer', message)
+        main.save_ticket_to_db(main.tickets[ticket_id])
+        self.assertFalse(main.flush_pending_writes())
+
+        # The process dies with the rows only in the journal
+        database = fakes.FakeDatabase()
+        use_database(database)
+        main.recover_journal()
+        self.assertTrue(main.flush_pending_writes())
+        self.assertEqual([row['text'] for row in database.messages_by_ticket[ticket_id]], ['journaled'])
+        self.assertIn(ticket_id, database.tickets)
+
+    def test_compaction_folds_flushed_segments_into_the_snapshot(self):
+        use_database(fakes.FakeDatabase())
+        ticket_id = open_ticket('journal-compact@c.us', ['one', 'two'])
+        with mock.patch.object(main, 'JOURNAL_COMPACT_MIN_RATIO', 0):
+            main.compact_journal()
+            main.compact_journal()  # Rotates the segment the first run kept open
+        self.assertGreater(main.journal_state['snapshot_seq'], 0)
+        self.assertTrue(os.path.exists(main.journal_path(main.JOURNAL_SNAPSHOT_NAME)))
+        self.assertEqual(journal_message_texts(ticket_id), ['one', 'two'])
+
+        # Later records stay in the segments until they rival the snapshot in size
+        main.append_message(ticket_id, {'author': 'Agent', 'message_type': 'text', 'text': 'three',
+                                        'timestamp': '2026-01-02T00:00:00'})
+        main.save_ticket_to_db(main.tickets[ticket_id])
+        self.assertTrue(main.flush_pending_writes())
+        snapshot_seq = main.journal_state['snapshot_seq']
+        with mock.patch.object(main, 'JOURNAL_COMPACT_MIN_RATIO', 1000):
+            main.compact_journal()
+        self.assertEqual(main.journal_state['snapshot_seq'], snapshot_seq)
+        self.assertEqual(journal_message_texts(ticket_id), ['one', 'two', 'three'])
+
+if __name__ == '__main__':
+    unittest.main()
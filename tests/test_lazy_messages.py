@@ -0,0 +1,54 @@
+"""Ticket messages loaded on demand into a bounded LRU cache (LAZY_MESSAGES).
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import fakes, main, message_texts, open_ticket, use_database
+
+class LazyMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.database = fakes.FakeDatabase()
+        use_database(self.database)
+        for name, value in (('LAZY_MESSAGES', True), ('MESSAGE_CACHE_MAX_TICKETS', 2)):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.clear_message_cache()
+        self.addCleanup(main.clear_message_cache)
+
+    def test_least_recently_used_ticket_is_evicted_and_reloaded(self):
+        first = open_ticket('lazy-first@c.us', ['one', 'two'])
+        second = open_ticket('lazy-second@c.us', ['three'])
+        main.get_ticket_messages(first)  # Now the second is least recently used
+        open_ticket('lazy-third@c.us', ['four'])
+        self.assertIn('messages', main.tickets[first])
+        self.assertNotIn('messages', main.tickets[second])
+        self.assertEqual(main.tickets[second]['message_count'], 1)  # The header stays
+        self.assertEqual(main.tickets[second]['last_message']['text'], 'three')
+
+        misses = main.get_message_cache_stats()['misses']
+        selects = self.database.calls['messages.select']
+        self.assertEqual(message_texts(second), ['three'])
+        self.assertEqual(main.get_message_cache_stats()['misses'], misses + 1)
+        self.assertEqual(self.database.calls['messages.select'], selects + 1)
+        self.assertEqual(message_texts(second), ['three'])  # Now resident
+        self.assertEqual(self.database.calls['messages.select'], selects + 1)
+
+    def test_ticket_with_unsaved_messages_stays_resident(self):
+        unsaved = open_ticket('lazy-unsaved@c.us', ['hello'])
+        main.append_message(unsaved, {'author': 'Agent', 'message_type': 'text', 'text': 'not saved yet',
+                                      'timestamp': '2026-01-01T00:01:00'})
+        open_ticket('lazy-other-1@c.us', ['one'])
+        open_ticket('lazy-other-2@c.us', ['two'])
+        self.assertIn('messages', main.tickets[unsaved])
+
+        self.assertTrue(main.save_ticket_to_db(main.tickets[unsaved]))
+        self.assertTrue(main.flush_pending_writes())
+        open_ticket('lazy-other-3@c.us', ['three'])
+        self.assertNotIn('messages', main.tickets[unsaved])
+        self.assertEqual(message_texts(unsaved), ['hello', 'not saved yet'])
+
+if __name__ == '__main__':
+    unittest.main()
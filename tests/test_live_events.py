@@ -0,0 +1,71 @@
+"""Live ticket updates over /events (Server-Sent Events) and /events/poll.
+
+    python -m pytest tests
+"""
+import json
+import threading
+import time
+import unittest
+from collections import deque
+from unittest import mock
+
+from support import fakes, main, open_ticket, use_database
+
+class LiveEventsTest(unittest.TestCase):
+    def setUp(self):
+        use_database(fakes.FakeDatabase())
+        self.client = main.app.test_client()
+
+    def poll(self, cursor, timeout=0):
+        response = self.client.get('/events/poll', query_string={'cursor': cursor, 'timeout': timeout})
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_poll_returns_events_after_the_cursor(self):
+        ticket_id = open_ticket('events-poll@c.us', ['hello'])
+        cursor = main.get_event_cursor()
+        main.append_message(ticket_id, {'author': 'Agent', 'message_type': 'text', 'text': 'reply',
+                                        'timestamp': '2026-01-01T00:01:00'})
+        result = self.poll(cursor)
+        self.assertFalse(result['reset'])
+        self.assertEqual([(event['type'], event['ticket_id'], event.get('position')) for event in result['events']],
+                         [('message-appended', ticket_id, 1)])
+        self.assertEqual(self.poll(result['cursor']), dict(result, events=[]))
+
+    def test_waiting_poll_wakes_up_on_publish(self):
+        cursor = main.get_event_cursor()
+        timer = threading.Timer(0.05, main.publish_event, args=('notes-updated', 'events-wake'))
+        timer.start()
+        started_at = time.monotonic()
+        result = self.poll(cursor, timeout=5)
+        timer.join()
+        self.assertLess(time.monotonic() - started_at, 2)
+        self.assertEqual([event['ticket_id'] for event in result['events']], ['events-wake'])
+
+    def test_unknown_or_expired_cursor_resets(self):
+        self.assertTrue(self.poll('otherprocess-1')['reset'])
+        with mock.patch.object(main, 'event_log', deque(maxlen=2)):
+            cursor = main.get_event_cursor()
+            for _ in range(3):
+                main.publish_event('notes-updated', 'events-expired')
+            self.assertTrue(self.poll(cursor)['reset'])
+
+    def test_stream_sends_events_with_their_cursor(self):
+        cursor = main.get_event_cursor()
+        stream = main.stream_events(cursor)
+        self.assertEqual(next(stream), 'retry: 3000\n\n')
+        main.publish_event('status-changed', 'events-stream', status='closed')
+        event_id, data = next(stream).strip().split('\n')
+        stream.close()
+        event = json.loads(data[len('data: '):])
+        self.assertEqual(event_id, f"id: {event['id']}")
+        self.assertEqual((event['type'], event['ticket_id'], event['status']), ('status-changed', 'events-stream', 'closed'))
+        self.assertEqual(main.get_event_stats()['subscribers'], 0)
+
+    def test_stream_from_another_process_resets(self):
+        response = self.client.get('/events', headers={'Last-Event-ID': 'otherprocess-1'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertIn('data: {"type": "reset"}', response.get_data(as_text=True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+"""The content-addressed media cache and the media route serving it.
+
+    python -m pytest tests
+"""
+import os
+import unittest
+from unittest import mock
+
+from support import fakes, green_api, main, open_ticket, use_database
+
+def media_url(name):
+    return f'https://{fakes.MEDIA_HOST}/{name}'
+
+class MediaCacheTest(unittest.TestCase):
+    def setUp(self):
+        use_database(fakes.FakeDatabase())
+        self.client = main.app.test_client()
+
+    def test_media_is_served_with_range_requests(self):
+        ticket_id = open_ticket('media-range@c.us', ['see attached'])
+        main.append_message(ticket_id, {'author': 'Customer', 'message_type': 'document', 'text': '[Document]',
+                                        'file_url': media_url('range.pdf'), 'file_name': 'range.pdf',
+                                        'mime_type': 'application/pdf', 'timestamp': '2026-01-01T00:01:00'})
+        response = self.client.get(f'/ticket/{ticket_id}/media/1', headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], f'bytes 0-9/{len(green_api.media_content)}')
+        self.assertEqual(response.data, green_api.media_content[:10])
+        self.assertEqual(response.mimetype, 'application/pdf')
+        self.assertEqual(self.client.get(f'/ticket/{ticket_id}/media/0').status_code, 404)  # A text message
+
+    @mock.patch.object(green_api, 'media_content', b'forwarded voice note')
+    def test_identical_content_is_stored_once(self):
+        downloads = green_api.calls['download']
+        files = main.get_media_cache_stats()['files']
+        first = main.get_media(media_url('forward-1.ogg'))
+        second = main.get_media(media_url('forward-2.ogg'))
+        self.assertEqual(first, second)
+        self.assertEqual(main.get_media(media_url('forward-1.ogg')), first)  # From the cache
+        self.assertEqual(green_api.calls['download'], downloads + 2)
+        self.assertEqual(main.get_media_cache_stats()['files'], files + 1)
+
+    def test_least_recently_used_blob_is_evicted_with_its_refs(self):
+        with mock.patch.object(main, 'MEDIA_CACHE_MAX_BYTES', 25):
+            old = main.store_media(media_url('old.ogg'), [b'o' * 10])
+            used = main.store_media(media_url('used.ogg'), [b'u' * 10])
+            main.get_cached_media_path(media_url('old.ogg'))  # Now used.ogg is least recently used
+            new = main.store_media(media_url('new.ogg'), [b'n' * 10])
+        self.assertEqual(main.get_cached_media_path(media_url('old.ogg')), old)
+        self.assertEqual(main.get_cached_media_path(media_url('new.ogg')), new)
+        self.assertIsNone(main.get_cached_media_path(media_url('used.ogg')))
+        self.assertFalse(os.path.exists(used))
+        self.assertFalse(os.path.exists(main.media_ref_path(main.media_url_key(media_url('used.ogg')))))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Messages held as slotted Message records that read like dicts.
+
+    python -m pytest tests
+"""
+import unittest
+
+from support import fakes, main, open_ticket, use_database
+
+class MessageRecordTest(unittest.TestCase):
+    def setUp(self):
+        use_database(fakes.FakeDatabase())
+        self.client = main.app.test_client()
+
+    def test_text_message_reads_like_its_dict(self):
+        message = main.compact_message({'author': 'Customer', 'message_type': 'text', 'text': 'hello',
+                                        'timestamp': '2026-01-01T00:00:00'})
+        self.assertEqual(dict(message), {'author': 'Customer', 'message_type': 'text', 'text': 'hello',
+                                         'timestamp': '2026-01-01T00:00:00'})
+        self.assertIsNone(message.media)
+        self.assertIsNone(message['file_url'])
+        self.assertEqual(message.get('file_name', 'none'), 'none')
+        self.assertNotIn('file_url', message)
+        with self.assertRaises(KeyError):
+            message['original_message_data']
+
+    def test_authors_and_types_are_interned(self):
+        first = main.Message(''.join(['Cust', 'omer']), '2026-01-01T00:00:00', message_type=''.join(['au', 'dio']))
+        second = main.Message(''.join(['Custo', 'mer']), '2026-01-01T00:00:01', message_type=''.join(['aud', 'io']))
+        self.assertIs(first['author'], second['author'])
+        self.assertIs(first['message_type'], second['message_type'])
+
+    def test_replace_keeps_the_other_fields(self):
+        message = main.Message('Customer', '2026-01-01T00:00:00', message_type='audio', file_url='https://x/voice.ogg',
+                               duration=4, metadata={'transcription_status': 'pending'})
+        done = message.replace(metadata={'transcription_status': 'completed'})
+        self.assertEqual(dict(done), dict(message, metadata={'transcription_status': 'completed'}))
+        self.assertEqual(message['metadata'], {'transcription_status': 'pending'})
+
+    def test_raw_payload_is_dropped_once_saved_and_read_back_on_request(self):
+        payload = {'typeMessage': 'documentMessage', 'downloadUrl': 'https://x/report.pdf'}
+        ticket_id = open_ticket('records-raw@c.us', ['see attached'])
+        main.append_message(ticket_id, {'author': 'Customer', 'message_type': 'document', 'text': '[Document]',
+                                        'file_url': 'https://x/report.pdf', 'file_name': 'report.pdf',
+                                        'metadata': {'original_message_data': payload, 'note': 'kept'},
+                                        'timestamp': '2026-01-01T00:01:00'})
+        message = main.get_ticket_messages(ticket_id)[1]
+        self.assertEqual(message['metadata'], {'note': 'kept'})
+        self.assertEqual(message.raw_payload, payload)
+
+        self.assertTrue(main.save_ticket_to_db(main.tickets[ticket_id]))
+        self.assertTrue(main.flush_pending_writes())
+        self.assertIsNone(message.raw_payload)
+        response = self.client.get(f'/api/tickets/{ticket_id}/messages', query_string={'after': 1, 'raw': 'true'})
+        [message_json] = response.get_json()['messages']
+        self.assertEqual(message_json['original_message_data'], payload)
+        self.assertEqual(message_json['metadata'], {'note': 'kept'})
+
+if __name__ == '__main__':
+    unittest.main()
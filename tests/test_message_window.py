@@ -0,0 +1,61 @@
+"""The ticket page's window of recent messages and the older history fetched by position.
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import fakes, main, open_ticket, use_database
+
+TEXTS = [f'msg-{number:02d}' for number in range(7)]
+
+def shown(html):
+    return [text for text in TEXTS if text in html]
+
+class MessageWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.database = fakes.FakeDatabase()
+        use_database(self.database)
+        for name, value in (('TICKET_MESSAGE_WINDOW', 3), ('LAZY_MESSAGES', True), ('MESSAGE_CACHE_MAX_TICKETS', 1)):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.clear_message_cache()
+        self.addCleanup(main.clear_message_cache)
+        self.client = main.app.test_client()
+
+    def test_ticket_page_renders_the_last_messages(self):
+        ticket_id = open_ticket('window-page@c.us', TEXTS)
+        response = self.client.get(f'/ticket/{ticket_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(shown(response.get_data(as_text=True)), TEXTS[4:])
+
+    def test_older_messages_are_fetched_before_a_cursor(self):
+        ticket_id = open_ticket('window-history@c.us', TEXTS)
+        page = self.client.get(f'/ticket/{ticket_id}/messages', query_string={'before': 4, 'limit': 3}).get_json()
+        self.assertEqual((shown(page['html']), page['cursor'], page['more'], page['message_count']), (TEXTS[1:4], 1, True, 7))
+        page = self.client.get(f'/ticket/{ticket_id}/messages', query_string={'before': page['cursor'], 'limit': 3}).get_json()
+        self.assertEqual((shown(page['html']), page['cursor'], page['more']), (TEXTS[:1], 0, False))
+        self.assertEqual(self.client.get('/ticket/window-missing/messages', query_string={'before': 1}).status_code, 404)
+
+    def test_evicted_ticket_loads_only_its_window(self):
+        ticket_id = open_ticket('window-evicted@c.us', TEXTS[:5])
+        for text in TEXTS[5:]:
+            main.append_message(ticket_id, {'author': 'Customer', 'message_type': 'text', 'text': text,
+                                            'timestamp': '2026-01-01T00:01:00'})
+        self.assertTrue(main.save_ticket_to_db(main.tickets[ticket_id]))  # Buffered, not flushed
+        open_ticket('window-other@c.us', ['hello'])
+        self.assertNotIn('messages', main.tickets[ticket_id])
+
+        window_loads = main.get_message_cache_stats()['window_loads']
+        snapshot = main.snapshot_ticket_window(ticket_id, lambda count: (count - 3, count))
+        self.assertEqual(([message['text'] for message in snapshot['messages']], snapshot['message_start'], snapshot['message_count']),
+                         (TEXTS[4:], 4, 7))  # Stored and buffered messages
+        self.assertEqual(main.get_message_cache_stats()['window_loads'], window_loads + 1)
+        self.assertNotIn('messages', main.tickets[ticket_id])  # Still not resident
+
+        page = self.client.get(f'/ticket/{ticket_id}/messages', query_string={'before': 4, 'limit': 2}).get_json()
+        self.assertEqual((shown(page['html']), page['cursor']), (TEXTS[2:4], 2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Latency histograms and counters kept in per-thread shards, served at /metrics.
+
+    python -m pytest tests
+"""
+import threading
+import unittest
+from unittest import mock
+
+from support import fakes, main, open_ticket, use_database
+
+def metric(name, **labels):
+    return main.collect_metrics().get((name, tuple(sorted(labels.items()))))
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        use_database(fakes.FakeDatabase())
+        self.client = main.app.test_client()
+
+    def test_histogram_is_rendered_with_cumulative_buckets(self):
+        name = 'ticket_system_transcode_seconds'
+        main.observe(name, 0.003, profile='metrics-render')
+        main.observe(name, 0.2, profile='metrics-render')
+        main.observe(name, 120, profile='metrics-render')
+        lines = [line for line in main.render_metrics({}).splitlines() if 'metrics-render' in line]
+        self.assertIn(f'{name}_bucket{{profile="metrics-render",le="0.001"}} 0', lines)
+        self.assertIn(f'{name}_bucket{{profile="metrics-render",le="0.005"}} 1', lines)
+        self.assertIn(f'{name}_bucket{{profile="metrics-render",le="0.25"}} 2', lines)
+        self.assertIn(f'{name}_bucket{{profile="metrics-render",le="60.0"}} 2', lines)
+        self.assertIn(f'{name}_bucket{{profile="metrics-render",le="+Inf"}} 3', lines)
+        self.assertIn(f'{name}_count{{profile="metrics-render"}} 3', lines)
+        self.assertIn(f'{name}_sum{{profile="metrics-render"}} 120.203', lines)
+
+    def test_threads_record_into_their_own_shards_and_are_kept_after_exiting(self):
+        name = 'ticket_system_green_api_errors_total'
+        def record():
+            for _ in range(100):
+                main.increment(name, method='metricsShards')
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(metric(name, method='metricsShards'), [800])
+        self.assertEqual(metric(name, method='metricsShards'), [800])  # Folded into the retired shard only once
+        self.assertFalse(any(thread in threads for thread, _ in main.metric_shards))
+
+    def test_supabase_queries_are_timed_by_table_and_operation(self):
+        database = fakes.FakeDatabase()
+        main.supabase = main.InstrumentedSupabase(fakes.FakeClient(database))
+        before = metric('ticket_system_supabase_request_seconds', table='tickets', operation='upsert')
+        open_ticket('metrics-supabase@c.us', ['hello'])
+        after = metric('ticket_system_supabase_request_seconds', table='tickets', operation='upsert')
+        self.assertGreater(database.calls['tickets.upsert'], 0)
+        self.assertEqual(sum(after[:-1]) - sum(before[:-1] if before else [0]), database.calls['tickets.upsert'])
+
+    def test_endpoint_serves_gauges(self):
+        open_ticket('metrics-gauges@c.us', ['hello', 'again'])
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.mimetype.startswith('text/plain'))
+        body = response.get_data(as_text=True)
+        self.assertIn('# TYPE ticket_system_tickets gauge', body)
+        self.assertIn(f'ticket_system_tickets{{status="open"}} {main.get_ticket_stats()["open"]}', body)
+        self.assertIn('ticket_system_queue_depth{queue="pending_writes"} 0', body)
+
+    def test_disabled_metrics_record_nothing(self):
+        with mock.patch.object(main, 'METRICS_ENABLED', False):
+            main.observe('ticket_system_transcode_seconds', 0.1, profile='metrics-disabled')
+            main.increment('ticket_system_green_api_errors_total', method='metricsDisabled')
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.assertIsNone(metric('ticket_system_transcode_seconds', profile='metrics-disabled'))
+        self.assertIsNone(metric('ticket_system_green_api_errors_total', method='metricsDisabled'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""The in-memory full-text search index over tickets and messages.
+
+    python -m pytest tests
+"""
+import unittest
+
+from support import fakes, main, open_ticket, use_database
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        use_database(fakes.FakeDatabase())
+        self.client = main.app.test_client()
+
+    def hits(self, query, **filters):
+        hits, total = main.search_tickets(query, **filters)
+        self.assertEqual(total, len(hits))
+        return {(hit['ticket_id'], hit['position']) for hit in hits}
+
+    def test_words_match_as_prefixes_and_all_must_match(self):
+        refund = open_ticket('search-refund@c.us', ['Where is my zyxrefund', 'zyxparcel arrived broken'])
+        parcel = open_ticket('search-parcel@c.us', ['zyxparcel is late'])
+        self.assertEqual(self.hits('zyxrefu'), {(refund, 0)})
+        self.assertEqual(self.hits('zyxparcel'), {(refund, 1), (parcel, 0)})
+        self.assertEqual(self.hits('zyxparcel broken'), {(refund, 1)})
+        self.assertEqual(self.hits('zyxparcel zyxnothing'), set())
+
+    def test_rare_word_is_probed_against_common_word(self):
+        texts = [f'zyxcommon note {number}' for number in range(40)] + ['zyxcommon zyxrarest', 'zyxrarest alone']
+        ticket_id = open_ticket('search-rare@c.us', texts)
+        self.assertEqual(self.hits('zyxcommon zyxrarest'), {(ticket_id, 40)})
+        self.assertEqual(self.hits('zyxrarest zyxcommo'), {(ticket_id, 40)})
+        [exact], _ = main.search_tickets('zyxcommon zyxrarest')
+        [prefix], _ = main.search_tickets('zyxcommo zyxrarest')
+        self.assertGreater(exact['score'], prefix['score'])
+
+    def test_appended_messages_and_status_filter(self):
+        ticket_id = open_ticket('search-append@c.us', ['hello'])
+        self.assertEqual(self.hits('zyxinvoice'), set())
+        main.append_message(ticket_id, {'author': 'Agent', 'message_type': 'text', 'text': 'zyxinvoice sent',
+                                        'timestamp': '2026-01-02T00:00:00'})
+        self.assertEqual(self.hits('zyxinvoice'), {(ticket_id, 1)})
+        self.assertEqual(self.hits('zyxinvoice', status='closed'), set())
+        self.assertEqual(self.hits('zyxinvoice', date_from='2026-01-03'), set())
+
+    def test_api_describes_the_matching_message(self):
+        ticket_id = open_ticket('search-api@c.us', ['first', 'zyxwarranty claim'])
+        response = self.client.get('/api/search?q=zyxwarranty')
+        self.assertEqual(response.status_code, 200)
+        [result] = response.get_json()['results']
+        self.assertEqual((result['ticket_id'], result['position']), (ticket_id, 1))
+        self.assertEqual((result['author'], result['text']), ('Customer', 'zyxwarranty claim'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Several workers sharing tickets through the database (SHARED_STATE).
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import fakes, main, message_texts, open_ticket, use_database
+
+class SharedStateTest(unittest.TestCase):
+    def setUp(self):
+        self.database = fakes.FakeDatabase()
+        use_database(self.database)
+        patcher = mock.patch.object(main, 'SHARED_STATE', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(main.shared_state, watermark=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open_elsewhere(self, ticket_id, sender, texts):
+        """Open a ticket as another worker would, straight in the database."""
+        self.database.write_ticket({'id': ticket_id, 'sender_id': sender, 'sender_name': 'Customer', 'status': 'open',
+                                    'created_at': '2026-01-01T00:00:00', 'admin_notes': ''}, insert_only=True)
+        for text in texts:
+            self.add_message_elsewhere(ticket_id, text)
+
+    def add_message_elsewhere(self, ticket_id, text):
+        message = main.Message('Customer', '2026-01-01T00:00:00', text=text)
+        self.database.write_message(main.build_message_record(ticket_id, message), 'message_key', True)
+
+    def record(self, sender, text):
+        message = {'author': 'Customer', 'message_type': 'text', 'text': text, 'timestamp': '2026-01-01T00:01:00'}
+        ticket_id, _ = main.record_incoming_message(sender, 'Customer', message)
+        return ticket_id
+
+    def test_worker_losing_the_claim_adopts_the_open_ticket(self):
+        sender = 'shared-race@c.us'
+        self.open_elsewhere('T900001', sender, ['from the other worker'])
+        self.assertEqual(self.record(sender, 'from this worker'), 'T900001')
+        self.assertEqual(message_texts('T900001'), ['from the other worker', 'from this worker'])
+        self.assertEqual(len(self.database.tickets), 1)
+
+    def test_sync_picks_up_changes_of_other_workers(self):
+        ticket_id = open_ticket('shared-sync@c.us', ['hello'])
+        self.database.write_ticket({'id': ticket_id, 'admin_notes': 'called back'}, insert_only=False)
+        self.add_message_elsewhere(ticket_id, 'answered elsewhere')
+        self.open_elsewhere('T900002', 'shared-new@c.us', ['new elsewhere'])
+        main.sync_shared_state()
+        self.assertEqual(main.tickets[ticket_id]['admin_notes'], 'called back')
+        self.assertEqual(message_texts(ticket_id), ['hello', 'answered elsewhere'])
+        self.assertEqual(main.open_tickets_by_sender['shared-new@c.us'], 'T900002')
+        self.assertEqual(message_texts('T900002'), ['new elsewhere'])
+
+    def test_ticket_closed_elsewhere_is_closed_here(self):
+        sender = 'shared-closed@c.us'
+        ticket_id = open_ticket(sender, ['hello'])
+        self.database.write_ticket({'id': ticket_id, 'status': 'closed'}, insert_only=False)
+        main.sync_shared_state()
+        self.assertEqual(main.tickets[ticket_id]['status'], 'closed')
+        self.assertNotIn(sender, main.open_tickets_by_sender)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""Per-sender lock stripes serializing changes to the in-memory tickets.
+
+    python -m pytest tests
+"""
+import threading
+import unittest
+import zlib
+
+from support import fakes, main, use_database
+
+def stripe(sender):
+    return zlib.crc32(sender.encode()) % main.TICKET_LOCK_STRIPES
+
+def customer_message(text):
+    return {'author': 'Customer', 'message_type': 'text', 'text': text, 'timestamp': '2026-01-01T00:00:00'}
+
+def run_concurrently(functions):
+    threads = [threading.Thread(target=function) for function in functions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+class TicketLockTest(unittest.TestCase):
+    def setUp(self):
+        use_database(fakes.FakeDatabase())
+
+    def sender_tickets(self, sender):
+        return [ticket_data for ticket_data in list(main.tickets.values()) if ticket_data['sender_id'] == sender]
+
+    def test_concurrent_first_messages_open_one_ticket(self):
+        sender = 'locks-burst@c.us'
+        run_concurrently([lambda number=number: main.record_incoming_message(sender, 'Customer', customer_message(f'm{number}'))
+                          for number in range(16)])
+        [ticket_data] = self.sender_tickets(sender)
+        self.assertEqual(sorted(message['text'] for message in main.get_ticket_messages(ticket_data['id'])),
+                         sorted(f'm{number}' for number in range(16)))
+
+    def test_closing_while_messages_arrive_never_leaves_two_open_tickets(self):
+        sender = 'locks-close@c.us'
+        functions = []
+        for number in range(20):
+            functions.append(lambda number=number: main.record_incoming_message(sender, 'Customer', customer_message(f'm{number}')))
+            functions.append(lambda: main.close_sender_ticket(sender))
+        run_concurrently(functions)
+        sender_tickets = self.sender_tickets(sender)
+        open_tickets = [ticket_data['id'] for ticket_data in sender_tickets if ticket_data['status'] == 'open']
+        self.assertLessEqual(len(open_tickets), 1)
+        self.assertEqual(main.open_tickets_by_sender.get(sender), open_tickets[0] if open_tickets else None)
+        self.assertEqual(sum(len(main.get_ticket_messages(ticket_data['id'])) for ticket_data in sender_tickets), 20)
+
+    def test_other_stripes_proceed_while_one_is_held(self):
+        busy = 'locks-busy@c.us'
+        other = next(f'locks-other-{number}@c.us' for number in range(1000) if stripe(f'locks-other-{number}@c.us') != stripe(busy))
+        ticket_id, _ = main.record_incoming_message(busy, 'Customer', customer_message('hello'))
+        contended = main.get_ticket_lock_stats()['contended']
+        append = threading.Thread(target=main.append_message, args=(ticket_id, customer_message('waited')))
+        with main.sender_lock(busy):
+            append.start()
+            main.record_incoming_message(other, 'Customer', customer_message('not blocked'))
+            append.join(0.2)
+            self.assertTrue(append.is_alive())  # The ticket's lock is its sender's
+        append.join(5)
+        self.assertEqual(main.get_ticket_messages(ticket_id)[-1]['text'], 'waited')
+        self.assertEqual(main.get_ticket_lock_stats()['contended'], contended + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""The ffmpeg transcoding pool: its cache, timeouts and bounded slots.
+
+An ffmpeg stand-in on PATH echoes its input, so the real subprocess handling
+runs without ffmpeg installed.
+
+    python -m pytest tests
+"""
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from support import main
+
+FAKE_FFMPEG = f'''#!{sys.executable}
+import sys, time
+if sys.argv[1:] == ['-version']:
+    sys.exit(0)
+data = sys.stdin.buffer.read()
+if data.startswith(b'slow'):
+    time.sleep(10)
+if data.startswith(b'bad'):
+    sys.stderr.write('Invalid data found when processing input')
+    sys.exit(1)
+sys.stdout.buffer.write(b'MP3:' + data)
+'''
+
+class TranscodingTest(unittest.TestCase):
+    def setUp(self):
+        bin_dir = tempfile.mkdtemp(prefix='fake-ffmpeg-')
+        ffmpeg = os.path.join(bin_dir, 'ffmpeg')
+        with open(ffmpeg, 'w') as f:
+            f.write(FAKE_FFMPEG)
+        os.chmod(ffmpeg, os.stat(ffmpeg).st_mode | stat.S_IXUSR)
+        for patcher in (mock.patch.dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', '')),
+                        mock.patch.dict(main.transcode_state, ffmpeg_available=None),
+                        mock.patch.object(main, 'transcode_slots', threading.BoundedSemaphore(2))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def stats(self):
+        return main.get_transcode_stats()
+
+    def test_output_is_cached_by_input(self):
+        before = self.stats()
+        self.assertEqual(main.transcode_audio(b'voice note 1'), b'MP3:voice note 1')
+        self.assertEqual(main.transcode_audio(b'voice note 1'), b'MP3:voice note 1')
+        after = self.stats()
+        self.assertEqual(after['jobs'], before['jobs'] + 1)
+        self.assertEqual(after['cache_hits'], before['cache_hits'] + 1)
+
+    def test_failed_conversion_is_not_cached(self):
+        jobs = self.stats()['jobs']
+        self.assertIsNone(main.transcode_audio(b'bad input'))
+        self.assertIsNone(main.transcode_audio(b'bad input'))
+        self.assertEqual(self.stats()['jobs'], jobs + 2)
+
+    def test_run_past_the_timeout_is_killed(self):
+        failed = self.stats()['failed']
+        started_at = time.monotonic()
+        with mock.patch.object(main, 'TRANSCODE_TIMEOUT', 0.5):
+            self.assertIsNone(main.transcode_audio(b'slow input'))
+        self.assertLess(time.monotonic() - started_at, 5)
+        self.assertEqual(self.stats()['failed'], failed + 1)
+        self.assertEqual(self.stats()['running'], 0)
+        self.assertEqual(main.transcode_audio(b'after the timeout'), b'MP3:after the timeout')  # Its slot is free again
+
+    def test_job_without_a_free_slot_gives_up(self):
+        slots = threading.BoundedSemaphore(1)
+        slots.acquire()
+        queue_timeouts = self.stats()['queue_timeouts']
+        with mock.patch.object(main, 'transcode_slots', slots), mock.patch.object(main, 'TRANSCODE_QUEUE_TIMEOUT', 0.05):
+            self.assertIsNone(main.transcode_audio(b'no slot'))
+        self.assertEqual(self.stats()['queue_timeouts'], queue_timeouts + 1)
+
+    def test_missing_ffmpeg_skips_conversion(self):
+        with mock.patch.dict(os.environ, PATH=tempfile.mkdtemp(prefix='no-ffmpeg-')):
+            self.assertIsNone(main.transcode_audio(b'voice note without ffmpeg'))
+        self.assertFalse(self.stats()['ffmpeg_available'])
+
+if __name__ == '__main__':
+    unittest.main()
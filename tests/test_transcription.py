@@ -0,0 +1,68 @@
+"""Background transcription of stored voice messages, in batches.
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import fakes, main, open_ticket, use_database
+
+def voice_message(name, duration):
+    return {'author': 'Customer', 'message_type': 'audio', 'text': f'[Voice Message - {duration}s]',
+            'file_url': f'https://{fakes.MEDIA_HOST}/{name}', 'file_name': name, 'duration': duration,
+            'mime_type': 'audio/ogg', 'metadata': {'transcription_status': 'pending'},
+            'timestamp': f'2026-01-01T00:{duration:02d}:00'}
+
+class TranscriptionTest(unittest.TestCase):
+    def setUp(self):
+        self.database = fakes.FakeDatabase()
+        use_database(self.database)
+        patcher = mock.patch.object(main, 'TRANSCRIPTION_ENGINE', 'stub')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open_with_voice(self, sender, durations):
+        ticket_id = open_ticket(sender, ['hello'])
+        for number, duration in enumerate(durations):
+            main.append_message(ticket_id, voice_message(f'{sender}-{number}.ogg', duration))
+        self.assertTrue(main.save_ticket_to_db(main.tickets[ticket_id]))
+        self.assertTrue(main.flush_pending_writes())
+        return ticket_id
+
+    def stored_statuses(self, ticket_id):
+        return [row['metadata']['transcription_status'] for row in self.database.messages_by_ticket[ticket_id]
+                if row['message_type'] == 'audio']
+
+    def test_batches_hold_up_to_the_configured_audio_seconds(self):
+        rows = [{'id': number, 'duration': duration} for number, duration in enumerate([100, 150, 100, 400, 10])]
+        with mock.patch.object(main, 'TRANSCRIPTION_BATCH_SECONDS', 300):
+            batches = main.batch_by_duration(rows)
+        self.assertEqual([[row['duration'] for row in batch] for batch in batches], [[100, 150], [100], [400], [10]])
+
+    def test_pending_voice_messages_are_transcribed_and_stored(self):
+        ticket_id = self.open_with_voice('transcribe-ok@c.us', [7, 12])
+        rows = main.fetch_pending_transcriptions()
+        self.assertEqual(len(rows), 2)
+        main.transcribe_batch(rows)
+
+        self.assertEqual(sorted(row['transcription_text'] for row in self.database.voice_transcriptions.values()),
+                         ['[Voice message, 12s]', '[Voice message, 7s]'])
+        self.assertEqual(self.stored_statuses(ticket_id), ['completed', 'completed'])
+        transcriptions = [message['metadata'].get('transcription') for message in main.get_ticket_messages(ticket_id)[1:]]
+        self.assertEqual(transcriptions, ['[Voice message, 7s]', '[Voice message, 12s]'])
+        self.assertEqual(main.fetch_pending_transcriptions(), [])
+
+    def test_untranscribable_messages_are_marked_failed(self):
+        ticket_id = self.open_with_voice('transcribe-failed@c.us', [3, 4, 5])
+        engine = lambda jobs: [None] + main.transcribe_with_stub(jobs[1:])
+        rows = main.fetch_pending_transcriptions()
+        gone = rows[2]['file_url']
+        get_media = main.get_media
+        with mock.patch.dict(main.TRANSCRIPTION_ENGINES, stub=engine), \
+                mock.patch.object(main, 'get_media', lambda file_url: None if file_url == gone else get_media(file_url)):
+            main.transcribe_batch(rows)
+        self.assertEqual(self.stored_statuses(ticket_id), ['failed', 'completed', 'failed'])
+        self.assertEqual(len(self.database.voice_transcriptions), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""Warm start from the local state snapshot, and catching up with the database.
+
+    python -m pytest tests
+"""
+import unittest
+
+from support import fakes, main, message_texts, open_ticket, use_database
+
+class WarmStartTest(unittest.TestCase):
+    def setUp(self):
+        self.database = fakes.FakeDatabase()
+        use_database(self.database)
+
+    def test_snapshot_restores_tickets_and_catch_up_adds_newer_messages(self):
+        ticket_id = open_ticket('warm-start@c.us', ['before the snapshot'])
+        self.assertTrue(main.write_state_snapshot())
+
+        # Another worker adds a message after the snapshot was taken
+        row = main.build_message_record(ticket_id, main.Message('Customer', '2026-01-02T00:00:00', text='after the snapshot'))
+        main.supabase.table('messages').insert(row).execute()
+
+        snapshot = main.load_state_snapshot()
+        self.assertEqual(main.warm_start_state['state'], 'warm')
+        self.assertEqual(message_texts(ticket_id), ['before the snapshot'])
+        self.assertEqual(main.open_tickets_by_sender['warm-start@c.us'], ticket_id)
+
+        self.assertGreaterEqual(main.catch_up_from_db(snapshot['watermark'], snapshot['message_watermark']), 1)
+        self.assertEqual(message_texts(ticket_id), ['before the snapshot', 'after the snapshot'])
+        self.assertEqual(main.tickets[ticket_id]['message_count'], 2)
+
+    def test_snapshot_waits_for_buffered_writes(self):
+        ticket_id = open_ticket('warm-buffered@c.us', ['saved'])
+        main.append_message(ticket_id, {'author': 'Agent', 'message_type': 'text', 'text': 'buffered',
+                                        'timestamp': '2026-01-02T00:00:00'})
+        main.save_ticket_to_db(main.tickets[ticket_id])
+        self.assertTrue(main.write_state_snapshot())
+        self.assertEqual([row['text'] for row in self.database.messages_by_ticket[ticket_id]], ['saved', 'buffered'])
+
+if __name__ == '__main__':
+    unittest.main()
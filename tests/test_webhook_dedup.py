@@ -0,0 +1,88 @@
+"""Deduplication of redelivered Green API webhooks by idMessage.
+
+    python -m pytest tests
+"""
+import unittest
+from unittest import mock
+
+from support import fakes, green_api, main, text_webhook, use_database
+
+class WebhookDedupTest(unittest.TestCase):
+    def setUp(self):
+        self.database = fakes.FakeDatabase()
+        use_database(self.database)
+        for name, value in (('WEBHOOK_WORKERS', 0), ('WEBHOOK_DEDUP_DATABASE', True)):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = main.app.test_client()
+
+    def post(self, payload):
+        response = self.client.post('/webhook', json=payload)
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def forget_ids(self):
+        """What a new process (or another worker) knows: none of the IDs."""
+        with main.webhook_dedup_lock:
+            main.webhook_dedup_ids.clear()
+
+    def customer_texts(self, ticket_id):
+        return [message['text'] for message in main.get_ticket_messages(ticket_id) if message['author'] == 'Customer']
+
+    def test_redelivery_after_restart_is_found_in_stored_ids(self):
+        sender = 'dedup-restart@c.us'
+        replies = green_api.calls['sendMessage']
+        self.assertNotIn('duplicate', self.post(text_webhook('DEDUP-1', sender, 'hello')))
+        ticket_id = main.open_tickets_by_sender[sender]
+        self.assertTrue(main.flush_pending_writes())
+
+        self.forget_ids()
+        main.seed_webhook_dedup()
+        self.assertTrue(self.post(text_webhook('DEDUP-1', sender, 'hello'))['duplicate'])
+        self.assertTrue(main.flush_pending_writes())
+
+        self.assertEqual(self.customer_texts(ticket_id), ['hello'])
+        stored = [row for row in self.database.messages_by_ticket[ticket_id] if row['author'] == 'Customer']
+        self.assertEqual(len(stored), 1)
+        self.assertEqual(green_api.calls['sendMessage'], replies + 1)  # One "ticket created" reply
+
+    def test_redelivery_to_another_worker_is_stored_once(self):
+        sender = 'dedup-worker@c.us'
+        self.post(text_webhook('DEDUP-4', sender, 'hello'))
+        ticket_id = main.open_tickets_by_sender[sender]
+        self.assertTrue(main.flush_pending_writes())
+
+        self.forget_ids()
+        self.post(text_webhook('DEDUP-4', sender, 'hello'))
+        self.assertTrue(main.flush_pending_writes())
+        stored = [row for row in self.database.messages_by_ticket[ticket_id] if row['author'] == 'Customer']
+        self.assertEqual(len(stored), 1)
+
+    def test_new_id_is_processed_without_database_lookup(self):
+        sender = 'dedup-new@c.us'
+        self.post(text_webhook('DEDUP-2', sender, 'first'))
+        self.forget_ids()
+        self.assertNotIn('duplicate', self.post(text_webhook('DEDUP-3', sender, 'second')))
+        self.assertEqual(self.customer_texts(main.open_tickets_by_sender[sender]), ['first', 'second'])
+        self.assertEqual(self.database.calls['messages.select'], 0)
+
+    def test_bloom_hit_is_confirmed_in_database(self):
+        bits = 1 << 16
+        for name, value in (('WEBHOOK_DEDUP_BLOOM_BITS', bits),
+                            ('webhook_dedup_bloom', [bytearray(bits // 8) for _ in range(2)])):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        sender = 'dedup-bloom@c.us'
+        self.post(text_webhook('DEDUP-5', sender, 'hello'))
+        self.assertTrue(main.flush_pending_writes())
+        self.assertEqual(self.database.calls['messages.select'], 0)
+
+        self.forget_ids()
+        self.assertTrue(self.post(text_webhook('DEDUP-5', sender, 'hello'))['duplicate'])
+        self.assertEqual(self.database.calls['messages.select'], 1)
+        self.assertEqual(self.customer_texts(main.open_tickets_by_sender[sender]), ['hello'])
+
+if __name__ == '__main__':
+    unittest.main()
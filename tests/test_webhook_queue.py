@@ -0,0 +1,57 @@
+"""Webhooks acknowledged on arrival and processed by per-sender worker threads.
+
+    python -m pytest tests
+"""
+import queue
+import unittest
+from unittest import mock
+
+from support import fakes, main, message_texts, text_webhook, use_database, wait_until
+
+class WebhookQueueTest(unittest.TestCase):
+    def setUp(self):
+        use_database(fakes.FakeDatabase())
+        patcher = mock.patch.object(main, 'WEBHOOK_WORKERS', 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = main.app.test_client()
+
+    def post(self, payload):
+        return self.client.post('/webhook', json=payload)
+
+    def wait_for_workers(self):
+        wait_until(lambda: not any(worker_queue.unfinished_tasks for worker_queue in main.webhook_queues))
+
+    def test_messages_of_a_sender_are_processed_in_order(self):
+        senders = [f'queue-order-{number}@c.us' for number in range(3)]
+        for number in range(20):
+            for sender in senders:
+                response = self.post(text_webhook(f'QUEUE-{sender}-{number}', sender, f'message {number}'))
+                self.assertEqual(response.status_code, 200)
+        self.wait_for_workers()
+        for sender in senders:
+            texts = [text for text in message_texts(main.open_tickets_by_sender[sender]) if text.startswith('message')]
+            self.assertEqual(texts, [f'message {number}' for number in range(20)])
+
+    def test_full_queue_rejects_and_forgets_the_webhook(self):
+        full_queue = queue.Queue(maxsize=1)
+        full_queue.put_nowait(None)
+        sender = 'queue-full@c.us'
+        payload = text_webhook('QUEUE-FULL', sender, 'hello')
+        with mock.patch.object(main, 'webhook_queues', [full_queue]):
+            response = self.post(payload)
+        self.assertEqual(response.status_code, 503)
+
+        # Green API redelivers it, and this time it is processed
+        response = self.post(payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('duplicate', response.get_json())
+        self.wait_for_workers()
+        self.assertIn('hello', message_texts(main.open_tickets_by_sender[sender]))
+
+    def test_invalid_payload_is_refused(self):
+        self.assertEqual(self.client.post('/webhook', data='not json').status_code, 400)
+        self.assertEqual(self.post({'idMessage': 'QUEUE-NO-TYPE'}).status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+"""Write-behind flushes against the bench's Supabase stand-in, with injected failures.
+
+    python -m pytest tests
+"""
+import threading
+import unittest
+from collections import Counter
+
+from support import fakes, main, use_database
+
+class RejectedRow(Exception):
+    code = '22P02'  # The database answered, as postgrest's APIError
+
+class FailingDatabase(fakes.FakeDatabase):
+    """A FakeDatabase whose queries fail while fail(query) returns an exception."""
+
+    def __init__(self):
+        super().__init__()
+        self.fail = lambda query: None
+
+    def execute(self, query):
+        error = self.fail(query)
+        if error is not None:
+            raise error
+        return super().execute(query)
+
+def fail_message_write(number, error):
+    """Fail the number-th message write (counting from 1) once with error."""
+    writes = Counter()
+    def fail(query):
+        if query.table != 'messages' or query.operation not in ('insert', 'upsert'):
+            return None
+        writes['count'] += 1
+        return error if writes['count'] == number else None
+    return fail
+
+class WriteBehindFlushTest(unittest.TestCase):
+    def setUp(self):
+        self.database = FailingDatabase()
+        use_database(self.database)
+
+    def build_rows(self, texts):
+        ticket_row = {'id': 'T1', 'sender_id': 'sender@c.us', 'sender_name': 'Sender', 'status': 'open',
+                      'created_at': '2026-01-01T00:00:00', 'admin_notes': ''}
+        message_rows = [main.build_message_record('T1', main.Message('customer', '2026-01-01T00:00:00', text=text))
+                        for text in texts]
+        return [ticket_row], message_rows
+
+    def buffer(self, ticket_rows, message_rows):
+        with main.pending_writes_condition:
+            main.add_pending_rows(ticket_rows, message_rows)
+
+    def stored_texts(self):
+        return [row['text'] for row in self.database.messages_by_ticket.get('T1', [])]
+
+    def test_failed_second_chunk_is_retried_without_duplicates(self):
+        texts = [f"message {number}" for number in range(5)]
+        self.buffer(*self.build_rows(texts))
+        self.database.fail = fail_message_write(2, Exception('connection reset'))
+
+        self.assertFalse(main.flush_pending_writes())
+        self.assertEqual(self.stored_texts(), texts[:2])
+        self.assertEqual(main.get_pending_row_count(), 3)  # Only the chunks not written
+
+        self.assertTrue(main.flush_pending_writes())
+        self.assertEqual(self.stored_texts(), texts)
+        self.assertEqual(main.get_pending_row_count(), 0)
+
+    def test_replayed_rows_are_stored_once(self):
+        texts = [f"message {number}" for number in range(5)]
+        ticket_rows, message_rows = self.build_rows(texts)
+        self.buffer(ticket_rows, message_rows)
+        self.database.fail = fail_message_write(2, Exception('connection reset'))
+        self.assertFalse(main.flush_pending_writes())
+
+        # A restart replays every journaled row, including the chunk already written
+        with main.pending_writes_condition:
+            main.pending_ticket_rows.clear()
+            main.pending_message_rows.clear()
+        self.buffer([dict(row) for row in ticket_rows], [dict(row) for row in message_rows])
+        self.assertTrue(main.flush_pending_writes())
+        self.assertEqual(self.stored_texts(), texts)
+
+    def test_rejected_row_is_dead_lettered_after_max_attempts(self):
+        texts = ['message 0', 'poison', 'message 2', 'message 3']
+        self.buffer(*self.build_rows(texts))
+        self.database.fail = lambda query: (RejectedRow('invalid input syntax')
+                                            if query.table == 'messages' and any(row['text'] == 'poison' for row in query.payload)
+                                            else None)
+
+        for attempt in range(main.WRITE_BEHIND_MAX_ATTEMPTS):
+            self.assertFalse(main.flush_pending_writes())
+        self.assertTrue(main.flush_pending_writes())
+        self.assertEqual(self.stored_texts(), ['message 0', 'message 2', 'message 3'])
+        self.assertEqual([record['row']['text'] for record in main.dead_letter_rows], ['poison'])
+        self.assertEqual(main.get_pending_row_count(), 0)
+
+    def test_unreachable_database_is_not_dead_lettered(self):
+        self.buffer(*self.build_rows(['message 0', 'message 1']))
+        self.database.fail = lambda query: Exception('connection refused')
+
+        for attempt in range(main.WRITE_BEHIND_MAX_ATTEMPTS + 1):
+            self.assertFalse(main.flush_pending_writes())
+        self.assertEqual(main.dead_letter_rows, [])
+        self.assertEqual(main.get_pending_row_count(), 3)
+
+    def test_load_during_a_stalled_flush_sees_each_message_once(self):
+        texts = [f"message {number}" for number in range(5)]
+        self.buffer(*self.build_rows(texts))
+        # The second message chunk stalls after the first one was written
+        stalled, resume = threading.Event(), threading.Event()
+        def stall(query):
+            if query.operation == 'upsert' and len(self.stored_texts()) == 2 and not resume.is_set():
+                stalled.set()
+                self.assertTrue(resume.wait(2), 'the load waited for the flush')
+            return None
+        self.database.fail = stall
+        flush = threading.Thread(target=main.flush_pending_writes)
+        flush.start()
+        try:
+            self.assertTrue(stalled.wait(2))
+            loaded = main.load_ticket_messages_from_db('T1')
+            window = main.load_message_window_from_db('T1', 1, 4)
+        finally:
+            resume.set()
+            flush.join(2)
+        self.assertEqual([message['text'] for message in loaded], texts)
+        self.assertEqual([message['text'] for message in window], texts[1:4])
+        self.assertEqual(self.stored_texts(), texts)
+
+if __name__ == '__main__':
+    unittest.main()